@@ -1,12 +1,58 @@
 import os
 import re
+import sys
+import csv
+import gzip
 import json
+import math
+import time
+import asyncio
+import atexit
+import hashlib
+import sqlite3
+import threading
+import contextvars
+from collections import OrderedDict, deque
+from email.utils import parsedate_to_datetime
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+import click
 import requests
-from flask import Flask, render_template_string, request, jsonify
+from requests.adapters import HTTPAdapter
+from urllib3.util import Timeout
+from urllib3.util.retry import Retry
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+try:
+    import brotli
+except ImportError:  # brotli is optional; gzip is always available
+    brotli = None
+from flask import Flask, Response, abort, render_template_string, request, jsonify
+from health_rules import WATCHED_TERMS_DIGEST, compile_rules, nutrient_display, watched_terms
+import metrics
+import request_timing
 
 app = Flask(__name__)
 
-# HTML Template as a string (unchanged from your original)
+# Third-party files the page loads, served from VENDOR_DIR when they are there
+# and match their sha256 and from these URLs otherwise; the service worker keeps
+# copies of them. A file with no sha256 yet is never saved or served locally.
+VENDOR_ASSETS = {
+    'bootstrap_css': {
+        'url': 'https://cdn.jsdelivr.net/npm/bootstrap@5.3.3/dist/css/bootstrap.min.css',
+        'sha256': '3c8f27e6009ccfd710a905e6dcf12d0ee3c6f2ac7da05b0572d3e0d12e736fc8',
+    },
+    'quagga_js': {
+        'url': 'https://cdn.jsdelivr.net/npm/quagga@0.12.1/dist/quagga.min.js',
+        'sha256': None,
+    },
+    'bootstrap_js': {
+        'url': 'https://cdn.jsdelivr.net/npm/bootstrap@5.3.3/dist/js/bootstrap.bundle.min.js',
+        'sha256': '0833b2e9c3a26c258476c46266e6877fc75218625162e0460be9a3a098a61c6c',
+    },
+}
+
+# The page, rendered once at startup: the scanner, its offline history and the
+# service worker registration
 HTML_TEMPLATE = '''
 <!DOCTYPE html>
 <html lang="en">
@@ -14,7 +60,8 @@ HTML_TEMPLATE = '''
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <title>Food Product Health Scanner</title>
-    <link rel="stylesheet" href="https://cdn.jsdelivr.net/npm/bootstrap@5.2.3/dist/css/bootstrap.min.css">
+    {% if vendor_from_cdn %}<link rel="preconnect" href="https://cdn.jsdelivr.net" crossorigin>{% endif %}
+    <link rel="stylesheet" href="{{ vendor.bootstrap_css }}">
     <style>
         /* Main Styles */
         body {
@@ -63,6 +110,18 @@ HTML_TEMPLATE = '''
             left: 0;
         }
 
+        /* The part of the frame the scanner decodes (SCAN_AREA in the script) */
+        #scan-region {
+            position: absolute;
+            top: 25%;
+            right: 10%;
+            bottom: 25%;
+            left: 10%;
+            border: 2px solid rgba(255, 255, 255, 0.8);
+            border-radius: 4px;
+            pointer-events: none;
+        }
+
         /* Product Info Styles */
         .product-image {
             max-height: 200px;
@@ -143,7 +202,9 @@ HTML_TEMPLATE = '''
             }
         }
     </style>
-    <script src="https://cdn.jsdelivr.net/npm/quagga@0.12.1/dist/quagga.min.js"></script>
+    <!-- Deferred: both run before DOMContentLoaded, where the page script uses them -->
+    <script defer src="{{ vendor.quagga_js }}"></script>
+    <script defer src="{{ vendor.bootstrap_js }}"></script>
 </head>
 <body>
     <div class="container">
@@ -170,6 +231,7 @@ HTML_TEMPLATE = '''
                             <div class="tab-pane fade show active" id="camera" role="tabpanel" aria-labelledby="camera-tab">
                                 <div id="scanner-container" class="mb-3">
                                     <div id="interactive" class="viewport"></div>
+                                    <div id="scan-region"></div>
                                 </div>
                                 <div class="d-grid gap-2">
                                     <button id="start-scanner" class="btn btn-primary">Start Scanner</button>
@@ -206,6 +268,7 @@ HTML_TEMPLATE = '''
                         <span id="health-badge" class="badge"></span>
                     </div>
                     <div class="card-body">
+                        <div id="saved-notice" class="alert alert-secondary d-none"></div>
                         <div class="row">
                             <div class="col-md-4 text-center mb-3">
                                 <img id="product-image" src="" alt="Product Image" class="img-fluid product-image mb-2">
@@ -255,7 +318,6 @@ HTML_TEMPLATE = '''
         </div>
     </div>
 
-    <script src="https://cdn.jsdelivr.net/npm/bootstrap@5.2.3/dist/js/bootstrap.bundle.min.js"></script>
     <script>
         document.addEventListener('DOMContentLoaded', function() {
             // DOM Elements
@@ -267,10 +329,44 @@ HTML_TEMPLATE = '''
             const errorMessage = document.getElementById('error-message');
             const productInfo = document.getElementById('product-info');
             
+            const savedNotice = document.getElementById('saved-notice');
+            
             // Scanner state
             let scannerInitialized = false;
             let scannerRunning = false;
             
+            // A code is accepted once it was read in CONSENSUS_FRAMES frames within
+            // CONSENSUS_WINDOW_MS and holds CONSENSUS_SHARE of the weight of all reads
+            // there; each read weighs 1 minus its mean decode error
+            const CONSENSUS_FRAMES = 3;
+            const CONSENSUS_WINDOW_MS = 1500;
+            const CONSENSUS_SHARE = 0.75;
+            // Reads whose bars matched worse than this are ignored
+            const MAX_DECODE_ERROR = 0.25;
+            // Only the band the guide box marks is searched, at most SCAN_FREQUENCY frames a second
+            const SCAN_AREA = { top: '25%', right: '10%', bottom: '25%', left: '10%' };
+            const SCAN_FREQUENCY = 10;
+            let readings = [];
+            // The browser's own detector, used when Quagga could not be loaded
+            let nativeScanner = null;
+            // Barcodes with a /search request under way; asking again would only repeat it
+            const pendingLookups = new Set();
+            
+            // Past results kept on this device, so a repeat scan renders without waiting for the server
+            const HISTORY_LIMIT = {{ scan_history_limit }};
+            const history = openHistory();
+            // The barcode on screen; answers that arrive after the next scan are stored but not shown
+            let currentBarcode = null;
+            
+            // Keep the page and its scripts on the device so it opens without a connection
+            if ('serviceWorker' in navigator) {
+                window.addEventListener('load', function() {
+                    navigator.serviceWorker.register('/sw.js').catch(error => {
+                        console.error("Service worker registration failed:", error);
+                    });
+                });
+            }
+            
             // Event Listeners
             startScannerBtn.addEventListener('click', startScanner);
             stopScannerBtn.addEventListener('click', stopScanner);
@@ -296,6 +392,15 @@ HTML_TEMPLATE = '''
             
             // Functions
             function initScanner() {
+                if (typeof Quagga === 'undefined') {
+                    if ('BarcodeDetector' in window) {
+                        initNativeScanner();
+                    } else {
+                        showError("The barcode scanner could not be loaded. Please use manual entry.");
+                    }
+                    return;
+                }
+                
                 Quagga.init({
                     inputStream: {
                         name: "Live",
@@ -306,12 +411,15 @@ HTML_TEMPLATE = '''
                             height: 480,
                             facingMode: "environment"
                         },
+                        area: SCAN_AREA,
                     },
                     locator: {
                         patchSize: "medium",
                         halfSample: true
                     },
-                    numOfWorkers: navigator.hardwareConcurrency || 4,
+                    frequency: SCAN_FREQUENCY,
+                    // With frames capped, more workers only add CPU
+                    numOfWorkers: Math.min(navigator.hardwareConcurrency || 2, 2),
                     decoder: {
                         readers: [
                             "ean_reader",
@@ -335,21 +443,98 @@ HTML_TEMPLATE = '''
                 });
             }
             
+            function initNativeScanner() {
+                const video = document.createElement('video');
+                video.muted = true;
+                video.playsInline = true;
+                document.querySelector('#interactive').appendChild(video);
+                nativeScanner = {
+                    detector: new BarcodeDetector({ formats: ['ean_13', 'ean_8', 'upc_a', 'upc_e'] }),
+                    video: video,
+                    stream: null,
+                    timer: null
+                };
+                scannerInitialized = true;
+                startScannerBtn.disabled = false;
+            }
+            
             function startScanner() {
                 if (!scannerInitialized) {
                     initScanner();
                     return;
                 }
                 
-                Quagga.start();
+                readings = [];
+                if (nativeScanner) {
+                    startNativeScanner();
+                } else {
+                    Quagga.start();
+                }
                 scannerRunning = true;
                 startScannerBtn.disabled = true;
                 stopScannerBtn.disabled = false;
             }
             
+            function startNativeScanner() {
+                navigator.mediaDevices.getUserMedia({
+                    video: { width: 640, height: 480, facingMode: "environment" }
+                }).then(stream => {
+                    if (!scannerRunning) {
+                        stream.getTracks().forEach(track => track.stop());
+                        return;
+                    }
+                    nativeScanner.stream = stream;
+                    nativeScanner.video.srcObject = stream;
+                    return nativeScanner.video.play().then(scanNativeFrame);
+                }).catch(err => {
+                    console.error("Error starting camera:", err);
+                    stopScanner();
+                    showError("Could not start the camera. Please ensure you've granted camera permissions or use manual entry.");
+                });
+            }
+            
+            function scanNativeFrame() {
+                if (!scannerRunning) {
+                    return;
+                }
+                const video = nativeScanner.video;
+                nativeScanner.detector.detect(video).then(barcodes => {
+                    barcodes.filter(barcode => inScanArea(barcode.boundingBox, video))
+                        .forEach(barcode => scannerRunning && recordReading(barcode.rawValue, 0));
+                }).catch(err => {
+                    console.error("Barcode detection failed:", err);
+                }).finally(() => {
+                    // One detection at a time, at most SCAN_FREQUENCY a second
+                    if (scannerRunning) {
+                        nativeScanner.timer = setTimeout(scanNativeFrame, 1000 / SCAN_FREQUENCY);
+                    }
+                });
+            }
+            
+            function inScanArea(box, video) {
+                // The same band Quagga is limited to: the code's centre must lie inside SCAN_AREA
+                const x = (box.x + box.width / 2) / video.videoWidth * 100;
+                const y = (box.y + box.height / 2) / video.videoHeight * 100;
+                return x >= parseFloat(SCAN_AREA.left) && x <= 100 - parseFloat(SCAN_AREA.right)
+                    && y >= parseFloat(SCAN_AREA.top) && y <= 100 - parseFloat(SCAN_AREA.bottom);
+            }
+            
+            function stopNativeScanner() {
+                clearTimeout(nativeScanner.timer);
+                if (nativeScanner.stream) {
+                    nativeScanner.stream.getTracks().forEach(track => track.stop());
+                    nativeScanner.stream = null;
+                }
+                nativeScanner.video.srcObject = null;
+            }
+            
             function stopScanner() {
                 if (scannerRunning) {
-                    Quagga.stop();
+                    if (nativeScanner) {
+                        stopNativeScanner();
+                    } else {
+                        Quagga.stop();
+                    }
                     scannerRunning = false;
                     startScannerBtn.disabled = false;
                     stopScannerBtn.disabled = true;
@@ -357,21 +542,46 @@ HTML_TEMPLATE = '''
             }
             
             function handleBarcodeDetection(result) {
-                if (result && result.codeResult) {
-                    const barcode = result.codeResult.code;
-                    stopScanner();
-                    
-                    // Clean barcode - remove any non-numeric characters
-                    const cleanedBarcode = barcode.replace(/[^0-9]/g, '');
-                    
-                    // Validate barcode
-                    if (!cleanedBarcode || cleanedBarcode.length < 8) {
-                        showError('Invalid barcode detected. Please try scanning again with better lighting or enter the barcode manually.');
-                        return;
-                    }
-                    
-                    searchProduct(cleanedBarcode);
+                if (!result || !result.codeResult || !result.codeResult.code) {
+                    return;
+                }
+                
+                recordReading(result.codeResult.code, decodeError(result.codeResult));
+            }
+            
+            function recordReading(code, error) {
+                // Clean barcode - remove any non-numeric characters
+                const cleanedBarcode = code.replace(/[^0-9]/g, '');
+                // A short or poorly matched read is a misread; keep scanning rather than look it up
+                if (cleanedBarcode.length < 8 || error > MAX_DECODE_ERROR) {
+                    return;
+                }
+                
+                const now = Date.now();
+                readings = readings.filter(reading => now - reading.at <= CONSENSUS_WINDOW_MS);
+                readings.push({ code: cleanedBarcode, weight: 1 - error, at: now });
+                
+                const agreeing = readings.filter(reading => reading.code === cleanedBarcode);
+                const weight = agreeing.reduce((sum, reading) => sum + reading.weight, 0);
+                const total = readings.reduce((sum, reading) => sum + reading.weight, 0);
+                if (agreeing.length < CONSENSUS_FRAMES || weight < CONSENSUS_SHARE * total) {
+                    return;
+                }
+                
+                readings = [];
+                stopScanner();
+                searchProduct(cleanedBarcode);
+            }
+            
+            function decodeError(codeResult) {
+                // The start, middle and end guards carry no error; the digits do
+                const errors = (codeResult.decodedCodes || [])
+                    .filter(code => code.error !== undefined)
+                    .map(code => code.error);
+                if (errors.length === 0) {
+                    return 1;
                 }
+                return errors.reduce((sum, error) => sum + error, 0) / errors.length;
             }
             
             function handleManualSubmit(event) {
@@ -387,8 +597,6 @@ HTML_TEMPLATE = '''
             }
             
             function searchProduct(barcode) {
-                // Show loading state
-                showLoading();
                 hideError();
                 
                 // Clean barcode input - remove any non-numeric characters
@@ -401,24 +609,59 @@ HTML_TEMPLATE = '''
                     return;
                 }
                 
-                // Make API request
-                fetch('/search', {
-                    method: 'POST',
-                    headers: {
-                        'Content-Type': 'application/x-www-form-urlencoded',
-                    },
-                    body: `barcode=${encodeURIComponent(cleanedBarcode)}`
-                })
+                currentBarcode = cleanedBarcode;
+                historyGet(cleanedBarcode).then(saved => {
+                    if (cleanedBarcode !== currentBarcode) {
+                        return;
+                    }
+                    if (saved) {
+                        // Show the saved copy at once and check it with the server behind it
+                        hideLoading();
+                        displayProductInfo(saved.product);
+                    } else {
+                        showLoading();
+                    }
+                    refreshProduct(cleanedBarcode, saved);
+                });
+            }
+            
+            function refreshProduct(cleanedBarcode, saved) {
+                // The request under way shows its answer if this barcode is still on screen
+                if (pendingLookups.has(cleanedBarcode)) {
+                    return;
+                }
+                pendingLookups.add(cleanedBarcode);
+                // With the saved ETag an unchanged product costs a 304 with no body
+                const headers = saved && saved.etag ? { 'If-None-Match': saved.etag } : {};
+                fetch(`/search?barcode=${encodeURIComponent(cleanedBarcode)}&schema=compact`, { headers: headers })
                 .then(response => {
-                    if (!response.ok) {
+                    if (response.status === 304 && saved) {
+                        return null;
+                    }
+                    // 503 and 504 mean Open Food Facts was unreachable or too slow; the body says so
+                    if (!response.ok && response.status !== 503 && response.status !== 504) {
                         throw new Error(`Server responded with status: ${response.status}`);
                     }
-                    return response.json();
+                    return response.json().then(data => ({ data: data, etag: response.headers.get('ETag') }));
                 })
-                .then(data => {
-                    hideLoading();
+                .then(answer => {
+                    const shown = cleanedBarcode === currentBarcode;
+                    if (answer === null) {
+                        // Unchanged; only its place in the history moves
+                        historyPut(Object.assign({}, saved, { scannedAt: Date.now() }));
+                        return;
+                    }
                     
+                    const data = answer.data;
                     if (data.error) {
+                        if (!shown) {
+                            return;
+                        }
+                        if (saved) {
+                            showSavedNotice('Showing details saved on this device; they could not be checked just now.');
+                            return;
+                        }
+                        hideLoading();
                         // Show error message with suggestions
                         let errorMessage = data.error;
                         if (data.error.includes('Product not found')) {
@@ -433,10 +676,29 @@ HTML_TEMPLATE = '''
                         return;
                     }
                     
-                    displayProductInfo(data);
+                    historyPut({ barcode: cleanedBarcode, etag: answer.etag, product: data, scannedAt: Date.now() });
+                    if (shown && !(saved && saved.etag === answer.etag)) {
+                        hideLoading();
+                        displayProductInfo(data);
+                    }
                 })
                 .catch(error => {
+                    console.error("Error fetching product:", error);
+                    if (cleanedBarcode !== currentBarcode) {
+                        return;
+                    }
+                    if (saved) {
+                        showSavedNotice(navigator.onLine === false
+                            ? 'You are offline. Showing details saved on this device.'
+                            : 'Showing details saved on this device; they could not be checked just now.');
+                        return;
+                    }
                     hideLoading();
+                    if (navigator.onLine === false) {
+                        showError('You are offline, and this product has not been looked up on this device before.<br><br>' +
+                            'Products you have scanned before can still be shown without a connection.');
+                        return;
+                    }
                     const errorHTML = 'An error occurred while fetching product information.<br><br>' +
                         'Possible reasons:<ul>' +
                         '<li>Network connection issues</li>' +
@@ -445,13 +707,73 @@ HTML_TEMPLATE = '''
                         '</ul>' +
                         'Please try again later or with a different product.';
                     showError(errorHTML);
-                    console.error("Error fetching product:", error);
+                })
+                .finally(() => pendingLookups.delete(cleanedBarcode));
+            }
+            
+            function openHistory() {
+                return new Promise(resolve => {
+                    if (!window.indexedDB) {
+                        resolve(null);
+                        return;
+                    }
+                    const request = indexedDB.open('scanner', 1);
+                    request.onupgradeneeded = () => {
+                        const store = request.result.createObjectStore('products', { keyPath: 'barcode' });
+                        store.createIndex('scannedAt', 'scannedAt');
+                    };
+                    request.onsuccess = () => resolve(request.result);
+                    // Private browsing may refuse storage; every scan then goes to the server
+                    request.onerror = () => resolve(null);
+                });
+            }
+            
+            function historyGet(barcode) {
+                return history.then(db => new Promise(resolve => {
+                    if (!db) {
+                        resolve(null);
+                        return;
+                    }
+                    const request = db.transaction('products').objectStore('products').get(barcode);
+                    request.onsuccess = () => resolve(request.result || null);
+                    request.onerror = () => resolve(null);
+                }));
+            }
+            
+            function historyPut(entry) {
+                history.then(db => {
+                    if (!db) {
+                        return;
+                    }
+                    const store = db.transaction('products', 'readwrite').objectStore('products');
+                    store.put(entry);
+                    // Keep the most recent HISTORY_LIMIT scans, deleting from the oldest
+                    const count = store.count();
+                    count.onsuccess = () => {
+                        let excess = count.result - HISTORY_LIMIT;
+                        if (excess <= 0) {
+                            return;
+                        }
+                        store.index('scannedAt').openCursor().onsuccess = event => {
+                            const cursor = event.target.result;
+                            if (cursor && excess-- > 0) {
+                                cursor.delete();
+                                cursor.continue();
+                            }
+                        };
+                    };
                 });
             }
             
+            function showSavedNotice(message) {
+                savedNotice.textContent = message;
+                savedNotice.classList.remove('d-none');
+            }
+            
             function displayProductInfo(product) {
                 // Hide error message if visible
                 hideError();
+                savedNotice.classList.add('d-none');
                 
                 // Set product name and brand
                 document.getElementById('product-name').textContent = product.name || 'Unknown Product';
@@ -481,6 +803,9 @@ HTML_TEMPLATE = '''
                 if (product.labels) {
                     productDetails += `<strong>Labels:</strong> ${product.labels}<br>`;
                 }
+                if (product.stale) {
+                    productDetails += '<div class="alert alert-warning mt-2">Showing saved product details, which may be out of date.</div>';
+                }
                 if (product.india_message) {
                     productDetails += `<div class="alert alert-info mt-2">${product.india_message}</div>`;
                 }
@@ -494,53 +819,34 @@ HTML_TEMPLATE = '''
                 // Set health badge
                 const healthBadge = document.getElementById('health-badge');
                 if (product.health_assessment) {
-                    if (product.health_assessment.overall_rating) {
-                        // New format with overall_rating
-                        if (product.health_assessment.overall_rating === 'Good') {
-                            healthBadge.textContent = 'Good';
-                            healthBadge.className = 'badge badge-success';
-                        } else if (product.health_assessment.overall_rating === 'Average') {
-                            healthBadge.textContent = 'Average';
-                            healthBadge.className = 'badge badge-warning';
-                        } else {
-                            healthBadge.textContent = 'Poor';
-                            healthBadge.className = 'badge badge-danger';
-                        }
+                    if (product.health_assessment.overall_rating === 'Good') {
+                        healthBadge.textContent = 'Good';
+                        healthBadge.className = 'badge badge-success';
+                    } else if (product.health_assessment.overall_rating === 'Average') {
+                        healthBadge.textContent = 'Average';
+                        healthBadge.className = 'badge badge-warning';
                     } else {
-                        // Old format with is_healthy
-                        healthBadge.textContent = product.health_assessment.is_healthy ? 'Healthy' : 'Not Healthy';
-                        healthBadge.className = 'badge ' + (product.health_assessment.is_healthy ? 'badge-success' : 'badge-danger');
+                        healthBadge.textContent = 'Poor';
+                        healthBadge.className = 'badge badge-danger';
                     }
                     
                     // Set health reasons
                     const healthReasonsList = document.getElementById('health-reasons');
                     healthReasonsList.innerHTML = '';
                     
-                    // Handle both new and old format
-                    if (product.health_assessment.positives) {
-                        // New format with positives/negatives
-                        product.health_assessment.positives.forEach(point => {
-                            const li = document.createElement('li');
-                            li.className = 'list-group-item list-group-item-success';
-                            li.textContent = point;
-                            healthReasonsList.appendChild(li);
-                        });
-                        
-                        product.health_assessment.negatives.forEach(point => {
-                            const li = document.createElement('li');
-                            li.className = 'list-group-item list-group-item-danger';
-                            li.textContent = point;
-                            healthReasonsList.appendChild(li);
-                        });
-                    } else if (product.health_assessment.reasons) {
-                        // Old format with reasons array
-                        product.health_assessment.reasons.forEach(reason => {
-                            const li = document.createElement('li');
-                            li.className = 'list-group-item';
-                            li.textContent = reason;
-                            healthReasonsList.appendChild(li);
-                        });
-                    }
+                    product.health_assessment.positives.forEach(point => {
+                        const li = document.createElement('li');
+                        li.className = 'list-group-item list-group-item-success';
+                        li.textContent = point;
+                        healthReasonsList.appendChild(li);
+                    });
+                    
+                    product.health_assessment.negatives.forEach(point => {
+                        const li = document.createElement('li');
+                        li.className = 'list-group-item list-group-item-danger';
+                        li.textContent = point;
+                        healthReasonsList.appendChild(li);
+                    });
                 }
                 
                 // Set age recommendations
@@ -551,28 +857,20 @@ HTML_TEMPLATE = '''
                 notSuitableAgesList.innerHTML = '';
                 
                 if (product.age_recommendations) {
-                    // Handle both new and old format
-                    const suitableAges = product.age_recommendations.suitable_for || 
-                                        product.age_recommendations.suitable || [];
-                    
-                    const notSuitableAges = product.age_recommendations.not_suitable_for || 
-                                           product.age_recommendations.not_suitable || [];
-                    
-                    suitableAges.forEach(age => {
+                    product.age_recommendations.suitable_for.forEach(age => {
                         const li = document.createElement('li');
                         li.className = 'list-group-item list-group-item-success';
                         li.textContent = age;
                         suitableAgesList.appendChild(li);
                     });
                     
-                    notSuitableAges.forEach(age => {
+                    product.age_recommendations.not_suitable_for.forEach(age => {
                         const li = document.createElement('li');
                         li.className = 'list-group-item list-group-item-danger';
                         li.textContent = age;
                         notSuitableAgesList.appendChild(li);
                     });
                     
-                    // Add reasons if available in new format
                     if (product.age_recommendations.reasons) {
                         const reasonsElement = document.getElementById('age-reasons');
                         if (reasonsElement) {
@@ -597,15 +895,7 @@ HTML_TEMPLATE = '''
                 const nutriments = product.nutriments;
                 if (nutriments && Object.keys(nutriments).length > 0) {
                     // Display key nutrients
-                    const keyNutrients = [
-                        { name: 'Energy', key: 'energy-kcal_100g', unit: 'kcal', high: 400, medium: 200 },
-                        { name: 'Fat', key: 'fat_100g', unit: 'g', high: 17.5, medium: 3 },
-                        { name: 'Saturated Fat', key: 'saturated-fat_100g', unit: 'g', high: 5, medium: 1.5 },
-                        { name: 'Sugars', key: 'sugars_100g', unit: 'g', high: 22.5, medium: 5 },
-                        { name: 'Salt', key: 'salt_100g', unit: 'g', high: 1.5, medium: 0.3 },
-                        { name: 'Fiber', key: 'fiber_100g', unit: 'g', high: 6, medium: 3 },
-                        { name: 'Proteins', key: 'proteins_100g', unit: 'g', high: 20, medium: 10 }
-                    ];
+                    const keyNutrients = {{ nutrient_display | tojson }};
                     
                     keyNutrients.forEach(nutrient => {
                         if (nutriments[nutrient.key] !== undefined) {
@@ -613,7 +903,7 @@ HTML_TEMPLATE = '''
                             let levelClass = 'medium';
                             
                             // For nutrients where high is good (fiber, protein)
-                            if (nutrient.name === 'Fiber' || nutrient.name === 'Proteins') {
+                            if (nutrient.higher_is_better) {
                                 levelClass = value >= nutrient.high ? 'low' : (value >= nutrient.medium ? 'medium' : 'high');
                             } else {
                                 levelClass = value >= nutrient.high ? 'high' : (value >= nutrient.medium ? 'medium' : 'low');
@@ -672,51 +962,2114 @@ HTML_TEMPLATE = '''
 </html>
 '''
 
+# Service worker served at /sw.js. It answers for the page and VENDOR_ASSETS from
+# its cache, so the page opens offline; /search results are kept by the page itself
+SERVICE_WORKER_TEMPLATE = '''
+// Named after the page's digest: a new page is a new worker, which caches it afresh
+const SHELL_CACHE = 'scanner-shell-{{ shell_version }}';
+const VENDOR_URLS = {{ vendor_urls | tojson }}.map(url => new URL(url, self.location).href);
+
+self.addEventListener('install', event => {
+    // The page must be cached; a vendor file that fails now is cached when the page next loads it
+    event.waitUntil(caches.open(SHELL_CACHE).then(cache => Promise.all([
+        cache.add(new Request('/', { cache: 'reload' })),
+        ...VENDOR_URLS.map(url => cache.add(url).catch(() => undefined)),
+    ])).then(() => self.skipWaiting()));
+});
+
+self.addEventListener('activate', event => {
+    event.waitUntil(caches.keys().then(names => Promise.all(
+        names.filter(name => name.startsWith('scanner-shell-') && name !== SHELL_CACHE)
+            .map(name => caches.delete(name))
+    )).then(() => self.clients.claim()));
+});
+
+self.addEventListener('fetch', event => {
+    const request = event.request;
+    if (request.method !== 'GET') {
+        return;
+    }
+    const url = new URL(request.url);
+    if (request.mode === 'navigate' && url.origin === self.location.origin && url.pathname === '/') {
+        event.respondWith(caches.match('/').then(cached => cached || fetch(request)));
+    } else if (VENDOR_URLS.includes(request.url)) {
+        // Fetched with CORS rather than as the page's no-cors request, so the copy is not opaque
+        event.respondWith(caches.match(request.url).then(cached => cached || fetch(request.url).then(response => {
+            if (response.ok) {
+                const copy = response.clone();
+                caches.open(SHELL_CACHE).then(cache => cache.put(request.url, copy));
+            }
+            return response;
+        })));
+    }
+    // Everything else, /search included, goes to the network as usual
+});
+'''
+
+# Health and age rules, compiled once from the table in health_rules.py
+rule_engine = compile_rules()
+
+# 'sync' serves through Flask; 'async' serves through the aiohttp app in async_app.py
+SERVER_MODE = os.environ.get('SERVER_MODE', 'sync')
+
+INVALID_BARCODE_ERROR = 'Invalid barcode format. Please provide a numeric barcode with at least 8 digits.'
+PRODUCT_NOT_FOUND_ERROR = 'Product not found. The barcode may not be in the Open Food Facts database.'
+UPSTREAM_UNAVAILABLE_ERROR = 'Open Food Facts could not be reached. Please try again in a moment.'
+UNKNOWN_SCHEMA_ERROR = "Unknown response schema. Use 'full' or 'compact'."
+LOOKUP_TIMED_OUT_ERROR = 'Open Food Facts did not answer in time. Please try again in a moment.'
+INVALID_TIMEOUT_ERROR = 'Invalid timeout. Give the seconds the lookup may take as a positive number.'
+
+# Upstream Open Food Facts configuration
+OFF_MIRRORS = ['world', 'us', 'uk', 'in']
+OFF_PRODUCT_URL = os.environ.get('OFF_PRODUCT_URL', 'https://{mirror}.openfoodfacts.org/api/v0/product/{barcode}.json')
+OFF_TIMEOUT = float(os.environ.get('OFF_TIMEOUT', 5))
+# Ask the mirrors for only the fields we read instead of the full product document
+OFF_FIELD_PROJECTION = os.environ.get('OFF_FIELD_PROJECTION', '1') != '0'
+
+# Seconds one lookup may spend on the mirrors in all, and the most a client may
+# ask for with the timeout parameter of /search
+SEARCH_DEADLINE = float(os.environ.get('SEARCH_DEADLINE', 8))
+SEARCH_DEADLINE_MAX = float(os.environ.get('SEARCH_DEADLINE_MAX', 30))
+
+# Each mirror request times out at a percentile of that mirror's recent latencies
+# times a multiplier, kept between MIRROR_TIMEOUT_MIN and OFF_TIMEOUT. Until it has
+# MIRROR_TIMEOUT_MIN_SAMPLES latencies a mirror gets the full OFF_TIMEOUT.
+MIRROR_LATENCY_WINDOW = int(os.environ.get('MIRROR_LATENCY_WINDOW', 200))
+MIRROR_TIMEOUT_MIN_SAMPLES = int(os.environ.get('MIRROR_TIMEOUT_MIN_SAMPLES', 20))
+MIRROR_TIMEOUT_PERCENTILE = float(os.environ.get('MIRROR_TIMEOUT_PERCENTILE', 0.95))
+MIRROR_TIMEOUT_MULTIPLIER = float(os.environ.get('MIRROR_TIMEOUT_MULTIPLIER', 2))
+MIRROR_TIMEOUT_MIN = float(os.environ.get('MIRROR_TIMEOUT_MIN', 0.25))
+
+# 'sequential' walks the ranked mirrors in order; 'hedged' starts with the best one
+# and fans out to the next mirror every HEDGE_DELAY seconds until one has the product
+LOOKUP_MODE = os.environ.get('LOOKUP_MODE', 'sequential')
+HEDGE_DELAY = float(os.environ.get('HEDGE_DELAY', 0.5))
+HEDGE_WORKERS = int(os.environ.get('HEDGE_WORKERS', 32))
+
+# Mirror health tracking: EWMA smoothing factor, consecutive failures that open a
+# mirror's circuit breaker, and seconds before an open breaker lets a probe through
+MIRROR_EWMA_ALPHA = float(os.environ.get('MIRROR_EWMA_ALPHA', 0.2))
+MIRROR_FAILURE_THRESHOLD = int(os.environ.get('MIRROR_FAILURE_THRESHOLD', 5))
+MIRROR_COOLDOWN = float(os.environ.get('MIRROR_COOLDOWN', 30))
+
+# Keep-alive sessions, one per mirror, each with its own connection pool
+OFF_POOL_SIZE = int(os.environ.get('OFF_POOL_SIZE', 16))
+OFF_RETRIES = int(os.environ.get('OFF_RETRIES', 1))
+
+# Outbound governor, per mirror: requests in flight, requests per second (0 for no
+# limit) and burst, and how many requests may queue for how many seconds. The rate
+# and burst are for the whole host when SHARED_LIMITS_PATH is set, else per worker
+OFF_MIRROR_CONCURRENCY = int(os.environ.get('OFF_MIRROR_CONCURRENCY', 16))
+OFF_MIRROR_RATE = float(os.environ.get('OFF_MIRROR_RATE', 20))
+OFF_MIRROR_BURST = int(os.environ.get('OFF_MIRROR_BURST', 40))
+OFF_QUEUE_SIZE = int(os.environ.get('OFF_QUEUE_SIZE', 64))
+OFF_QUEUE_TIMEOUT = float(os.environ.get('OFF_QUEUE_TIMEOUT', 1.0))
+# Seconds to stop calling the mirrors after a 429 or 503 without a usable
+# Retry-After, and the longest Retry-After we honour
+OFF_RETRY_AFTER_DEFAULT = float(os.environ.get('OFF_RETRY_AFTER_DEFAULT', 5))
+OFF_RETRY_AFTER_MAX = float(os.environ.get('OFF_RETRY_AFTER_MAX', 300))
+# File the workers share the mirrors' token buckets and Retry-After pauses through;
+# gunicorn.conf.py creates one, and empty keeps them per worker
+SHARED_LIMITS_PATH = os.environ.get('SHARED_LIMITS_PATH', '')
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+_sessions_pid = None
+
+# Add a Server-Timing header with per-phase durations to every /search response
+SERVER_TIMING = os.environ.get('SERVER_TIMING', '1') == '1'
+
+# Fraction of /search requests that also write their phases as a JSON line to stderr
+TIMING_LOG_SAMPLE_RATE = float(os.environ.get('TIMING_LOG_SAMPLE_RATE', 0))
+request_timing.setup_log(TIMING_LOG_SAMPLE_RATE)
+
+# JSON bodies at least this many bytes are compressed when the client accepts it
+COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))
+
+# Products the page keeps in the browser's IndexedDB for repeat and offline scans
+SCAN_HISTORY_LIMIT = int(os.environ.get('SCAN_HISTORY_LIMIT', 500))
+
+# Downloaded copies of VENDOR_ASSETS, served under /assets/ with their content hash in the name
+VENDOR_DIR = os.environ.get('VENDOR_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'vendor'))
+# A hashed name never changes content, so browsers may keep it without revalidating
+VENDOR_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+VENDOR_MIMETYPES = {'.css': 'text/css', '.js': 'text/javascript'}
+
+# /search response schemas, chosen with the schema parameter: 'full' is everything
+# we hold about the product, 'compact.v1' only what the page displays
+RESPONSE_SCHEMAS = ('full', 'compact.v1')
+SCHEMA_ALIASES = {'compact': 'compact.v1'}
+DEFAULT_RESPONSE_SCHEMA = os.environ.get('DEFAULT_RESPONSE_SCHEMA', 'full')
+COMPACT_FIELDS = ('name', 'brands', 'image_url', 'categories', 'countries', 'origin', 'labels', 'ingredients',
+                  'india_message', 'stale')
+COMPACT_NUTRIMENTS = tuple(nutrient['key'] for nutrient in nutrient_display())
+
+# Barcodes accepted by /search/batch and how many of them are looked up at once
+BATCH_MAX_BARCODES = int(os.environ.get('BATCH_MAX_BARCODES', 1000))
+BATCH_CONCURRENCY = int(os.environ.get('BATCH_CONCURRENCY', 16))
+
+_thread_pools = {}
+_thread_pools_lock = threading.Lock()
+
+# Offline product database built with `flask --app app ingest-products` (empty disables it)
+LOCAL_PRODUCTS_DB = os.environ.get('LOCAL_PRODUCTS_DB', 'products.sqlite3')
+
+# Upstream product fields that extract_product_info reads
+PRODUCT_FIELDS = (
+    'product_name', 'brands', 'image_url', 'categories', 'countries', 'origins', 'labels',
+    'ingredients_text', 'allergens_tags', 'additives_tags', 'nutriments', 'nutrition_grade_fr', 'nova_group',
+)
+UPSTREAM_FIELDS = ','.join(PRODUCT_FIELDS)
+
+# Product cache configuration (all sizes are entry counts, all ages in seconds)
+PRODUCT_CACHE_SIZE = int(os.environ.get('PRODUCT_CACHE_SIZE', 2048))
+PRODUCT_CACHE_TTL = float(os.environ.get('PRODUCT_CACHE_TTL', 6 * 3600))
+PRODUCT_CACHE_DB = os.environ.get('PRODUCT_CACHE_DB', 'product_cache.sqlite3')
+PRODUCT_CACHE_DB_SIZE = int(os.environ.get('PRODUCT_CACHE_DB_SIZE', 200000))
+PRODUCT_CACHE_DB_TTL = float(os.environ.get('PRODUCT_CACHE_DB_TTL', 7 * 24 * 3600))
+
+# Memory-mapped cache shared by all workers on the host (empty disables it;
+# gunicorn.conf.py points it at a fresh file). Slot size bounds the JSON of one product
+SHARED_CACHE_PATH = os.environ.get('SHARED_CACHE_PATH', '')
+SHARED_CACHE_SLOTS = int(os.environ.get('SHARED_CACHE_SLOTS', 8192))
+SHARED_CACHE_SLOT_SIZE = int(os.environ.get('SHARED_CACHE_SLOT_SIZE', 8192))
+
+# Past PRODUCT_CACHE_TTL a product is stale. For PRODUCT_CACHE_MAX_STALE more seconds
+# it is still served at once while a background thread refreshes it; for
+# PRODUCT_CACHE_STALE_IF_ERROR it is served when no mirror can be reached
+PRODUCT_CACHE_MAX_STALE = float(os.environ.get('PRODUCT_CACHE_MAX_STALE', 24 * 3600))
+PRODUCT_CACHE_STALE_IF_ERROR = float(os.environ.get('PRODUCT_CACHE_STALE_IF_ERROR', 7 * 24 * 3600))
+CACHE_REFRESH_WORKERS = int(os.environ.get('CACHE_REFRESH_WORKERS', 4))
+
+# Lookup counts per barcode, kept so a restarted process can prefetch the most
+# popular products; barcodes not looked up within POPULARITY_WINDOW seconds are skipped
+POPULARITY_DB = os.environ.get('POPULARITY_DB', 'product_popularity.sqlite3')
+POPULARITY_DB_SIZE = int(os.environ.get('POPULARITY_DB_SIZE', 100000))
+POPULARITY_WINDOW = float(os.environ.get('POPULARITY_WINDOW', 7 * 24 * 3600))
+POPULARITY_FLUSH_INTERVAL = float(os.environ.get('POPULARITY_FLUSH_INTERVAL', 10))
+
+# Warm-up on boot: how many of the most popular barcodes to load into the cache,
+# how many at once, and at most how many mirror fetches per second
+WARMUP_COUNT = int(os.environ.get('WARMUP_COUNT', 500))
+WARMUP_CONCURRENCY = int(os.environ.get('WARMUP_CONCURRENCY', 4))
+WARMUP_RATE = float(os.environ.get('WARMUP_RATE', 5))
+
+
+class ProductCache:
+    """Tiered cache of extracted product info keyed on the cleaned barcode.
+
+    The first tier is a bounded in-process LRU. The optional shared tier is a
+    SharedProductCache that every worker on the host reads from memory, and the
+    last an SQLite file that survives restarts and is shared the same way. An
+    entry is fresh for ttl seconds and is still returned, with its age, for
+    max_stale seconds after that; SQLite drops entries after db_ttl. Once a
+    tier is full the least recently used entry (memory), the oldest entry in
+    the slot set (shared) or the oldest entry (SQLite) is evicted. Setting a
+    size to 0 disables that tier.
+    """
+
+    def __init__(self, max_entries, ttl, db_path=None, db_max_entries=0, db_ttl=0, max_stale=0, shared=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.shared = shared
+        self.db_path = db_path if db_max_entries > 0 else None
+        self.db_max_entries = db_max_entries
+        self.db_ttl = db_ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._db = None
+        self._db_pid = None
+        self._writes_since_trim = 0
+        self.memory_hits = 0
+        self.shared_hits = 0
+        self.disk_hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, barcode):
+        """Return (product info, age in seconds) for a barcode, or (None, None) on a miss; age may exceed the TTL"""
+        now = time.time()
+        stale = None
+        with self._lock:
+            entry = self._entries.get(barcode)
+            if entry is not None:
+                fetched_at, product_info = entry
+                if now - fetched_at < self.ttl:
+                    self._entries.move_to_end(barcode)
+                    self.memory_hits += 1
+                    return product_info, now - fetched_at
+                if now - fetched_at < self.ttl + self.max_stale:
+                    stale = entry
+                else:
+                    del self._entries[barcode]
+
+        # Another worker may have refreshed the product since this one cached it
+        entry, source = self._shared_get(barcode, now), 'shared'
+        if entry is None or now - entry[0] >= self.ttl:
+            # SQLite may still have it fresh: from before this server started, or too big for a shared slot
+            disk_entry = self._db_get(barcode, now)
+            if disk_entry is not None and (entry is None or disk_entry[0] > entry[0]):
+                entry, source = disk_entry, 'disk'
+                self._shared_set(barcode, *disk_entry)
+        if entry is not None and (stale is None or entry[0] > stale[0]):
+            self._remember(barcode, *entry)
+        else:
+            entry = stale
+
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None, None
+            fetched_at, product_info = entry
+            if now - fetched_at >= self.ttl:
+                self.stale_hits += 1
+            elif source == 'shared':
+                self.shared_hits += 1
+            else:
+                self.disk_hits += 1
+        return product_info, now - fetched_at
+
+    def warm(self, barcode):
+        """Move a barcode's disk entry into memory without counting a lookup; True if memory now has it fresh
+
+        With a shared tier the entry goes there instead, where every worker finds it.
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(barcode)
+            if entry is not None and now - entry[0] < self.ttl:
+                return True
+        entry = self._shared_get(barcode, now)
+        if entry is not None and now - entry[0] < self.ttl:
+            return True
+        entry = self._db_get(barcode, now)
+        if entry is None:
+            return False
+        if not self._shared_set(barcode, *entry):
+            self._remember(barcode, *entry)
+        return now - entry[0] < self.ttl
+
+    def set(self, barcode, product_info):
+        """Store product info in every tier"""
+        fetched_at = time.time()
+        self._remember(barcode, fetched_at, product_info)
+        self._shared_set(barcode, fetched_at, product_info)
+        self._db_set(barcode, fetched_at, product_info)
+
+    def stats(self):
+        """Return hit/miss counters and tier sizes"""
+        with self._lock:
+            hits = self.memory_hits + self.shared_hits + self.disk_hits
+            lookups = hits + self.stale_hits + self.misses
+            stats = {
+                'memory_hits': self.memory_hits,
+                'shared_hits': self.shared_hits,
+                'disk_hits': self.disk_hits,
+                'stale_hits': self.stale_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': round(hits / lookups, 4) if lookups else 0.0,
+                'memory_entries': len(self._entries),
+                'memory_max_entries': self.max_entries,
+                'memory_ttl': self.ttl,
+                'max_stale': self.max_stale,
+            }
+        if self.shared is not None:
+            stats.update(self.shared.stats())
+        stats['disk_entries'] = self._db_count()
+        stats['disk_max_entries'] = self.db_max_entries if self.db_path else 0
+        stats['disk_ttl'] = self.db_ttl
+        return stats
+
+    def _shared_get(self, barcode, now):
+        if self.shared is None:
+            return None
+        entry = self.shared.get(barcode)
+        if entry is None or now - entry[0] >= self.ttl + self.max_stale:
+            return None
+        return entry[0], json.loads(entry[1])
+
+    def _shared_set(self, barcode, fetched_at, product_info):
+        if self.shared is None:
+            return False
+        return self.shared.set(barcode, fetched_at, json.dumps(product_info, separators=(',', ':')).encode())
+
+    def _remember(self, barcode, fetched_at, product_info):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[barcode] = (fetched_at, product_info)
+            self._entries.move_to_end(barcode)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def _connection(self):
+        # SQLite connections must not cross a fork, so reopen in each worker
+        if self._db is None or self._db_pid != os.getpid():
+            self._db = sqlite3.connect(self.db_path, timeout=5, check_same_thread=False)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS product_cache ('
+                'barcode TEXT PRIMARY KEY, fetched_at REAL NOT NULL, data TEXT NOT NULL)'
+            )
+            self._db.execute('CREATE INDEX IF NOT EXISTS product_cache_fetched_at ON product_cache (fetched_at)')
+            self._db.commit()
+            self._db_pid = os.getpid()
+        return self._db
+
+    def _db_get(self, barcode, now):
+        if not self.db_path:
+            return None
+        try:
+            with self._db_lock:
+                row = self._connection().execute(
+                    'SELECT fetched_at, data FROM product_cache WHERE barcode = ?', (barcode,)
+                ).fetchone()
+        except sqlite3.Error as e:
+            app.logger.warning('Product cache read failed: %s', e)
+            return None
+        if row is None or now - row[0] >= min(self.db_ttl, self.ttl + self.max_stale):
+            return None
+        return row[0], json.loads(row[1])
+
+    def _db_set(self, barcode, fetched_at, product_info):
+        if not self.db_path:
+            return
+        try:
+            with self._db_lock:
+                db = self._connection()
+                db.execute(
+                    'INSERT OR REPLACE INTO product_cache (barcode, fetched_at, data) VALUES (?, ?, ?)',
+                    (barcode, fetched_at, json.dumps(product_info))
+                )
+                self._writes_since_trim += 1
+                # Trimming needs an index scan, so only do it every so often
+                if self._writes_since_trim >= 100:
+                    self._writes_since_trim = 0
+                    db.execute('DELETE FROM product_cache WHERE fetched_at < ?', (fetched_at - self.db_ttl,))
+                    db.execute(
+                        'DELETE FROM product_cache WHERE barcode IN ('
+                        'SELECT barcode FROM product_cache ORDER BY fetched_at DESC LIMIT -1 OFFSET ?)',
+                        (self.db_max_entries,)
+                    )
+                db.commit()
+        except sqlite3.Error as e:
+            app.logger.warning('Product cache write failed: %s', e)
+
+    def _db_count(self):
+        if not self.db_path:
+            return 0
+        try:
+            with self._db_lock:
+                return self._connection().execute('SELECT COUNT(*) FROM product_cache').fetchone()[0]
+        except sqlite3.Error:
+            return 0
+
+
+def open_shared_cache(path):
+    """The SharedProductCache at path, or None when it is disabled or cannot be opened"""
+    if not path:
+        return None
+    # Imported here because it needs fcntl, so the app still runs where there is none
+    from shared_cache import SharedProductCache
+    try:
+        return SharedProductCache(path, SHARED_CACHE_SLOTS, SHARED_CACHE_SLOT_SIZE)
+    except (OSError, ValueError) as e:
+        app.logger.warning('Shared product cache disabled: %s', e)
+        return None
+
+
+product_cache = ProductCache(
+    PRODUCT_CACHE_SIZE,
+    PRODUCT_CACHE_TTL,
+    db_path=PRODUCT_CACHE_DB,
+    db_max_entries=PRODUCT_CACHE_DB_SIZE if PRODUCT_CACHE_DB else 0,
+    db_ttl=PRODUCT_CACHE_DB_TTL,
+    max_stale=max(PRODUCT_CACHE_MAX_STALE, PRODUCT_CACHE_STALE_IF_ERROR),
+    shared=open_shared_cache(SHARED_CACHE_PATH),
+)
+
+
+class UpstreamUnavailable(Exception):
+    """No mirror could say whether a product exists: each one failed, timed out or was skipped"""
+
+
+class LookupTimedOut(UpstreamUnavailable):
+    """The lookup's deadline passed before any mirror could say whether the product exists"""
+
+
+class LocalProductStore:
+    """Read-only view of the offline product database, keyed by barcode
+
+    Each thread queries through its own connection. A thread looks at the file
+    again at most every STAT_INTERVAL seconds, and reopens it if ingest has
+    swapped in a new one.
+    """
+
+    STAT_INTERVAL = 2.0
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, barcode):
+        """Return the stored raw product fields for a barcode, or None"""
+        if not self.db_path:
+            return None
+        try:
+            db = self._connection()
+            if db is None:
+                return None
+            row = db.execute('SELECT data FROM products WHERE barcode = ?', (barcode,)).fetchone()
+        except (sqlite3.Error, OSError) as e:
+            # OSError too: the file can be replaced or removed between any two looks at it
+            app.logger.warning('Local product lookup failed: %s', e)
+            self._local.pid = None
+            return None
+        with self._lock:
+            if row is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return None if row is None else json.loads(row[0])
+
+    def stats(self):
+        """Return hit/miss counters"""
+        return {'hits': self.hits, 'misses': self.misses, 'path': self.db_path or None}
+
+    def _connection(self):
+        """This thread's connection, or None while there is no database file"""
+        local = self._local
+        pid = os.getpid()
+        now = time.monotonic()
+        if getattr(local, 'pid', None) == pid and now - local.checked_at < self.STAT_INTERVAL:
+            return local.db
+        try:
+            inode = os.stat(self.db_path).st_ino
+        except FileNotFoundError:
+            inode = None
+        # Reopen after a fork or an error, and whenever ingest has swapped in a new file
+        if getattr(local, 'pid', None) != pid or local.inode != inode:
+            if getattr(local, 'pid', None) == pid and local.db is not None:
+                local.db.close()
+            local.db = None
+            if inode is not None:
+                local.db = sqlite3.connect(f'file:{self.db_path}?mode=ro', uri=True)
+            local.pid = pid
+            local.inode = inode
+        local.checked_at = now
+        return local.db
+
+
+local_products = LocalProductStore(LOCAL_PRODUCTS_DB)
+
+
+class SingleFlight:
+    """Coalesce concurrent calls per key: the first caller runs the call, the others wait for its outcome"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    def do(self, key, fn, *args, timeout=None):
+        """Run fn(*args) unless a call for key is already in flight, sharing its result or exception
+
+        A caller that joins a call in flight waits at most timeout seconds for it,
+        then gets TimeoutError while the call carries on for the others.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = Future()
+                self.leaders += 1
+                leader = True
+            else:
+                self.coalesced += 1
+                leader = False
+        if not leader:
+            return call.result(timeout)
+
+        try:
+            result = fn(*args)
+        except BaseException as e:
+            call.set_exception(e)
+            raise
+        else:
+            call.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+    def stats(self):
+        """Return how many calls ran and how many piggybacked on one already in flight"""
+        with self._lock:
+            return {'upstream_fetches': self.leaders, 'coalesced_requests': self.coalesced, 'in_flight': len(self._calls)}
+
+
+upstream_flights = SingleFlight()
+
+
+class PopularityTracker:
+    """Lookup counts per barcode, kept in SQLite so they outlive the process.
+
+    record() only bumps an in-memory counter; a background thread adds the
+    counts to the database every flush_interval seconds, so the request path
+    never waits on a write. Every worker on the host adds to the same file. The
+    table keeps the max_entries most looked-up barcodes.
+    """
+
+    def __init__(self, db_path, max_entries, flush_interval):
+        self.db_path = db_path if max_entries > 0 else None
+        self.max_entries = max_entries
+        self.flush_interval = flush_interval
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._db = None
+        self._db_pid = None
+        self._flusher_pid = None
+        self._flushes_since_trim = 0
+        self.recorded = 0
+        self.flushed = 0
+
+    def record(self, barcode):
+        """Count one lookup of a barcode"""
+        if not self.db_path:
+            return
+        with self._lock:
+            self._pending[barcode] = self._pending.get(barcode, 0) + 1
+            self.recorded += 1
+            # Threads do not survive a fork, so each worker starts its own flusher
+            if self._flusher_pid != os.getpid():
+                self._flusher_pid = os.getpid()
+                threading.Thread(target=self._flush_periodically, name='popularity-flush', daemon=True).start()
+
+    def top(self, count, window):
+        """The count most looked-up barcodes among those looked up in the last window seconds"""
+        if not self.db_path or count <= 0:
+            return []
+        try:
+            with self._db_lock:
+                rows = self._connection().execute(
+                    'SELECT barcode FROM popularity WHERE last_seen >= ? ORDER BY hits DESC LIMIT ?',
+                    (time.time() - window, count)
+                ).fetchall()
+        except sqlite3.Error as e:
+            app.logger.warning('Popularity read failed: %s', e)
+            return []
+        return [row[0] for row in rows]
+
+    def flush(self):
+        """Add the counts recorded since the last flush to the database"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        now = time.time()
+        try:
+            with self._db_lock:
+                db = self._connection()
+                db.executemany(
+                    'INSERT INTO popularity (barcode, hits, last_seen) VALUES (?, ?, ?) '
+                    'ON CONFLICT (barcode) DO UPDATE SET hits = hits + excluded.hits, last_seen = excluded.last_seen',
+                    [(barcode, hits, now) for barcode, hits in pending.items()]
+                )
+                self._flushes_since_trim += 1
+                # Trimming sorts the whole table, so only do it every so often
+                if self._flushes_since_trim >= 60:
+                    self._flushes_since_trim = 0
+                    db.execute(
+                        'DELETE FROM popularity WHERE barcode IN ('
+                        'SELECT barcode FROM popularity ORDER BY hits DESC, last_seen DESC LIMIT -1 OFFSET ?)',
+                        (self.max_entries,)
+                    )
+                db.commit()
+            with self._lock:
+                self.flushed += sum(pending.values())
+        except sqlite3.Error as e:
+            app.logger.warning('Popularity write failed: %s', e)
+
+    def stats(self):
+        """Return counters and the number of barcodes tracked"""
+        with self._lock:
+            stats = {'recorded': self.recorded, 'flushed': self.flushed, 'pending': sum(self._pending.values())}
+        stats['barcodes'] = self._count()
+        stats['path'] = self.db_path
+        return stats
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def _connection(self):
+        # SQLite connections must not cross a fork, so reopen in each worker
+        if self._db is None or self._db_pid != os.getpid():
+            self._db = sqlite3.connect(self.db_path, timeout=5, check_same_thread=False)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS popularity ('
+                'barcode TEXT PRIMARY KEY, hits INTEGER NOT NULL, last_seen REAL NOT NULL)'
+            )
+            self._db.execute('CREATE INDEX IF NOT EXISTS popularity_hits ON popularity (hits)')
+            self._db.commit()
+            self._db_pid = os.getpid()
+        return self._db
+
+    def _count(self):
+        if not self.db_path:
+            return 0
+        try:
+            with self._db_lock:
+                return self._connection().execute('SELECT COUNT(*) FROM popularity').fetchone()[0]
+        except sqlite3.Error:
+            return 0
+
+
+popularity = PopularityTracker(POPULARITY_DB, POPULARITY_DB_SIZE if POPULARITY_DB else 0, POPULARITY_FLUSH_INTERVAL)
+atexit.register(popularity.flush)
+
+
+class RateLimiter:
+    """Space calls out to at most rate per second across threads; a rate of 0 means no limit"""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate > 0 else 0
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """Block until the next call is allowed"""
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next)
+            self._next = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class CacheWarmer:
+    """Load the most popular products into the cache in the background after a restart.
+
+    Runs once per process, while it already serves requests. Products on disk
+    are moved into the memory tier. The rest are fetched from the mirrors, at
+    most concurrency at a time and rate per second. When the disk tier is shared,
+    only one worker on the host fetches, holding a lock file next to the
+    popularity database. The others wait for it to finish, then load its
+    results from disk.
+    """
+
+    def __init__(self, count, concurrency, rate):
+        self.count = count
+        self.concurrency = max(1, concurrency)
+        self.limiter = RateLimiter(rate)
+        self._lock = threading.Lock()
+        self._pid = None
+        self._reset('disabled' if count <= 0 or not popularity.db_path else 'not_started')
+
+    def start(self):
+        """Start warming in a background thread, once per process"""
+        with self._lock:
+            if self.state == 'disabled' or self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._reset('warming')
+        threading.Thread(target=self._run, name='cache-warmup', daemon=True).start()
+
+    def progress(self):
+        """Return the warm-up state and how many products it has handled so far"""
+        with self._lock:
+            progress = dict(self._progress)
+        progress['state'] = self.state
+        progress['role'] = self.role
+        progress['ready'] = self.state != 'warming'
+        progress['remaining'] = progress['total'] - progress['cached'] - progress['fetched'] - progress['not_found'] \
+            - progress['failed'] - progress['skipped']
+        if self.started_at is not None:
+            progress['elapsed'] = round((self.finished_at or time.time()) - self.started_at, 3)
+        return progress
+
+    def _reset(self, state):
+        self.state = state
+        self.role = None
+        self.started_at = time.time() if state == 'warming' else None
+        self.finished_at = None
+        self._progress = dict.fromkeys(('total', 'cached', 'fetched', 'not_found', 'failed', 'skipped'), 0)
+
+    def _count(self, outcome, products=1):
+        with self._lock:
+            self._progress[outcome] += products
+        metrics.warmup_products.labels(outcome).inc(products)
+
+    def _run(self):
+        try:
+            # Warming more products than the tier they go to holds would only evict the first ones
+            capacity = product_cache.shared.slots if product_cache.shared is not None else product_cache.max_entries
+            count = min(self.count, capacity) if capacity > 0 else self.count
+            barcodes = popularity.top(count, POPULARITY_WINDOW)
+            with self._lock:
+                self._progress['total'] = len(barcodes)
+            missing = [barcode for barcode in barcodes if not self._load(barcode)]
+            if missing:
+                self._fetch_or_wait(missing)
+        except Exception:
+            app.logger.exception('Cache warm-up failed')
+        finally:
+            with self._lock:
+                self.state = 'done'
+                self.finished_at = time.time()
+
+    def _load(self, barcode):
+        if product_cache.warm(barcode):
+            self._count('cached')
+            return True
+        return False
+
+    def _fetch_or_wait(self, barcodes):
+        if not product_cache.db_path and product_cache.shared is None:
+            # Nothing is shared between workers, so each one fetches for itself
+            self.role = 'fetcher'
+            self._fetch_all(barcodes)
+            return
+        import fcntl
+        with open(popularity.db_path + '.warmup.lock', 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                self.role = 'fetcher'
+            except BlockingIOError:
+                # Another worker is fetching; once it lets go, its products are cached where this one can read them
+                self.role = 'follower'
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                if self.role == 'fetcher':
+                    self._fetch_all(barcodes)
+                else:
+                    missing = [barcode for barcode in barcodes if not self._load(barcode)]
+                    self._count('skipped', len(missing))
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _fetch_all(self, barcodes):
+        executor = ThreadPoolExecutor(self.concurrency, thread_name_prefix='cache-warmup')
+        try:
+            for outcome in executor.map(self._fetch, barcodes):
+                self._count(outcome)
+        finally:
+            executor.shutdown(wait=False)
+
+    def _fetch(self, barcode):
+        # Another worker or a request may have fetched it since the first pass
+        if product_cache.warm(barcode):
+            return 'cached'
+        self.limiter.wait()
+        try:
+            product_info = upstream_flights.do(barcode, fetch_into_cache, barcode)
+        except Exception as e:
+            app.logger.warning('Warm-up fetch failed for %s: %s', barcode, e)
+            return 'failed'
+        return 'fetched' if product_info is not None else 'not_found'
+
+
+cache_warmer = CacheWarmer(WARMUP_COUNT, WARMUP_CONCURRENCY, WARMUP_RATE)
+
+
+def project_product(product_data):
+    """Keep only the fields we serve, dropping empty values and nutriments other than per-100g"""
+    projected = {}
+    for field in PRODUCT_FIELDS:
+        value = product_data.get(field)
+        if value in (None, '', [], {}):
+            continue
+        if field == 'nutriments':
+            value = {key: amount for key, amount in value.items() if key.endswith('_100g')}
+        projected[field] = value
+    return projected
+
+
+def iter_dump_products(path):
+    """Yield (barcode, raw product fields) from an Open Food Facts JSONL or CSV export, one row at a time"""
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', encoding='utf-8', newline='') as dump:
+        if '.csv' in os.path.basename(path):
+            csv.field_size_limit(sys.maxsize)
+            for row in csv.DictReader(dump, delimiter='\t', quoting=csv.QUOTE_NONE):
+                barcode = clean_barcode(row.get('code') or '')
+                if barcode:
+                    yield barcode, project_product(_csv_row_to_product(row))
+        else:
+            for line in dump:
+                try:
+                    product_data = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                barcode = clean_barcode(str(product_data.get('code') or ''))
+                if barcode:
+                    yield barcode, project_product(product_data)
+
+
+def _csv_row_to_product(row):
+    # The CSV export flattens nutriments into *_100g columns and tag lists into comma-separated strings
+    product_data = {field: row.get(field) for field in PRODUCT_FIELDS if field in row}
+    product_data['allergens_tags'] = _split_tags(row.get('allergens_tags') or row.get('allergens'))
+    product_data['additives_tags'] = _split_tags(row.get('additives_tags'))
+    product_data['nutrition_grade_fr'] = row.get('nutrition_grade_fr') or row.get('nutriscore_grade')
+    nutriments = {}
+    for column, value in row.items():
+        if column and column.endswith('_100g') and value:
+            try:
+                nutriments[column] = float(value)
+            except ValueError:
+                pass
+    product_data['nutriments'] = nutriments
+    return product_data
+
+
+def _split_tags(value):
+    return [tag for tag in (value or '').split(',') if tag]
+
+
+@app.cli.command('ingest-products')
+@click.argument('dump_path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--db', 'db_path', default=LOCAL_PRODUCTS_DB, show_default=True, help='SQLite file to build.')
+@click.option('--batch-size', default=10000, show_default=True, help='Rows per bulk insert.')
+def ingest_products(dump_path, db_path, batch_size):
+    """Build the offline product database from an Open Food Facts JSONL or CSV export"""
+    # Build into a scratch file and swap it in at the end so running workers never see a partial store
+    tmp_path = db_path + '.ingest'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    db = sqlite3.connect(tmp_path)
+    db.execute('PRAGMA journal_mode=OFF')
+    db.execute('PRAGMA synchronous=OFF')
+    db.execute('CREATE TABLE products (barcode TEXT PRIMARY KEY, data TEXT NOT NULL) WITHOUT ROWID')
+    
+    started = time.time()
+    total = 0
+    batch = []
+    for barcode, product_data in iter_dump_products(dump_path):
+        batch.append((barcode, json.dumps(product_data, separators=(',', ':'))))
+        if len(batch) >= batch_size:
+            db.executemany('INSERT OR REPLACE INTO products (barcode, data) VALUES (?, ?)', batch)
+            total += len(batch)
+            batch = []
+            click.echo(f'{total} products ({total / (time.time() - started):.0f}/s)')
+    if batch:
+        db.executemany('INSERT OR REPLACE INTO products (barcode, data) VALUES (?, ?)', batch)
+        total += len(batch)
+    db.commit()
+    db.close()
+    os.replace(tmp_path, db_path)
+    click.echo(f'Ingested {total} products into {db_path} in {time.time() - started:.1f}s')
+
+
+@app.cli.command('fetch-vendor-assets')
+@click.option('--directory', default=VENDOR_DIR, show_default=True, help='Where to save the files.')
+def fetch_vendor_assets(directory):
+    """Download the page's Bootstrap and Quagga files so the app serves them itself
+
+    A download that does not match its sha256 in VENDOR_ASSETS is refused, as
+    is one with no sha256 there; its digest is printed so it can be checked
+    against the published package and pinned.
+    """
+    os.makedirs(directory, exist_ok=True)
+    refused = []
+    with requests.Session() as session:
+        for key, asset in VENDOR_ASSETS.items():
+            source = asset['url']
+            try:
+                response = session.get(source, timeout=30)
+                response.raise_for_status()
+            except requests.RequestException as e:
+                raise click.ClickException(f'Could not download {source}: {e}')
+            digest = hashlib.sha256(response.content).hexdigest()
+            if digest != asset['sha256']:
+                expected = asset['sha256'] or 'none pinned'
+                click.echo(f'Refusing {source}: sha256 {digest}, expected {expected}', err=True)
+                refused.append(key)
+                continue
+            path = os.path.join(directory, vendor_filename(source))
+            # Replaced whole, so a worker starting meanwhile never reads half a file
+            with open(path + '.download', 'wb') as vendor_file:
+                vendor_file.write(response.content)
+            os.replace(path + '.download', path)
+            click.echo(f'{path}: {len(response.content)} bytes')
+    if refused:
+        raise click.ClickException(f'Not saved: {", ".join(refused)}; the page loads them from the CDN')
+    click.echo('Restart the app to serve them')
+
+
+@app.cli.command('score-catalog')
+@click.argument('dump_path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--output', type=click.File('w'), default='-', help='JSONL file for the scores (default stdout).')
+@click.option('--chunk-size', default=50000, show_default=True, help='Products scored per vectorized pass.')
+@click.option('--verify', is_flag=True, help='Check every score against assess_health/get_age_recommendations.')
+def score_catalog(dump_path, output, chunk_size, verify):
+    """Score every product in an Open Food Facts JSONL or CSV export in streamed chunks"""
+    from bulk_scoring import score_products, TagTermCounter
+    
+    tag_counter = TagTermCounter()
+    started = time.time()
+    total = 0
+    
+    def flush(barcodes, product_infos):
+        scores = score_products(product_infos, tag_counter)
+        for barcode, product_info, (health_assessment, age_recommendations) in zip(barcodes, product_infos, scores):
+            if verify and (health_assessment != assess_health(product_info)
+                           or age_recommendations != get_age_recommendations(product_info)):
+                raise click.ClickException(f'Batch score for {barcode} differs from the per-product functions')
+            output.write(json.dumps({
+                'barcode': barcode,
+                'health_assessment': health_assessment,
+                'age_recommendations': age_recommendations,
+            }) + '\n')
+    
+    barcodes, product_infos = [], []
+    for barcode, product_data in iter_dump_products(dump_path):
+        barcodes.append(barcode)
+        product_infos.append(extract_product_info(product_data, 'local'))
+        if len(product_infos) >= chunk_size:
+            flush(barcodes, product_infos)
+            total += len(product_infos)
+            barcodes, product_infos = [], []
+            click.echo(f'{total} products ({total / (time.time() - started):.0f}/s)', err=True)
+    if product_infos:
+        flush(barcodes, product_infos)
+        total += len(product_infos)
+    elapsed = time.time() - started
+    click.echo(f'Scored {total} products in {elapsed:.1f}s ({total / elapsed if elapsed else 0:.0f} products/s)', err=True)
+
+
+class MirrorHealth:
+    """Rolling health of one mirror plus its circuit breaker.
+
+    Latency, error rate and not-found rate are exponentially weighted moving
+    averages. After MIRROR_FAILURE_THRESHOLD consecutive errors the breaker
+    opens and the mirror is skipped; once MIRROR_COOLDOWN has passed a single
+    half-open probe is let through, which closes the breaker on success and
+    reopens it on failure. The last MIRROR_LATENCY_WINDOW latencies set the
+    mirror's request timeout.
+    """
+
+    def __init__(self, name, priority):
+        self.name = name
+        self.priority = priority
+        # Start from a pessimistic guess so measured mirrors win over unknown ones
+        self.latency = OFF_TIMEOUT / 4
+        self.latencies = deque(maxlen=MIRROR_LATENCY_WINDOW)
+        self.timeout = OFF_TIMEOUT
+        self.error_rate = 0.0
+        self.not_found_rate = 0.0
+        self.requests = 0
+        self.bytes_received = 0
+        self.last_request_at = 0.0
+        self.consecutive_failures = 0
+        self.state = 'closed'
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def available(self, now=None):
+        """Whether the mirror may be ranked for a lookup right now"""
+        now = time.time() if now is None else now
+        with self._lock:
+            if self.state == 'open':
+                return now - self.opened_at >= MIRROR_COOLDOWN
+            if self.state == 'half_open':
+                return not self.probe_in_flight
+            return True
+
+    def acquire(self):
+        """Claim permission for one request, turning an expired open breaker into a probe"""
+        with self._lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open' and time.time() - self.opened_at >= MIRROR_COOLDOWN:
+                self.state = 'half_open'
+            if self.state == 'half_open' and not self.probe_in_flight:
+                self.probe_in_flight = True
+                return True
+            return False
+
+    def release(self):
+        """Give back a claimed request that was abandoned without an outcome"""
+        with self._lock:
+            self.probe_in_flight = False
+
+    def record(self, outcome, latency, size=0):
+        """Record the outcome ('found', 'not_found' or 'error'), latency and body size of one request"""
+        alpha = MIRROR_EWMA_ALPHA
+        with self._lock:
+            self.requests += 1
+            self.bytes_received += size
+            self.last_request_at = time.time()
+            self.latency += alpha * (latency - self.latency)
+            self.latencies.append(latency)
+            if len(self.latencies) >= MIRROR_TIMEOUT_MIN_SAMPLES:
+                # Timeouts are recorded too, so a mirror that slows down sees its timeout grow with it
+                ordered = sorted(self.latencies)
+                percentile = ordered[min(len(ordered) - 1, int(MIRROR_TIMEOUT_PERCENTILE * len(ordered)))]
+                self.timeout = min(OFF_TIMEOUT, max(MIRROR_TIMEOUT_MIN, percentile * MIRROR_TIMEOUT_MULTIPLIER))
+            self.error_rate += alpha * ((outcome == 'error') - self.error_rate)
+            self.not_found_rate += alpha * ((outcome == 'not_found') - self.not_found_rate)
+            self.probe_in_flight = False
+            if outcome == 'error':
+                self.consecutive_failures += 1
+                if self.state == 'half_open' or self.consecutive_failures >= MIRROR_FAILURE_THRESHOLD:
+                    self.state = 'open'
+                    self.opened_at = time.time()
+            else:
+                self.consecutive_failures = 0
+                self.state = 'closed'
+
+    def score(self):
+        """Expected seconds to a useful answer; lower ranks first"""
+        with self._lock:
+            # Penalties fade while a mirror sits idle, so a demoted mirror eventually gets retried
+            decay = 0.5 ** ((time.time() - self.last_request_at) / MIRROR_COOLDOWN)
+            # Errors tend to cost a full timeout, and a mirror that rarely has the product is worth less
+            cost = self.latency + self.error_rate * decay * self.timeout
+            return cost / max(1.0 - self.not_found_rate * decay, 0.1)
+
+    def snapshot(self):
+        """Return the current numbers for the admin endpoint"""
+        score = self.score()
+        with self._lock:
+            return {
+                'mirror': self.name,
+                'score': round(score, 4),
+                'latency': round(self.latency, 4),
+                'timeout': round(self.timeout, 4),
+                'error_rate': round(self.error_rate, 4),
+                'not_found_rate': round(self.not_found_rate, 4),
+                'requests': self.requests,
+                'bytes_received': self.bytes_received,
+                'consecutive_failures': self.consecutive_failures,
+                'state': self.state,
+            }
+
+
+mirror_health = {mirror: MirrorHealth(mirror, priority) for priority, mirror in enumerate(OFF_MIRRORS)}
+
+
+class MirrorGovernor:
+    """Admission control for requests to one mirror.
+
+    At most max_in_flight requests run at once, and a token bucket holds them
+    to rate per second with bursts of up to burst. A request that cannot start
+    joins a queue of at most max_waiting until its deadline. It is shed at once
+    if the queue is full, if the bucket cannot refill before the deadline, or if
+    the mirror is throttled. After a 429 or 503 the mirror takes no requests
+    until the Retry-After has passed. Threads and asyncio tasks can wait side by
+    side. In-flight and queue limits apply per worker process; with shared
+    limits (a SharedMirrorLimits and this mirror's index in it) the token bucket
+    and the pause are those of the whole host.
+    """
+
+    def __init__(self, name, max_in_flight, rate, burst, max_waiting, shared=None, index=0):
+        self.name = name
+        self.shared = shared
+        self.index = index
+        self.max_in_flight = max(1, max_in_flight)
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.max_waiting = max_waiting
+        self.tokens = float(self.burst)
+        self.refilled_at = time.monotonic()
+        self.throttled_until = 0.0
+        self.in_flight = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.shed = dict.fromkeys(('throttled', 'queue_full', 'queue_timeout'), 0)
+        self._cond = threading.Condition()
+        self._async_waiters = deque()
+
+    def acquire(self, deadline):
+        """Wait for a turn until deadline (a time.monotonic() value); None once admitted, else why it was shed"""
+        with self._cond:
+            now = time.monotonic()
+            wait = self._try_start(now)
+            if wait == 0:
+                return None
+            reason = self._enqueue(now, wait, deadline)
+            if reason:
+                return reason
+            try:
+                while True:
+                    self._cond.wait(min(wait, deadline - now))
+                    now = time.monotonic()
+                    wait = self._try_start(now)
+                    if wait == 0:
+                        return None
+                    reason = self._give_up(now, wait, deadline)
+                    if reason:
+                        return reason
+            finally:
+                self.waiting -= 1
+
+    async def acquire_async(self, deadline):
+        """acquire() for asyncio tasks: waits without blocking the event loop"""
+        loop = asyncio.get_running_loop()
+        with self._cond:
+            now = time.monotonic()
+            wait = self._try_start(now)
+            if wait == 0:
+                return None
+            reason = self._enqueue(now, wait, deadline)
+            if reason:
+                return reason
+        try:
+            while True:
+                waiter = loop.create_future()
+                with self._cond:
+                    self._async_waiters.append((loop, waiter))
+                try:
+                    await asyncio.wait_for(waiter, min(wait, deadline - now))
+                except asyncio.TimeoutError:
+                    pass
+                with self._cond:
+                    now = time.monotonic()
+                    wait = self._try_start(now)
+                    if wait == 0:
+                        return None
+                    reason = self._give_up(now, wait, deadline)
+                    if reason:
+                        return reason
+        finally:
+            with self._cond:
+                self.waiting -= 1
+
+    def release(self):
+        """Hand back the turn of a finished request and wake one waiter"""
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify()
+            while self._async_waiters:
+                loop, waiter = self._async_waiters.popleft()
+                if not waiter.done():
+                    loop.call_soon_threadsafe(_wake_waiter, waiter)
+                    break
+
+    def throttle(self, seconds):
+        """Take no requests for the next seconds, as a Retry-After asks"""
+        with self._cond:
+            until = time.monotonic() + seconds
+            self.throttled_until = max(self.throttled_until, until)
+            if self.shared is not None:
+                self.shared.throttle(self.index, until)
+
+    def throttled_for(self, now=None):
+        """Seconds until the mirror takes requests again after a 429 or 503, or 0"""
+        now = time.monotonic() if now is None else now
+        return max(0.0, self._throttled_until() - now)
+
+    def snapshot(self):
+        """Return the current numbers for the admin endpoint"""
+        with self._cond:
+            now = time.monotonic()
+            if self.rate <= 0:
+                tokens = None
+            elif self.shared is not None:
+                tokens = self.shared.tokens(self.index, self.rate, self.burst, now)
+            else:
+                tokens = min(self.burst, self.tokens + (now - self.refilled_at) * self.rate)
+            return {
+                'mirror': self.name,
+                'in_flight': self.in_flight,
+                'max_in_flight': self.max_in_flight,
+                'waiting': self.waiting,
+                'max_waiting': self.max_waiting,
+                'rate': self.rate,
+                'tokens': round(tokens, 2) if tokens is not None else None,
+                'throttled_for': round(self.throttled_for(now), 3),
+                'shared': self.shared is not None,
+                'admitted': self.admitted,
+                'shed': dict(self.shed),
+            }
+
+    def _try_start(self, now):
+        # Returns 0 once the request has a slot and a token, else how long until it might
+        throttled_until = self._throttled_until()
+        if now < throttled_until:
+            return throttled_until - now
+        if self.in_flight >= self.max_in_flight:
+            # Only a release frees a slot, and it wakes a waiter
+            return math.inf
+        if self.rate > 0:
+            wait = self._take_token(now)
+            if wait:
+                return wait
+        self.in_flight += 1
+        self.admitted += 1
+        return 0
+
+    def _take_token(self, now):
+        # 0 once a token is taken, else how long until one is due
+        if self.shared is not None:
+            return self.shared.take_token(self.index, self.rate, self.burst, now)
+        self.tokens = min(self.burst, self.tokens + (now - self.refilled_at) * self.rate)
+        self.refilled_at = now
+        if self.tokens < 1:
+            return (1 - self.tokens) / self.rate
+        self.tokens -= 1
+        return 0
+
+    def _throttled_until(self):
+        if self.shared is None:
+            return self.throttled_until
+        # Another worker may have been told to back off
+        return max(self.throttled_until, self.shared.throttled_until(self.index))
+
+    def _enqueue(self, now, wait, deadline):
+        reason = self._give_up(now, wait, deadline)
+        if reason:
+            return reason
+        if self.waiting >= self.max_waiting:
+            return self._shed('queue_full')
+        self.waiting += 1
+        return None
+
+    def _give_up(self, now, wait, deadline):
+        # Shed rather than wait for a turn that cannot come before the deadline
+        if now < self._throttled_until():
+            return self._shed('throttled')
+        if now >= deadline or (wait != math.inf and now + wait > deadline):
+            return self._shed('queue_timeout')
+        return None
+
+    def _shed(self, reason):
+        self.shed[reason] += 1
+        metrics.upstream_shed.labels(self.name, reason).inc()
+        return reason
+
+
+def _wake_waiter(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+def open_shared_limits(path):
+    """The SharedMirrorLimits at path, or None when they are disabled or cannot be opened"""
+    if not path:
+        return None
+    # Imported here because it needs fcntl, so the app still runs where there is none
+    from shared_limits import SharedMirrorLimits
+    try:
+        return SharedMirrorLimits(path, OFF_MIRRORS)
+    except (OSError, ValueError) as e:
+        app.logger.warning('Shared mirror limits disabled, limiting per worker: %s', e)
+        return None
+
+
+shared_limits = open_shared_limits(SHARED_LIMITS_PATH)
+mirror_governors = {
+    mirror: MirrorGovernor(
+        mirror, OFF_MIRROR_CONCURRENCY, OFF_MIRROR_RATE, OFF_MIRROR_BURST, OFF_QUEUE_SIZE,
+        shared=shared_limits, index=index,
+    )
+    for index, mirror in enumerate(OFF_MIRRORS)
+}
+
+
+def throttle_upstream(retry_after):
+    """Pause every mirror after a 429 or 503; they are one service, so the others would refuse us too"""
+    seconds = OFF_RETRY_AFTER_DEFAULT
+    if retry_after:
+        try:
+            seconds = float(retry_after)
+        except ValueError:
+            try:
+                seconds = parsedate_to_datetime(retry_after).timestamp() - time.time()
+            except (TypeError, ValueError):
+                pass
+    seconds = min(max(seconds, 0.0), OFF_RETRY_AFTER_MAX)
+    for governor in mirror_governors.values():
+        governor.throttle(seconds)
+    return seconds
+
+
+def upstream_retry_after():
+    """Whole seconds until a throttled upstream takes requests again, or None if it is not throttled"""
+    now = time.monotonic()
+    waits = [governor.throttled_for(now) for governor in mirror_governors.values()]
+    return math.ceil(min(waits)) if waits and min(waits) > 0 else None
+
+
+def mirror_report():
+    """The current ranking and every mirror's health snapshot, best ranked first"""
+    ranking = ranked_mirrors()
+    mirrors = sorted(
+        (health.snapshot() for health in mirror_health.values()),
+        key=lambda mirror: ranking.index(mirror['mirror']) if mirror['mirror'] in ranking else len(ranking)
+    )
+    return {'ranking': ranking, 'mirrors': mirrors}
+
+
+def ranked_mirrors():
+    """Return the mirrors whose breakers allow traffic and that are not throttled, best score first"""
+    now = time.time()
+    candidates = [
+        health for health in mirror_health.values()
+        if health.available(now) and not mirror_governors[health.name].throttled_for()
+    ]
+    candidates.sort(key=lambda health: (health.score(), health.priority))
+    return [health.name for health in candidates]
+
+
+class PrecompressedAsset:
+    """An in-memory response body with its gzip/brotli variants and strong ETags built once"""
+
+    def __init__(self, body, mimetype, cache_control):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        self.mimetype = mimetype
+        self.cache_control = cache_control
+        digest = hashlib.sha256(body).hexdigest()[:32]
+        # Each encoding is a different representation, so each gets its own strong ETag
+        self.variants = {None: (body, digest)}
+        self.variants['gzip'] = (gzip.compress(body, 9, mtime=0), digest + '-gz')
+        if brotli is not None:
+            self.variants['br'] = (brotli.compress(body, quality=11), digest + '-br')
+
+    def select(self, accepts):
+        """Pick the smallest variant the client accepts, given a function returning encoding quality"""
+        for encoding in ('br', 'gzip'):
+            if encoding in self.variants and accepts(encoding):
+                return encoding, self.variants[encoding]
+        return None, self.variants[None]
+
+
+def serve_asset(asset):
+    """Serve a precompressed asset, answering 304 when the client already holds it"""
+    encoding, (body, etag) = asset.select(lambda encoding: request.accept_encodings[encoding] > 0)
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(body, mimetype=asset.mimetype)
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = asset.cache_control
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def compress_response(response, accepts):
+    """Compress a buffered JSON response in place when it is large enough to be worth it"""
+    if (response.direct_passthrough or response.is_streamed or response.status_code != 200
+            or response.mimetype != 'application/json' or 'Content-Encoding' in response.headers):
+        return response
+    body = response.get_data()
+    if len(body) < COMPRESS_MIN_SIZE:
+        return response
+    if brotli is not None and accepts('br'):
+        # Low quality levels keep per-response CPU close to gzip's
+        response.set_data(brotli.compress(body, quality=4))
+        response.headers['Content-Encoding'] = 'br'
+        suffix = '-br'
+    elif accepts('gzip'):
+        response.set_data(gzip.compress(body, 5, mtime=0))
+        response.headers['Content-Encoding'] = 'gzip'
+        suffix = '-gz'
+    else:
+        return response
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        # The compressed body is a different representation, so it gets its own strong ETag
+        response.set_etag(etag + suffix)
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def etag_matches(if_none_match, etag):
+    """The variant of etag (plain, -gz or -br) that an If-None-Match header names, or None"""
+    for candidate in (etag, etag + '-gz', etag + '-br'):
+        if if_none_match.contains(candidate):
+            return candidate
+    return None
+
+
+def vendor_filename(source):
+    return source.rsplit('/', 1)[1]
+
+
+def load_vendor_assets(directory):
+    """The URL the page loads each of VENDOR_ASSETS from, and the files served under /assets/ by name
+
+    A file found in directory that matches its sha256 is served under a name
+    carrying that digest; one that is missing or does not match is loaded from
+    its CDN URL instead.
+    """
+    urls, assets = {}, {}
+    for key, asset in VENDOR_ASSETS.items():
+        urls[key] = asset['url']
+        filename = vendor_filename(asset['url'])
+        try:
+            with open(os.path.join(directory, filename), 'rb') as vendor_file:
+                body = vendor_file.read()
+        except FileNotFoundError:
+            continue
+        digest = hashlib.sha256(body).hexdigest()
+        if digest != asset['sha256']:
+            app.logger.warning('Not serving %s: its sha256 is not the one pinned in VENDOR_ASSETS', filename)
+            continue
+        stem, extension = os.path.splitext(filename)
+        hashed = f'{stem}.{digest[:16]}{extension}'
+        assets[hashed] = PrecompressedAsset(body, VENDOR_MIMETYPES[extension], VENDOR_CACHE_CONTROL)
+        urls[key] = f'/assets/{hashed}'
+    missing = [key for key, url in urls.items() if url == VENDOR_ASSETS[key]['url']]
+    if missing:
+        app.logger.warning('Loading %s from the CDN; run `flask fetch-vendor-assets` to serve them locally',
+                           ', '.join(missing))
+    return urls, assets
+
+
+vendor_urls, vendor_files = load_vendor_assets(VENDOR_DIR)
+
+# The page has no per-request state, so render and compress it once at startup
+with app.app_context():
+    index_page = PrecompressedAsset(
+        render_template_string(
+            HTML_TEMPLATE, nutrient_display=nutrient_display(), vendor=vendor_urls,
+            vendor_from_cdn=len(vendor_files) < len(VENDOR_ASSETS), scan_history_limit=SCAN_HISTORY_LIMIT,
+        ),
+        'text/html', 'no-cache',
+    )
+    service_worker = PrecompressedAsset(
+        render_template_string(
+            SERVICE_WORKER_TEMPLATE, shell_version=index_page.variants[None][1],
+            vendor_urls=list(vendor_urls.values()),
+        ),
+        'text/javascript', 'no-cache',
+    )
+
+
 @app.route('/')
 def index():
-    return render_template_string(HTML_TEMPLATE)
+    return serve_asset(index_page)
+
+@app.route('/sw.js')
+def service_worker_script():
+    return serve_asset(service_worker)
+
+@app.route('/assets/<name>')
+def vendor_asset(name):
+    asset = vendor_files.get(name)
+    if asset is None:
+        abort(404)
+    return serve_asset(asset)
+
+@app.after_request
+def compress_json(response):
+    return compress_response(response, lambda encoding: request.accept_encodings[encoding] > 0)
 
-@app.route('/search', methods=['POST'])
+@app.route('/search', methods=['GET', 'POST'])
 def search_product():
-    barcode = request.form.get('barcode', '')
+    timing = request_timing.start()
+    cleaned_barcode = clean_barcode(request.values.get('barcode', ''))
+    if not cleaned_barcode:
+        return search_response({'error': INVALID_BARCODE_ERROR}, 'invalid', timing, cleaned_barcode)
+    schema = response_schema(request.values.get('schema'))
+    if schema is None:
+        return search_response({'error': UNKNOWN_SCHEMA_ERROR}, 'invalid', timing, cleaned_barcode, status=400)
+    budget = search_budget(request.values.get('timeout'))
+    if budget is None:
+        return search_response({'error': INVALID_TIMEOUT_ERROR}, 'invalid', timing, cleaned_barcode, status=400)
     
-    # Clean barcode - remove any non-numeric characters
-    cleaned_barcode = re.sub(r'[^0-9]', '', barcode)
+    try:
+        product_info = lookup_product(cleaned_barcode, time.monotonic() + budget)
+    except LookupTimedOut:
+        return search_response({'error': LOOKUP_TIMED_OUT_ERROR}, 'timed_out', timing, cleaned_barcode, status=504)
+    except UpstreamUnavailable:
+        return search_response({'error': UPSTREAM_UNAVAILABLE_ERROR}, 'unavailable', timing, cleaned_barcode,
+                               status=503, retry_after=upstream_retry_after())
+    if product_info is None:
+        return search_response({'error': PRODUCT_NOT_FOUND_ERROR}, 'not_found', timing, cleaned_barcode)
     
-    # Validate barcode
-    if not cleaned_barcode or len(cleaned_barcode) < 8:
-        return jsonify({
-            'error': 'Invalid barcode format. Please provide a numeric barcode with at least 8 digits.'
-        })
+    # Only a GET can be answered with 304; RFC 9110 gives other methods 412 instead
+    etag = product_etag(product_info, schema)
+    if request.method == 'GET':
+        matched = etag_matches(request.if_none_match, etag)
+        if matched:
+            return search_response(None, 'not_modified', timing, cleaned_barcode, status=304, etag=matched)
     
-    # Try different Open Food Facts API endpoints
-    api_endpoints = [
-        f"https://world.openfoodfacts.org/api/v0/product/{cleaned_barcode}.json",
-        f"https://us.openfoodfacts.org/api/v0/product/{cleaned_barcode}.json",
-        f"https://uk.openfoodfacts.org/api/v0/product/{cleaned_barcode}.json",
-        f"https://in.openfoodfacts.org/api/v0/product/{cleaned_barcode}.json"
-    ]
+    return search_response(build_search_payload(product_info, schema), 'found', timing, cleaned_barcode, etag=etag)
+
+def search_response(payload, result, timing, cleaned_barcode, status=200, etag=None, retry_after=None):
+    """Serialize a /search answer, record it in the metrics and attach its phase timings"""
+    with request_timing.phase('serialize'):
+        response = Response(status=304) if payload is None else jsonify(payload)
+    response.status_code = status
+    if retry_after:
+        response.headers['Retry-After'] = str(retry_after)
+    if etag:
+        response.set_etag(etag)
+        # Browsers may keep the body but must revalidate it, which costs a 304 when nothing changed
+        response.headers['Cache-Control'] = 'no-cache'
+        response.vary.add('Accept-Encoding')
+    request_timing.finish()
+    metrics.observe_search(result, timing.elapsed(), response.content_length or 0)
+    if SERVER_TIMING:
+        response.headers['Server-Timing'] = timing.header()
+    request_timing.log(timing, TIMING_LOG_SAMPLE_RATE, barcode=cleaned_barcode, result=result, mode='sync')
+    return response
+
+@app.route('/search/batch', methods=['POST'])
+def search_batch():
+    """Look up many barcodes at once, streaming one NDJSON line per product as it is ready"""
+    payload = request.get_json(silent=True)
+    if isinstance(payload, dict):
+        barcodes = payload.get('barcodes')
+    else:
+        barcodes = request.form.getlist('barcode')
+    unique_barcodes, invalid_barcodes, error = split_batch_barcodes(barcodes)
+    if error:
+        return jsonify({'error': error}), 400
     
-    product_data = None
-    endpoint_used = None
+    def generate():
+        for barcode in invalid_barcodes:
+            yield json.dumps({'barcode': barcode, 'error': INVALID_BARCODE_ERROR}) + '\n'
+        
+        # Keep at most BATCH_CONCURRENCY lookups in flight so memory does not grow with the batch
+        executor = _thread_pool('batch-lookup', BATCH_CONCURRENCY)
+        remaining = iter(unique_barcodes)
+        pending = {}
+        
+        def submit_next():
+            barcode = next(remaining, None)
+            if barcode is not None:
+                pending[executor.submit(lookup_product, barcode)] = barcode
+        
+        for _ in range(BATCH_CONCURRENCY):
+            submit_next()
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                barcode = pending.pop(future)
+                submit_next()
+                yield json.dumps(batch_result(barcode, future)) + '\n'
     
-    for endpoint in api_endpoints:
-        try:
-            response = requests.get(endpoint, timeout=5)
-            if response.status_code == 200:
-                data = response.json()
-                if data.get('status') == 1 and data.get('product'):
-                    product_data = data.get('product')
-                    endpoint_used = endpoint
-                    break
-        except (requests.RequestException, json.JSONDecodeError) as e:
-            continue
+    return Response(generate(), mimetype='application/x-ndjson')
+
+@app.route('/admin/cache')
+def cache_stats():
+    return jsonify(product_cache.stats())
+
+@app.route('/admin/coalescing')
+def coalescing_stats():
+    return jsonify(upstream_flights.stats())
+
+@app.route('/admin/local-products')
+def local_products_stats():
+    return jsonify(local_products.stats())
+
+@app.route('/admin/mirrors')
+def mirror_scores():
+    return jsonify(mirror_report())
+
+@app.route('/admin/governor')
+def governor_stats():
+    return jsonify([governor.snapshot() for governor in mirror_governors.values()])
+
+@app.route('/admin/pool')
+def upstream_pool_stats():
+    return jsonify(pool_stats())
+
+@app.route('/admin/popularity')
+def popularity_stats():
+    return jsonify({**popularity.stats(), 'top': popularity.top(20, POPULARITY_WINDOW)})
+
+@app.route('/ready')
+def readiness():
+    """200 once the cache warm-up has finished, 503 while it runs; /search is served either way"""
+    progress = cache_warmer.progress()
+    return jsonify(progress), 200 if progress['ready'] else 503
+
+@app.route('/metrics')
+def prometheus_metrics():
+    body, content_type = metrics.render()
+    return Response(body, content_type=content_type)
+
+def fetch_from_mirror(mirror, cleaned_barcode, queue_deadline, deadline):
+    """Fetch a raw product document from one mirror, returning (document or None, outcome)"""
+    health = mirror_health[mirror]
+    if not health.acquire():
+        metrics.observe_upstream(mirror, 'skipped')
+        return None, 'skipped'
+    governor = mirror_governors[mirror]
+    with request_timing.phase('queue'):
+        shed = governor.acquire(min(queue_deadline, deadline))
+    if shed:
+        health.release()
+        metrics.observe_upstream(mirror, 'shed')
+        return None, 'shed'
     
+    # The mirror's own timeout, unless the lookup has less time than that left
+    timeout, cut_short = mirror_timeout(health, deadline)
+    outcome = 'error'
+    timed_out = False
+    status = None
+    size = 0
+    started = time.perf_counter()
+    try:
+        response = mirror_session(mirror).get(
+            OFF_PRODUCT_URL.format(mirror=mirror, barcode=cleaned_barcode),
+            params=upstream_params(),
+            timeout=Timeout(total=timeout)
+        )
+        status = response.status_code
+        size = len(response.content)
+        if response.status_code == 200:
+            with request_timing.phase('parse'):
+                product_data = parse_product_payload(response.content)
+            if product_data:
+                outcome = 'found'
+                return product_data, outcome
+            outcome = 'not_found'
+        elif response.status_code == 404:
+            outcome = 'not_found'
+        elif response.status_code in (429, 503):
+            outcome = 'throttled'
+            throttle_upstream(response.headers.get('Retry-After'))
+    except requests.Timeout:
+        if cut_short:
+            outcome = 'deadline'
+        else:
+            timed_out = True
+    # ValueError covers bodies that are not JSON and those that are not even UTF-8
+    except (requests.RequestException, ValueError):
+        pass
+    finally:
+        governor.release()
+        latency = time.perf_counter() - started
+        if outcome == 'deadline':
+            # Running out of the lookup's time says nothing about the mirror
+            health.release()
+        else:
+            health.record('error' if outcome == 'throttled' else outcome, latency, size)
+        metrics.observe_upstream(mirror, 'timeout' if timed_out else outcome, status, latency, size)
+        request_timing.record(f'mirror-{mirror}', latency, 'timeout' if timed_out else outcome)
+    return None, 'timeout' if timed_out else outcome
+
+def mirror_timeout(health, deadline):
+    """Seconds to give one request to a mirror, and whether that was cut short by the lookup's deadline"""
+    left = deadline - time.monotonic()
+    if left < health.timeout:
+        # urllib3 refuses a zero timeout; this request just times out at once
+        return max(left, 0.001), True
+    return health.timeout, False
+
+def upstream_params():
+    """Query parameters asking the mirrors for just the fields we read"""
+    return {'fields': UPSTREAM_FIELDS} if OFF_FIELD_PROJECTION else None
+
+def parse_product_payload(content):
+    """Decode an upstream response body into just the product fields we read, or None if it has no product
+
+    The body is parsed whole: the mirrors are asked for UPSTREAM_FIELDS only, and
+    on bodies that small the C json decoder beats skipping unwanted members in Python.
+    """
+    data = json.loads(content)
+    product = data.get('product') if isinstance(data, dict) and data.get('status') == 1 else None
+    if not product:
+        return None
+    return {field: product[field] for field in PRODUCT_FIELDS if field in product}
+
+def lookup_product(cleaned_barcode, deadline=None):
+    """Return extracted product info from the cache, the offline database or the mirrors, or None
+
+    A stale cached product comes back marked 'stale': at once while it is being
+    refreshed, or when the mirrors cannot be reached (otherwise UpstreamUnavailable,
+    or LookupTimedOut once the time.monotonic() deadline has passed).
+    """
+    if deadline is None:
+        deadline = time.monotonic() + SEARCH_DEADLINE
+    with request_timing.phase('cache'):
+        cached, age = product_cache.get(cleaned_barcode)
+    if cached is not None and age < PRODUCT_CACHE_TTL + PRODUCT_CACHE_MAX_STALE:
+        popularity.record(cleaned_barcode)
+        if age < PRODUCT_CACHE_TTL:
+            metrics.lookup_sources.labels('cache').inc()
+            return cached
+        refresh_in_background(cleaned_barcode)
+        metrics.lookup_sources.labels('stale').inc()
+        return mark_stale(cached)
+    
+    # The offline database answers without any network call
+    with request_timing.phase('local'):
+        product_data = local_products.get(cleaned_barcode)
+    if product_data is not None:
+        metrics.lookup_sources.labels('local').inc()
+        return extract_product_info(product_data, 'local')
+    
+    # Concurrent lookups for the same barcode share one trip to the mirrors
+    try:
+        with request_timing.phase('upstream'):
+            try:
+                product_info = upstream_flights.do(cleaned_barcode, fetch_and_cache_product, cleaned_barcode,
+                                                   deadline, timeout=time_left(deadline))
+            except TimeoutError:
+                # The fetch we joined runs to its own deadline, which came later than ours
+                raise LookupTimedOut(cleaned_barcode) from None
+    except UpstreamUnavailable:
+        if cached is None or age >= PRODUCT_CACHE_TTL + PRODUCT_CACHE_STALE_IF_ERROR:
+            raise
+        metrics.lookup_sources.labels('stale').inc()
+        popularity.record(cleaned_barcode)
+        return mark_stale(cached)
+    if product_info is not None:
+        popularity.record(cleaned_barcode)
+    return product_info
+
+def mark_stale(product_info):
+    """A copy of cached product info flagged as past its TTL; the flag also changes its ETag"""
+    return {**product_info, 'stale': True}
+
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+# When a background refresh last found each barcode missing upstream, oldest first.
+# Its stale copy is not refetched again until PRODUCT_CACHE_TTL has passed
+_refresh_misses = OrderedDict()
+REFRESH_MISSES_MAX = 4096
+
+def refresh_due(cleaned_barcode):
+    """Whether a stale product may be refetched: no refresh found it missing within the TTL"""
+    missed_at = _refresh_misses.get(cleaned_barcode)
+    return missed_at is None or time.monotonic() - missed_at >= PRODUCT_CACHE_TTL
+
+def record_refresh_miss(cleaned_barcode):
+    """Hold off refreshing a stale product the mirrors no longer have for one TTL"""
+    now = time.monotonic()
+    with _refreshing_lock:
+        _refresh_misses.pop(cleaned_barcode, None)
+        _refresh_misses[cleaned_barcode] = now
+        while _refresh_misses and (len(_refresh_misses) > REFRESH_MISSES_MAX
+                                   or now - next(iter(_refresh_misses.values())) >= PRODUCT_CACHE_TTL):
+            _refresh_misses.popitem(last=False)
+
+def refresh_in_background(cleaned_barcode):
+    """Refetch a stale product on a worker thread, unless it is already being refreshed or is backing off"""
+    with _refreshing_lock:
+        if cleaned_barcode in _refreshing or not refresh_due(cleaned_barcode):
+            return
+        _refreshing.add(cleaned_barcode)
+    _thread_pool('cache-refresh', CACHE_REFRESH_WORKERS).submit(_refresh_product, cleaned_barcode)
+
+def _refresh_product(cleaned_barcode):
+    try:
+        # Shares the trip with any lookup that misses the cache meanwhile
+        if upstream_flights.do(cleaned_barcode, fetch_into_cache, cleaned_barcode) is None:
+            record_refresh_miss(cleaned_barcode)
+    except Exception as e:
+        # The stale copy stays until a later lookup manages to refresh it
+        app.logger.warning('Background refresh failed for %s: %r', cleaned_barcode, e)
+    finally:
+        with _refreshing_lock:
+            _refreshing.discard(cleaned_barcode)
+
+def fetch_and_cache_product(cleaned_barcode, deadline=None):
+    """Fetch a product from the mirrors and cache its extracted info, or return None if not found"""
+    metrics.lookup_sources.labels('mirrors').inc()
+    return fetch_into_cache(cleaned_barcode, deadline)
+
+def fetch_into_cache(cleaned_barcode, deadline=None):
+    """Fetch and cache a product without counting it as a lookup, as the warm-up does"""
+    product_data, mirror = fetch_product_data(cleaned_barcode, deadline)
     if not product_data:
-        return jsonify({
-            'error': 'Product not found. The barcode may not be in the Open Food Facts database.'
-        })
+        return None
+    product_info = extract_product_info(product_data, mirror)
+    product_cache.set(cleaned_barcode, product_info)
+    return product_info
+
+def split_batch_barcodes(barcodes):
+    """Deduplicate a batch on the cleaned barcode, returning (unique, invalid, error)"""
+    if not isinstance(barcodes, list) or not barcodes:
+        return [], [], 'Provide a list of barcodes as {"barcodes": [...]} or repeated barcode form fields.'
+    if len(barcodes) > BATCH_MAX_BARCODES:
+        return [], [], f'Too many barcodes. At most {BATCH_MAX_BARCODES} can be looked up per batch.'
     
+    unique_barcodes = []
+    invalid_barcodes = []
+    seen = set()
+    for barcode in barcodes:
+        cleaned_barcode = clean_barcode(str(barcode))
+        if cleaned_barcode is None:
+            invalid_barcodes.append(str(barcode))
+        elif cleaned_barcode not in seen:
+            seen.add(cleaned_barcode)
+            unique_barcodes.append(cleaned_barcode)
+    return unique_barcodes, invalid_barcodes, None
+
+def batch_result(barcode, future):
+    """Turn a finished batch lookup into one NDJSON record"""
+    try:
+        product_info = future.result()
+    except LookupTimedOut:
+        return {'barcode': barcode, 'error': LOOKUP_TIMED_OUT_ERROR}
+    except UpstreamUnavailable:
+        return {'barcode': barcode, 'error': UPSTREAM_UNAVAILABLE_ERROR}
+    except Exception:
+        app.logger.exception('Batch lookup failed for %s', barcode)
+        return {'barcode': barcode, 'error': 'Lookup failed. Please try again later.'}
+    if product_info is None:
+        return {'barcode': barcode, 'error': PRODUCT_NOT_FOUND_ERROR}
+    return {'barcode': barcode, **build_product_response(product_info)}
+
+def clean_barcode(barcode):
+    """Strip non-numeric characters, returning None unless at least 8 digits remain"""
+    cleaned_barcode = re.sub(r'[^0-9]', '', barcode)
+    if not cleaned_barcode or len(cleaned_barcode) < 8:
+        return None
+    return cleaned_barcode
+
+def search_budget(requested):
+    """Seconds a lookup may take given the client's timeout parameter, or None if it is not a positive number"""
+    if not requested:
+        return SEARCH_DEADLINE
+    try:
+        budget = float(requested)
+    except ValueError:
+        return None
+    # Also rejects NaN
+    if not budget > 0:
+        return None
+    return min(budget, SEARCH_DEADLINE_MAX)
+
+def time_left(deadline):
+    """Seconds until a time.monotonic() deadline, or 0 once it has passed"""
+    return max(0.0, deadline - time.monotonic())
+
+def response_schema(requested):
+    """Resolve a schema parameter to one of RESPONSE_SCHEMAS, or None if it names no schema"""
+    schema = SCHEMA_ALIASES.get(requested, requested) if requested else DEFAULT_RESPONSE_SCHEMA
+    return schema if schema in RESPONSE_SCHEMAS else None
+
+def product_etag(product_info, schema):
+    """Strong ETag for a product's /search body: its schema, the rules, the watched terms and the product"""
+    # The body is a function of these four, so it can be validated before it is built
+    digest = hashlib.blake2b(
+        json.dumps(product_info, sort_keys=True, separators=(',', ':')).encode('utf-8'), digest_size=12
+    ).hexdigest()
+    return f'{schema}.r{rule_engine.version}.t{WATCHED_TERMS_DIGEST}.{digest}'
+
+def build_search_payload(product_info, schema):
+    """The /search body for a found product in the given schema"""
+    if schema == 'compact.v1':
+        return build_compact_response(product_info)
+    return build_product_response(product_info)
+
+def build_compact_response(product_info):
+    """The page's fields without empty values, its nutriments and the assessment"""
+    compact = {'schema': 'compact.v1'}
+    for field in COMPACT_FIELDS:
+        value = product_info.get(field)
+        if value:
+            compact[field] = value
+    nutriments = product_info.get('nutriments')
+    if isinstance(nutriments, dict):
+        displayed = {key: nutriments[key] for key in COMPACT_NUTRIMENTS if key in nutriments}
+        if displayed:
+            compact['nutriments'] = displayed
+    
+    with request_timing.phase('assess'):
+        compact['health_assessment'], compact['age_recommendations'] = rule_engine.evaluate(product_info)
+    
+    return compact
+
+def build_product_response(product_info):
+    """Add the health assessment and age recommendations to a copy of the product info"""
+    # Work on a copy so a cached entry is never mutated
+    product_info = dict(product_info)
+    
+    with request_timing.phase('assess'):
+        # Assess health and age suitability in one pass over the rule table
+        product_info['health_assessment'], product_info['age_recommendations'] = rule_engine.evaluate(product_info)
+        
+        # Allergens, oils, sweeteners and additives found in the ingredients and allergen tags
+        product_info['watched_terms'] = watched_terms(product_info)
+    
+    return product_info
+
+class TimedHTTPConnection(HTTPConnection):
+    """Connection that reports DNS, TCP (and for HTTPS, TLS) setup as the 'connect' phase"""
+    
+    def connect(self):
+        with request_timing.phase('connect'):
+            super().connect()
+
+class TimedHTTPSConnection(HTTPSConnection):
+    """HTTPS counterpart of TimedHTTPConnection, so the TLS handshake is included"""
+    
+    def connect(self):
+        with request_timing.phase('connect'):
+            super().connect()
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+TIMED_POOL_CLASSES = {'http': TimedHTTPConnectionPool, 'https': TimedHTTPSConnectionPool}
+
+def mirror_session(mirror):
+    """Return the shared keep-alive session for a mirror, creating it on first use"""
+    session = _sessions.get(mirror)
+    if session is not None and _sessions_pid == os.getpid():
+        return session
+    with _sessions_lock:
+        _reset_sessions_after_fork()
+        session = _sessions.get(mirror)
+        if session is None:
+            retries = Retry(
+                total=OFF_RETRIES,
+                # A read timeout is reported as one, not retried: a retry would double the wait
+                # past the lookup's deadline, and the error would surface as a ConnectionError
+                read=False,
+                backoff_factor=0.1,
+                status_forcelist=(502, 504),
+                allowed_methods=('GET',),
+                raise_on_status=False,
+            )
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=OFF_POOL_SIZE, max_retries=retries)
+            adapter.poolmanager.pool_classes_by_scheme = TIMED_POOL_CLASSES
+            session = requests.Session()
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _sessions[mirror] = session
+        return session
+
+def _reset_sessions_after_fork():
+    # Pooled sockets must not be shared between processes, so a forked worker starts afresh
+    global _sessions_pid
+    if _sessions_pid != os.getpid():
+        _sessions.clear()
+        _sessions_pid = os.getpid()
+
+def pool_stats():
+    """Return connection reuse counters for each mirror session"""
+    stats = {}
+    for mirror, session in list(_sessions.items()):
+        created = requests_made = 0
+        for adapter in set(session.adapters.values()):
+            for key in adapter.poolmanager.pools.keys():
+                pool = adapter.poolmanager.pools.get(key)
+                if pool is not None:
+                    created += pool.num_connections
+                    requests_made += pool.num_requests
+        stats[mirror] = {
+            'connections_created': created,
+            'requests': requests_made,
+            'connections_reused': max(requests_made - created, 0),
+            'reuse_rate': round(1 - created / requests_made, 4) if requests_made else 0.0,
+        }
+    return stats
+
+def fetch_product_data(cleaned_barcode, deadline=None):
+    """Fetch the raw product document and the mirror that answered, or (None, None) if no mirror has it
+
+    Raises UpstreamUnavailable when no mirror answered at all, so a miss is never
+    reported for a product we simply could not reach, and LookupTimedOut when the
+    time.monotonic() deadline (SEARCH_DEADLINE from now by default) ran out first.
+    """
+    if deadline is None:
+        deadline = time.monotonic() + SEARCH_DEADLINE
+    if LOOKUP_MODE == 'hedged':
+        return fetch_product_data_hedged(cleaned_barcode, deadline)
+    
+    # Try the mirrors one after another, healthiest first
+    queue_deadline = time.monotonic() + OFF_QUEUE_TIMEOUT
+    answered = False
+    for depth, mirror in enumerate(ranked_mirrors()):
+        if time.monotonic() >= deadline:
+            break
+        product_data, outcome = fetch_from_mirror(mirror, cleaned_barcode, queue_deadline, deadline)
+        if product_data:
+            metrics.observe_fallthrough(depth, mirror)
+            return product_data, mirror
+        answered = answered or outcome == 'not_found'
+        if outcome == 'throttled':
+            # Trying the next mirror would only add to the load that got us throttled
+            break
+    metrics.observe_fallthrough(None, None)
+    if not answered:
+        raise no_answer(cleaned_barcode, deadline)
+    return None, None
+
+def fetch_product_data_hedged(cleaned_barcode, deadline):
+    """Query the best-ranked mirror and hedge to the others, returning the first product found"""
+    executor = _thread_pool('off-hedge', HEDGE_WORKERS)
+    ranking = ranked_mirrors()
+    mirrors = iter(ranking)
+    pending = {}
+    queue_deadline = time.monotonic() + OFF_QUEUE_TIMEOUT
+    
+    def launch_next():
+        mirror = next(mirrors, None) if time.monotonic() < deadline else None
+        if mirror is not None:
+            # Run in a copy of this context so the hedge's phases land in this request's timing
+            pending[executor.submit(
+                contextvars.copy_context().run, fetch_from_mirror, mirror, cleaned_barcode, queue_deadline, deadline
+            )] = mirror
+    
+    launch_next()
+    answered = False
+    while pending:
+        left = time_left(deadline)
+        if not left:
+            # Running hedges end by the deadline on their own
+            for other in pending:
+                other.cancel()
+            break
+        done, _ = wait(pending, timeout=min(HEDGE_DELAY, left), return_when=FIRST_COMPLETED)
+        for future in done:
+            mirror = pending.pop(future)
+            product_data, outcome = future.result()
+            answered = answered or outcome == 'not_found'
+            if outcome == 'throttled':
+                # No more hedges: the other mirrors are the same service
+                mirrors = iter(())
+            if product_data:
+                # Drop hedges that have not started; running ones finish in the background
+                for other in pending:
+                    other.cancel()
+                metrics.observe_fallthrough(ranking.index(mirror), mirror)
+                return product_data, mirror
+        # Either the outstanding mirrors are slow or one came back empty: hedge to the next
+        launch_next()
+    metrics.observe_fallthrough(None, None)
+    if not answered:
+        raise no_answer(cleaned_barcode, deadline)
+    return None, None
+
+def no_answer(cleaned_barcode, deadline):
+    """The error for a lookup no mirror answered: LookupTimedOut if its deadline has passed"""
+    if time.monotonic() >= deadline:
+        return LookupTimedOut(cleaned_barcode)
+    return UpstreamUnavailable(cleaned_barcode)
+
+def _thread_pool(name, max_workers):
+    # Thread pools do not survive a fork, so each gunicorn worker builds its own
+    with _thread_pools_lock:
+        pool, pid = _thread_pools.get(name, (None, None))
+        if pool is None or pid != os.getpid():
+            pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+            _thread_pools[name] = (pool, os.getpid())
+        return pool
+
+def extract_product_info(product_data, mirror):
+    """Pick the fields we serve out of a raw Open Food Facts product document"""
     # Extract product information
     product_info = {
         'name': product_data.get('product_name', 'Unknown Product'),
@@ -732,197 +3085,27 @@ def search_product():
         'nutriments': product_data.get('nutriments', {}),
         'nutrition_grade': product_data.get('nutrition_grade_fr', ''),
         'nova_group': product_data.get('nova_group', ''),
-        'india_message': 'For Indian users: Please verify product details with local regulations.' if 'in.openfoodfacts.org' in endpoint_used else ''
+        'india_message': 'For Indian users: Please verify product details with local regulations.' if mirror == 'in' else ''
     }
     
-    # Assess health
-    product_info['health_assessment'] = assess_health(product_info)
-    
-    # Get age recommendations
-    product_info['age_recommendations'] = get_age_recommendations(product_info)
-    
-    return jsonify(product_info)
+    return product_info
 
 def assess_health(product_info):
     """Assess the health aspects of the product"""
-    assessment = {
-        'overall_rating': 'Average',  # Default rating
-        'positives': [],
-        'negatives': []
-    }
-    
-    # Check nutrition grade
-    nutrition_grade = product_info.get('nutrition_grade', '')
-    if nutrition_grade:
-        if nutrition_grade in ['a', 'b']:
-            assessment['positives'].append(f"Good nutrition grade ({nutrition_grade.upper()})")
-            assessment['overall_rating'] = 'Good'
-        elif nutrition_grade == 'c':
-            assessment['positives'].append(f"Average nutrition grade ({nutrition_grade.upper()})")
-        else:  # d or e
-            assessment['negatives'].append(f"Poor nutrition grade ({nutrition_grade.upper()})")
-            assessment['overall_rating'] = 'Poor'
-    
-    # Check sugar content
-    nutriments = product_info.get('nutriments', {})
-    try:
-        sugar_100g = float(nutriments.get('sugars_100g', 0) or 0)
-        if sugar_100g > 22.5:
-            assessment['negatives'].append(f"High sugar content ({sugar_100g}g per 100g)")
-            assessment['overall_rating'] = 'Poor'
-        elif sugar_100g > 5:
-            assessment['negatives'].append(f"Medium sugar content ({sugar_100g}g per 100g)")
-        else:
-            assessment['positives'].append(f"Low sugar content ({sugar_100g}g per 100g)")
-    except (ValueError, TypeError):
-        pass
-    
-    # Check fat content
-    try:
-        fat_100g = float(nutriments.get('fat_100g', 0) or 0)
-        if fat_100g > 17.5:
-            assessment['negatives'].append(f"High fat content ({fat_100g}g per 100g)")
-            assessment['overall_rating'] = 'Poor'
-        elif fat_100g > 3:
-            assessment['negatives'].append(f"Medium fat content ({fat_100g}g per 100g)")
-        else:
-            assessment['positives'].append(f"Low fat content ({fat_100g}g per 100g)")
-    except (ValueError, TypeError):
-        pass
-    
-    # Check additives
-    additives = product_info.get('additives_tags', [])
-    if len(additives) > 5:
-        assessment['negatives'].append(f"Contains many additives ({len(additives)})")
-        assessment['overall_rating'] = 'Poor'
-    elif len(additives) > 0:
-        assessment['negatives'].append(f"Contains some additives ({len(additives)})")
-    else:
-        assessment['positives'].append("No additives")
-    
-    # Check for palm oil
-    ingredients = product_info.get('ingredients', '')
-    if isinstance(ingredients, str) and 'palm oil' in ingredients.lower():
-        assessment['negatives'].append("Contains palm oil")
-    
-    # Check NOVA group (food processing classification)
-    try:
-        nova_group = int(product_info.get('nova_group', 0))
-        if nova_group == 4:
-            assessment['negatives'].append("Ultra-processed food (NOVA group 4)")
-            assessment['overall_rating'] = 'Poor'
-        elif nova_group == 3:
-            assessment['negatives'].append("Processed food (NOVA group 3)")
-        elif nova_group in [1, 2]:
-            assessment['positives'].append(f"Minimally processed food (NOVA group {nova_group})")
-            if assessment['overall_rating'] != 'Poor':
-                assessment['overall_rating'] = 'Good'
-    except (ValueError, TypeError):
-        pass
-    
-    # If no specific positives or negatives were found
-    if not assessment['positives'] and not assessment['negatives']:
-        assessment['positives'].append("Limited information available for detailed assessment")
-    
-    return assessment
+    return rule_engine.evaluate(product_info)[0]
 
 def get_age_recommendations(product_info):
     """Determine suitable age groups for the product"""
-    recommendations = {
-        'suitable_for': [],
-        'not_suitable_for': [],
-        'reasons': []
-    }
-    
-    all_age_groups = [
-        'Infants (0-12 months)', 
-        'Young children (1-3 years)', 
-        'Children (4-8 years)', 
-        'Older children (9-13 years)', 
-        'Teenagers (14-18 years)', 
-        'Adults (19-64 years)', 
-        'Elderly (65+ years)', 
-        'Pregnant women'
-    ]
-    
-    # Check for allergens (common allergens make product unsuitable for infants and young children)
-    allergens = product_info.get('allergens', [])
-    common_allergens = ['nuts', 'peanuts', 'milk', 'eggs', 'fish', 'shellfish', 'soy', 'wheat', 'gluten', 'celery', 'mustard', 'sesame', 'sulphites', 'lupin', 'molluscs']
-    
-    detected_allergens = []
-    for allergen in allergens:
-        for common in common_allergens:
-            if common in allergen.lower():
-                detected_allergens.append(common)
-    
-    if detected_allergens:
-        recommendations['not_suitable_for'].append('Infants (0-12 months)')
-        recommendations['not_suitable_for'].append('people with allergies to: ' + ', '.join(allergens))
-        recommendations['reasons'].append(f"Contains allergens: {', '.join(allergens)}")
-        if len(detected_allergens) > 1:
-            recommendations['not_suitable_for'].append('Young children (1-3 years)')
-    
-    # Check sugar content (high sugar is not good for children)
-    nutriments = product_info.get('nutriments', {})
-    try:
-        sugar_100g = float(nutriments.get('sugars_100g', 0) or 0)
-        if sugar_100g > 10:
-            recommendations['not_suitable_for'].extend(['Children (4-8 years)', 'Infants (0-12 months)', 'Young children (1-3 years)', 'people with diabetes'])
-            recommendations['reasons'].append(f"High sugar content ({sugar_100g}g per 100g)")
-        elif sugar_100g > 5:
-            recommendations['not_suitable_for'].extend(['Infants (0-12 months)'])
-    except (ValueError, TypeError):
-        # Sugar content not available or not a valid number
-        pass
-    
-    # Check salt content (high salt is not good for elderly and infants)
-    try:
-        salt_100g = float(nutriments.get('salt_100g', 0) or 0)
-        if salt_100g > 1.5:
-            recommendations['not_suitable_for'].extend(['Elderly (65+ years)', 'Infants (0-12 months)', 'people with hypertension'])
-            recommendations['reasons'].append(f"High salt content ({salt_100g}g per 100g)")
-        elif salt_100g > 0.8:
-            recommendations['not_suitable_for'].extend(['Infants (0-12 months)'])
-    except (ValueError, TypeError):
-        # Salt content not available or not a valid number
-        pass
-    
-    # Check additives (many additives not good for children and pregnant women)
-    additives = product_info.get('additives_tags', [])
-    if len(additives) > 3:
-        recommendations['not_suitable_for'].extend(['Pregnant women', 'Infants (0-12 months)', 'Young children (1-3 years)'])
-        recommendations['reasons'].append("Contains many additives")
-    
-    # Check NOVA group (highly processed foods not good for certain groups)
-    try:
-        nova_group = int(product_info.get('nova_group', 0))
-        if nova_group == 4:  # Ultra-processed food
-            recommendations['not_suitable_for'].extend(['Infants (0-12 months)', 'Young children (1-3 years)', 'Pregnant women'])
-            recommendations['reasons'].append(f"Highly processed food (NOVA group {nova_group})")
-    except (ValueError, TypeError):
-        # Nova group not available or not a valid number
-        pass
-    
-    # Remove duplicates
-    recommendations['not_suitable_for'] = list(set(recommendations['not_suitable_for']))
-    
-    # Default recommendations if no specific issues found
-    if not recommendations['not_suitable_for']:
-        recommendations['suitable_for'].append('all age groups')
-        recommendations['reasons'].append("No specific concerns identified")
-    else:
-        # Add suitable age groups that aren't in the not_suitable list
-        age_groups = ['Teenagers (14-18 years)', 'Adults (19-64 years)']
-        for group in age_groups:
-            if group not in recommendations['not_suitable_for']:
-                recommendations['suitable_for'].append(group)
-    
-    # If no suitable groups were found, add adults as default
-    if not recommendations['suitable_for']:
-        recommendations['suitable_for'].append('Adults (19-64 years)')
-    
-    return recommendations
+    return rule_engine.evaluate(product_info)[1]
 
 if __name__ == '__main__':
     port = int(os.environ.get("PORT", 5000))
-    app.run(host='0.0.0.0', port=port, debug=False)  # Debug mode OFF for production
\ No newline at end of file
+    if SERVER_MODE == 'async':
+        # async_app imports 'app'; without this it would get a second copy of this
+        # module, with its own caches, governors and warmer, beside the one running
+        sys.modules['app'] = sys.modules['__main__']
+        from async_app import run
+        run(port)
+    else:
+        cache_warmer.start()
+        app.run(host='0.0.0.0', port=port, debug=False)  # Debug mode OFF for production
\ No newline at end of file
@@ -0,0 +1,614 @@
+"""Asyncio serving mode for the scanner.
+
+Serves the same routes as app.py on a single aiohttp event loop, so one worker
+can keep hundreds of Open Food Facts lookups in flight instead of one per
+worker. Product extraction, caching and scoring are shared with the Flask app.
+
+Select it with ``SERVER_MODE=async python app.py`` or run it under gunicorn:
+
+    gunicorn async_app:app --worker-class aiohttp.GunicornWebWorker
+"""
+import os
+import json
+import time
+import asyncio
+import logging
+import functools
+import aiohttp
+from aiohttp import web
+from werkzeug.http import parse_accept_header, parse_etags
+
+import metrics
+import request_timing
+
+from app import (
+    COMPRESS_MIN_SIZE,
+    INVALID_BARCODE_ERROR,
+    PRODUCT_NOT_FOUND_ERROR,
+    UPSTREAM_UNAVAILABLE_ERROR,
+    UNKNOWN_SCHEMA_ERROR,
+    LOOKUP_TIMED_OUT_ERROR,
+    INVALID_TIMEOUT_ERROR,
+    OFF_PRODUCT_URL,
+    OFF_QUEUE_TIMEOUT,
+    SEARCH_DEADLINE,
+    LOOKUP_MODE,
+    HEDGE_DELAY,
+    SERVER_TIMING,
+    TIMING_LOG_SAMPLE_RATE,
+    BATCH_CONCURRENCY,
+    POPULARITY_WINDOW,
+    PRODUCT_CACHE_TTL,
+    PRODUCT_CACHE_MAX_STALE,
+    PRODUCT_CACHE_STALE_IF_ERROR,
+    UpstreamUnavailable,
+    LookupTimedOut,
+    no_answer,
+    search_budget,
+    time_left,
+    mirror_timeout,
+    mark_stale,
+    refresh_due,
+    record_refresh_miss,
+    product_cache,
+    local_products,
+    popularity,
+    cache_warmer,
+    mirror_health,
+    mirror_governors,
+    throttle_upstream,
+    upstream_retry_after,
+    ranked_mirrors,
+    mirror_report,
+    upstream_params,
+    parse_product_payload,
+    clean_barcode,
+    extract_product_info,
+    response_schema,
+    product_etag,
+    etag_matches,
+    build_search_payload,
+    index_page,
+    service_worker,
+    vendor_files,
+    split_batch_barcodes,
+    batch_result,
+)
+
+# Total connections the upstream client may hold open across all mirrors
+ASYNC_UPSTREAM_CONNECTIONS = int(os.environ.get('ASYNC_UPSTREAM_CONNECTIONS', 256))
+
+# In-flight upstream fetches by barcode; everything runs on one loop, so no lock is needed
+upstream_flights = {}
+flight_stats = {'upstream_fetches': 0, 'coalesced_requests': 0}
+# Upstream requests and new connections per mirror, counted by the client's trace hooks
+pool_counters = {}
+
+UPSTREAM_SESSION = web.AppKey('upstream_session', aiohttp.ClientSession)
+
+logger = logging.getLogger(__name__)
+
+
+async def fetch_from_mirror(session, mirror, cleaned_barcode, queue_deadline, deadline):
+    """Fetch a raw product document from one mirror, returning (document or None, outcome)"""
+    health = mirror_health[mirror]
+    if not health.acquire():
+        metrics.observe_upstream(mirror, 'skipped')
+        return None, 'skipped'
+    governor = mirror_governors[mirror]
+    try:
+        with request_timing.phase('queue'):
+            shed = await governor.acquire_async(min(queue_deadline, deadline))
+    except asyncio.CancelledError:
+        health.release()
+        raise
+    if shed:
+        health.release()
+        metrics.observe_upstream(mirror, 'shed')
+        return None, 'shed'
+
+    url = OFF_PRODUCT_URL.format(mirror=mirror, barcode=cleaned_barcode)
+    # The mirror's own timeout, unless the lookup has less time than that left
+    timeout, cut_short = mirror_timeout(health, deadline)
+    outcome = 'error'
+    timed_out = False
+    status = None
+    size = 0
+    started = time.perf_counter()
+    try:
+        async with session.get(url, params=upstream_params(), timeout=aiohttp.ClientTimeout(total=timeout),
+                               trace_request_ctx={'mirror': mirror}) as response:
+            status = response.status
+            content = await response.read()
+            size = len(content)
+            if response.status == 200:
+                with request_timing.phase('parse'):
+                    product_data = parse_product_payload(content)
+                if product_data:
+                    outcome = 'found'
+                    return product_data, outcome
+                outcome = 'not_found'
+            elif response.status == 404:
+                outcome = 'not_found'
+            elif response.status in (429, 503):
+                outcome = 'throttled'
+                throttle_upstream(response.headers.get('Retry-After'))
+    except asyncio.TimeoutError:
+        if cut_short:
+            outcome = 'deadline'
+        else:
+            timed_out = True
+    # ValueError covers bodies that are not JSON and those that are not even UTF-8
+    except (aiohttp.ClientError, ValueError):
+        pass
+    except asyncio.CancelledError:
+        # A losing hedge says nothing about the mirror's health
+        outcome = None
+        raise
+    finally:
+        governor.release()
+        if outcome is None:
+            health.release()
+        else:
+            latency = time.perf_counter() - started
+            if outcome == 'deadline':
+                # Nor does running out of the lookup's time
+                health.release()
+            else:
+                health.record('error' if outcome == 'throttled' else outcome, latency, size)
+            metrics.observe_upstream(mirror, 'timeout' if timed_out else outcome, status, latency, size)
+            request_timing.record(f'mirror-{mirror}', latency, 'timeout' if timed_out else outcome)
+    return None, 'timeout' if timed_out else outcome
+
+
+async def fetch_product_data(session, cleaned_barcode, deadline=None):
+    """Fetch the raw product document and the mirror that answered, or (None, None) if no mirror has it
+
+    Raises UpstreamUnavailable when no mirror answered at all, or LookupTimedOut
+    when the deadline ran out first.
+    """
+    if deadline is None:
+        deadline = time.monotonic() + SEARCH_DEADLINE
+    if LOOKUP_MODE == 'hedged':
+        return await fetch_product_data_hedged(session, cleaned_barcode, deadline)
+
+    queue_deadline = time.monotonic() + OFF_QUEUE_TIMEOUT
+    answered = False
+    for depth, mirror in enumerate(ranked_mirrors()):
+        if time.monotonic() >= deadline:
+            break
+        product_data, outcome = await fetch_from_mirror(session, mirror, cleaned_barcode, queue_deadline, deadline)
+        if product_data:
+            metrics.observe_fallthrough(depth, mirror)
+            return product_data, mirror
+        answered = answered or outcome == 'not_found'
+        if outcome == 'throttled':
+            # Trying the next mirror would only add to the load that got us throttled
+            break
+    metrics.observe_fallthrough(None, None)
+    if not answered:
+        raise no_answer(cleaned_barcode, deadline)
+    return None, None
+
+
+async def fetch_product_data_hedged(session, cleaned_barcode, deadline):
+    """Query the best-ranked mirror and hedge to the others, returning the first product found"""
+    ranking = ranked_mirrors()
+    mirrors = iter(ranking)
+    pending = {}
+    queue_deadline = time.monotonic() + OFF_QUEUE_TIMEOUT
+
+    def launch_next():
+        mirror = next(mirrors, None) if time.monotonic() < deadline else None
+        if mirror is not None:
+            pending[asyncio.ensure_future(
+                fetch_from_mirror(session, mirror, cleaned_barcode, queue_deadline, deadline)
+            )] = mirror
+
+    launch_next()
+    answered = False
+    try:
+        while pending:
+            left = time_left(deadline)
+            if not left:
+                break
+            done, _ = await asyncio.wait(pending, timeout=min(HEDGE_DELAY, left), return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                mirror = pending.pop(task)
+                product_data, outcome = task.result()
+                answered = answered or outcome == 'not_found'
+                if outcome == 'throttled':
+                    # No more hedges: the other mirrors are the same service
+                    mirrors = iter(())
+                if product_data:
+                    metrics.observe_fallthrough(ranking.index(mirror), mirror)
+                    return product_data, mirror
+            launch_next()
+        metrics.observe_fallthrough(None, None)
+        if not answered:
+            raise no_answer(cleaned_barcode, deadline)
+        return None, None
+    finally:
+        # Unlike threads, losing hedges can really be cancelled here
+        for task in pending:
+            task.cancel()
+
+
+async def lookup_product(session, cleaned_barcode, deadline=None):
+    """Return extracted product info from the cache, the offline database or the mirrors, or None
+
+    A stale cached product comes back marked 'stale': at once while it is being
+    refreshed, or when the mirrors cannot be reached (otherwise UpstreamUnavailable,
+    or LookupTimedOut once the time.monotonic() deadline has passed).
+    """
+    if deadline is None:
+        deadline = time.monotonic() + SEARCH_DEADLINE
+    loop = asyncio.get_running_loop()
+    # Both reads may wait on SQLite, which would stall every other lookup on the loop
+    with request_timing.phase('cache'):
+        cached, age = await loop.run_in_executor(None, product_cache.get, cleaned_barcode)
+    if cached is not None and age < PRODUCT_CACHE_TTL + PRODUCT_CACHE_MAX_STALE:
+        popularity.record(cleaned_barcode)
+        if age < PRODUCT_CACHE_TTL:
+            metrics.lookup_sources.labels('cache').inc()
+            return cached
+        if refresh_due(cleaned_barcode):
+            # Shares the trip with any lookup that misses the cache meanwhile
+            refresh = upstream_flight(cleaned_barcode, fetch_into_cache(session, cleaned_barcode))
+            refresh.add_done_callback(functools.partial(_refresh_done, cleaned_barcode))
+        metrics.lookup_sources.labels('stale').inc()
+        return mark_stale(cached)
+
+    with request_timing.phase('local'):
+        product_data = await loop.run_in_executor(None, local_products.get, cleaned_barcode)
+    if product_data is not None:
+        metrics.lookup_sources.labels('local').inc()
+        return extract_product_info(product_data, 'local')
+
+    try:
+        with request_timing.phase('upstream'):
+            flight = upstream_flights.get(cleaned_barcode)
+            if flight is not None:
+                flight_stats['coalesced_requests'] += 1
+            else:
+                flight = upstream_flight(cleaned_barcode, fetch_and_cache_product(session, cleaned_barcode, deadline))
+            # Shield the shared fetch so one impatient client cannot cancel it for the rest
+            try:
+                product_info = await asyncio.wait_for(asyncio.shield(flight), time_left(deadline))
+            except asyncio.TimeoutError:
+                # The fetch we joined runs to its own deadline, which came later than ours
+                raise LookupTimedOut(cleaned_barcode) from None
+    except UpstreamUnavailable:
+        if cached is None or age >= PRODUCT_CACHE_TTL + PRODUCT_CACHE_STALE_IF_ERROR:
+            raise
+        metrics.lookup_sources.labels('stale').inc()
+        popularity.record(cleaned_barcode)
+        return mark_stale(cached)
+    if product_info is not None:
+        popularity.record(cleaned_barcode)
+    return product_info
+
+
+def upstream_flight(cleaned_barcode, fetch):
+    """The in-flight upstream fetch for a barcode, starting the coroutine fetch unless one is running"""
+    flight = upstream_flights.get(cleaned_barcode)
+    if flight is not None:
+        fetch.close()
+        return flight
+    # Concurrent lookups for the same barcode share one trip to the mirrors
+    flight = asyncio.ensure_future(fetch)
+    upstream_flights[cleaned_barcode] = flight
+    flight_stats['upstream_fetches'] += 1
+    flight.add_done_callback(lambda _: upstream_flights.pop(cleaned_barcode, None))
+    return flight
+
+
+def _refresh_done(cleaned_barcode, flight):
+    # Nobody awaits a background refresh, so its outcome is read here; the stale copy stays
+    if flight.cancelled():
+        return
+    if flight.exception() is not None:
+        logger.warning('Background refresh failed: %r', flight.exception())
+    elif flight.result() is None:
+        record_refresh_miss(cleaned_barcode)
+
+
+async def fetch_and_cache_product(session, cleaned_barcode, deadline=None):
+    """Fetch a product from the mirrors and cache its extracted info, or return None if not found"""
+    metrics.lookup_sources.labels('mirrors').inc()
+    return await fetch_into_cache(session, cleaned_barcode, deadline)
+
+
+async def fetch_into_cache(session, cleaned_barcode, deadline=None):
+    """Fetch and cache a product without counting it as a lookup, as background refreshes do"""
+    product_data, mirror = await fetch_product_data(session, cleaned_barcode, deadline)
+    if not product_data:
+        return None
+    product_info = extract_product_info(product_data, mirror)
+    # SQLite writes block, so keep them off the event loop
+    await asyncio.get_running_loop().run_in_executor(None, product_cache.set, cleaned_barcode, product_info)
+    return product_info
+
+
+def serve_asset(request, asset):
+    """Serve a precompressed asset, answering 304 when the client already holds it"""
+    accept_encoding = parse_accept_header(request.headers.get('Accept-Encoding'))
+    encoding, (body, etag) = asset.select(lambda encoding: accept_encoding[encoding] > 0)
+    if parse_etags(request.headers.get('If-None-Match')).contains(etag):
+        response = web.Response(status=304)
+    else:
+        response = web.Response(body=body, content_type=asset.mimetype)
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+    response.headers['ETag'] = f'"{etag}"'
+    response.headers['Cache-Control'] = asset.cache_control
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+
+async def index(request):
+    return serve_asset(request, index_page)
+
+
+async def service_worker_script(request):
+    return serve_asset(request, service_worker)
+
+
+async def vendor_asset(request):
+    asset = vendor_files.get(request.match_info['name'])
+    if asset is None:
+        raise web.HTTPNotFound()
+    return serve_asset(request, asset)
+
+
+@web.middleware
+async def compress_json(request, handler):
+    response = await handler(request)
+    if (isinstance(response, web.Response) and response.content_type == 'application/json'
+            and response.body is not None and len(response.body) >= COMPRESS_MIN_SIZE):
+        # gzip rather than aiohttp's first match, so the ETag suffix matches the sync server's
+        if parse_accept_header(request.headers.get('Accept-Encoding'))['gzip'] > 0:
+            response.enable_compression(web.ContentCoding.gzip)
+            etag = response.headers.get('ETag')
+            if etag and not etag.startswith('W/'):
+                response.headers['ETag'] = etag[:-1] + '-gz"'
+    return response
+
+
+async def search_product(request):
+    timing = request_timing.start()
+    values = request.query if request.method == 'GET' else await request.post()
+    cleaned_barcode = clean_barcode(values.get('barcode', ''))
+    if not cleaned_barcode:
+        return search_response({'error': INVALID_BARCODE_ERROR}, 'invalid', timing, cleaned_barcode)
+    schema = response_schema(values.get('schema'))
+    if schema is None:
+        return search_response({'error': UNKNOWN_SCHEMA_ERROR}, 'invalid', timing, cleaned_barcode, status=400)
+    budget = search_budget(values.get('timeout'))
+    if budget is None:
+        return search_response({'error': INVALID_TIMEOUT_ERROR}, 'invalid', timing, cleaned_barcode, status=400)
+
+    try:
+        product_info = await lookup_product(request.app[UPSTREAM_SESSION], cleaned_barcode, time.monotonic() + budget)
+    except LookupTimedOut:
+        return search_response({'error': LOOKUP_TIMED_OUT_ERROR}, 'timed_out', timing, cleaned_barcode, status=504)
+    except UpstreamUnavailable:
+        return search_response({'error': UPSTREAM_UNAVAILABLE_ERROR}, 'unavailable', timing, cleaned_barcode,
+                               status=503, retry_after=upstream_retry_after())
+    if product_info is None:
+        return search_response({'error': PRODUCT_NOT_FOUND_ERROR}, 'not_found', timing, cleaned_barcode)
+
+    # Only a GET can be answered with 304; RFC 9110 gives other methods 412 instead
+    etag = product_etag(product_info, schema)
+    if request.method == 'GET':
+        matched = etag_matches(parse_etags(request.headers.get('If-None-Match')), etag)
+        if matched:
+            return search_response(None, 'not_modified', timing, cleaned_barcode, status=304, etag=matched)
+
+    return search_response(build_search_payload(product_info, schema), 'found', timing, cleaned_barcode, etag=etag)
+
+
+def search_response(payload, result, timing, cleaned_barcode, status=200, etag=None, retry_after=None):
+    """Serialize a /search answer, record it in the metrics and attach its phase timings"""
+    with request_timing.phase('serialize'):
+        response = web.Response(status=304) if payload is None else web.json_response(payload, status=status)
+    if retry_after:
+        response.headers['Retry-After'] = str(retry_after)
+    if etag:
+        response.headers['ETag'] = f'"{etag}"'
+        # Browsers may keep the body but must revalidate it, which costs a 304 when nothing changed
+        response.headers['Cache-Control'] = 'no-cache'
+        response.headers['Vary'] = 'Accept-Encoding'
+    metrics.observe_search(result, timing.elapsed(), len(response.body or b''))
+    if SERVER_TIMING:
+        response.headers['Server-Timing'] = timing.header()
+    request_timing.log(timing, TIMING_LOG_SAMPLE_RATE, barcode=cleaned_barcode, result=result, mode='async')
+    return response
+
+
+async def search_batch(request):
+    """Look up many barcodes at once, streaming one NDJSON line per product as it is ready"""
+    if request.content_type == 'application/json':
+        try:
+            payload = await request.json()
+        except json.JSONDecodeError:
+            payload = None
+        barcodes = payload.get('barcodes') if isinstance(payload, dict) else None
+    else:
+        barcodes = (await request.post()).getall('barcode', [])
+    unique_barcodes, invalid_barcodes, error = split_batch_barcodes(barcodes)
+    if error:
+        return web.json_response({'error': error}, status=400)
+
+    response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+    await response.prepare(request)
+    for barcode in invalid_barcodes:
+        await response.write((json.dumps({'barcode': barcode, 'error': INVALID_BARCODE_ERROR}) + '\n').encode())
+
+    # Keep at most BATCH_CONCURRENCY lookups in flight so memory does not grow with the batch
+    session = request.app[UPSTREAM_SESSION]
+    remaining = iter(unique_barcodes)
+    pending = {}
+
+    def submit_next():
+        barcode = next(remaining, None)
+        if barcode is not None:
+            pending[asyncio.ensure_future(lookup_product(session, barcode))] = barcode
+
+    for _ in range(BATCH_CONCURRENCY):
+        submit_next()
+    try:
+        while pending:
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                barcode = pending.pop(task)
+                submit_next()
+                await response.write((json.dumps(batch_result(barcode, task)) + '\n').encode())
+    finally:
+        # The client went away mid-stream
+        for task in pending:
+            task.cancel()
+    await response.write_eof()
+    return response
+
+
+async def cache_stats(request):
+    # Counts the SQLite tier, which blocks
+    stats = await asyncio.get_running_loop().run_in_executor(None, product_cache.stats)
+    return web.json_response(stats)
+
+
+async def coalescing_stats(request):
+    return web.json_response({**flight_stats, 'in_flight': len(upstream_flights)})
+
+
+async def popularity_stats(request):
+    loop = asyncio.get_running_loop()
+    stats = await loop.run_in_executor(None, popularity.stats)
+    top = await loop.run_in_executor(None, popularity.top, 20, POPULARITY_WINDOW)
+    return web.json_response({**stats, 'top': top})
+
+
+async def readiness(request):
+    """200 once the cache warm-up has finished, 503 while it runs; /search is served either way"""
+    progress = cache_warmer.progress()
+    return web.json_response(progress, status=200 if progress['ready'] else 503)
+
+
+async def local_products_stats(request):
+    stats = await asyncio.get_running_loop().run_in_executor(None, local_products.stats)
+    return web.json_response(stats)
+
+
+async def mirror_scores(request):
+    report = await asyncio.get_running_loop().run_in_executor(None, mirror_report)
+    return web.json_response(report)
+
+
+async def upstream_pool_stats(request):
+    stats = await asyncio.get_running_loop().run_in_executor(None, pool_stats)
+    return web.json_response(stats)
+
+
+def pool_stats():
+    """Return connection reuse counters for each mirror, in the shape app.pool_stats reports them"""
+    stats = {}
+    for mirror, counters in list(pool_counters.items()):
+        created, requests_made = counters['connections_created'], counters['requests']
+        stats[mirror] = {
+            'connections_created': created,
+            'requests': requests_made,
+            'connections_reused': max(requests_made - created, 0),
+            'reuse_rate': round(1 - created / requests_made, 4) if requests_made else 0.0,
+        }
+    return stats
+
+
+async def governor_stats(request):
+    return web.json_response([governor.snapshot() for governor in mirror_governors.values()])
+
+
+async def prometheus_metrics(request):
+    body, content_type = metrics.render()
+    # aiohttp wants the charset separately from the media type
+    media_type, _, charset = content_type.partition('; charset=')
+    return web.Response(body=body, content_type=media_type, charset=charset or None)
+
+
+def connection_tracing():
+    """Report DNS lookups and new upstream connections as request phases, and count them for /admin/pool"""
+    trace_config = aiohttp.TraceConfig()
+
+    # The DNS lookup happens inside connection setup, so each phase keeps its own start
+    def started(name):
+        async def mark(session, context, params):
+            setattr(context, name, time.perf_counter())
+        return mark
+
+    def finished(name):
+        async def record(session, context, params):
+            request_timing.record(name, time.perf_counter() - getattr(context, name))
+        return record
+
+    def counted(name):
+        async def count(session, context, params):
+            if context.trace_request_ctx:
+                counters = pool_counters.setdefault(
+                    context.trace_request_ctx['mirror'], {'connections_created': 0, 'requests': 0}
+                )
+                counters[name] += 1
+        return count
+
+    trace_config.on_request_start.append(counted('requests'))
+    trace_config.on_connection_create_end.append(counted('connections_created'))
+    trace_config.on_dns_resolvehost_start.append(started('dns'))
+    trace_config.on_dns_resolvehost_end.append(finished('dns'))
+    trace_config.on_connection_create_start.append(started('connect'))
+    trace_config.on_connection_create_end.append(finished('connect'))
+    return trace_config
+
+
+async def upstream_session(application):
+    connector = aiohttp.TCPConnector(limit=ASYNC_UPSTREAM_CONNECTIONS)
+    async with aiohttp.ClientSession(connector=connector, trace_configs=[connection_tracing()]) as session:
+        application[UPSTREAM_SESSION] = session
+        yield
+
+
+async def start_cache_warmup(application):
+    # Started here so it warms the same app module this server reads from; a
+    # second start in the process, as from gunicorn's post_worker_init, does nothing
+    cache_warmer.start()
+
+
+def create_app():
+    """Build the aiohttp application"""
+    application = web.Application(middlewares=[compress_json])
+    application.cleanup_ctx.append(upstream_session)
+    application.on_startup.append(start_cache_warmup)
+    application.router.add_get('/', index)
+    application.router.add_get('/sw.js', service_worker_script)
+    application.router.add_get('/assets/{name}', vendor_asset)
+    application.router.add_get('/search', search_product)
+    application.router.add_post('/search', search_product)
+    application.router.add_post('/search/batch', search_batch)
+    application.router.add_get('/admin/cache', cache_stats)
+    application.router.add_get('/admin/coalescing', coalescing_stats)
+    application.router.add_get('/admin/local-products', local_products_stats)
+    application.router.add_get('/admin/mirrors', mirror_scores)
+    application.router.add_get('/admin/pool', upstream_pool_stats)
+    application.router.add_get('/admin/popularity', popularity_stats)
+    application.router.add_get('/admin/governor', governor_stats)
+    application.router.add_get('/ready', readiness)
+    application.router.add_get('/metrics', prometheus_metrics)
+    return application
+
+
+def run(port):
+    web.run_app(create_app(), host='0.0.0.0', port=port)
+
+
+app = create_app()
+
+if __name__ == '__main__':
+    run(int(os.environ.get('PORT', 5000)))
@@ -0,0 +1,258 @@
+"""Microbenchmarks for the per-request hot paths, with a baseline check.
+
+For every upstream response in benchmarks/corpus/ (tiny to very large, sparse
+to complete), times each step /search takes after the network:
+
+    parse      parse_product_payload on the raw body
+    extract    extract_product_info on the parsed product
+    health     assess_health
+    age        get_age_recommendations
+    serialize  jsonify of build_product_response's result, as /search sends it
+    compact    jsonify of the compact.v1 body the page asks for
+
+Each step reports its per-call latency distribution in microseconds over several
+rounds, and its allocations measured with tracemalloc in a separate run: peak
+bytes during one call and bytes still held afterwards. Steps faster than about
+10us are timed in small batches, each sample being the batch average.
+
+    python benchmarks/bench_hotpaths.py --output results.json
+    python benchmarks/bench_hotpaths.py --baseline benchmarks/baseline.json --threshold 0.2
+
+With --baseline the run is compared against a saved result. The exit status is
+1 if any step's peak allocation, or the median of its quietest round, grew by
+more than the threshold. Latency comparisons are only meaningful on the machine
+that recorded the baseline, and on a shared or throttled machine the threshold
+has to be wider than its run-to-run noise. benchmarks/baseline.json records the
+CPU, Python and platform it was measured on next to the results; on any other
+machine, record a baseline of your own first.
+
+The shipped corpus is synthetic. It follows the shape of Open Food Facts
+documents, including string nutriments, translations, image metadata and
+ingredient trees. To capture real responses into the corpus:
+
+    python benchmarks/bench_hotpaths.py --record 3017620422003 5449000000996
+"""
+import os
+import sys
+import gc
+import json
+import time
+import argparse
+import platform
+import tracemalloc
+import requests
+from flask import jsonify
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CORPUS = os.path.join(ROOT, 'benchmarks', 'corpus')
+
+sys.path.insert(0, ROOT)
+# Keep the benchmark off the on-disk product cache
+os.environ.setdefault('PRODUCT_CACHE_DB', '')
+
+from app import (
+    app,
+    OFF_PRODUCT_URL,
+    parse_product_payload,
+    extract_product_info,
+    assess_health,
+    get_age_recommendations,
+    build_product_response,
+    build_compact_response,
+)
+
+
+# Growth below these is never reported, however large relative to a tiny step
+LATENCY_FLOOR_US = 1.0
+ALLOCATION_FLOOR_BYTES = 1024
+
+
+def load_corpus(directory):
+    payloads = {}
+    for name in sorted(os.listdir(directory)):
+        if name.endswith('.json'):
+            with open(os.path.join(directory, name), 'rb') as payload:
+                payloads[name[:-len('.json')]] = payload.read()
+    return payloads
+
+
+def record(barcodes, directory, mirror):
+    with requests.Session() as session:
+        for barcode in barcodes:
+            response = session.get(OFF_PRODUCT_URL.format(mirror=mirror, barcode=barcode), timeout=30)
+            response.raise_for_status()
+            with open(os.path.join(directory, f'{barcode}.json'), 'wb') as payload:
+                payload.write(response.content)
+            print(f'Recorded {barcode} ({len(response.content)} bytes)', file=sys.stderr)
+
+
+def steps(body):
+    """The (name, call) pairs to measure for one payload, each call taking no arguments"""
+    product_data = parse_product_payload(body)
+    yield 'parse', lambda: parse_product_payload(body)
+    if product_data is None:
+        return
+    product_info = extract_product_info(product_data, 'world')
+    response = build_product_response(product_info)
+    compact = build_compact_response(product_info)
+    yield 'extract', lambda: extract_product_info(product_data, 'world')
+    yield 'health', lambda: assess_health(product_info)
+    yield 'age', lambda: get_age_recommendations(product_info)
+    yield 'serialize', lambda: jsonify(response)
+    yield 'compact', lambda: jsonify(compact)
+
+
+def percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def measure_latency(call, min_time, min_calls, rounds):
+    # Warm up caches and specialisations, and size batches so the timer's own cost
+    # (tens of nanoseconds) stays under 1% of each sample
+    started = time.perf_counter_ns()
+    for _ in range(10):
+        call()
+    batch = max(1, min(1000, 10000 // max(1, (time.perf_counter_ns() - started) // 10)))
+    samples = []
+    round_medians = []
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(rounds):
+            round_samples = []
+            deadline = time.perf_counter() + min_time / rounds
+            while len(round_samples) * batch < min_calls / rounds or time.perf_counter() < deadline:
+                started = time.perf_counter_ns()
+                for _ in range(batch):
+                    call()
+                round_samples.append((time.perf_counter_ns() - started) / batch)
+            round_samples.sort()
+            round_medians.append(percentile(round_samples, 0.50))
+            samples.extend(round_samples)
+    finally:
+        if gc_enabled:
+            gc.enable()
+    samples.sort()
+    return {
+        'calls': len(samples) * batch,
+        'batch': batch,
+        'min_us': samples[0] / 1000,
+        'p50_us': percentile(samples, 0.50) / 1000,
+        'p90_us': percentile(samples, 0.90) / 1000,
+        'p99_us': percentile(samples, 0.99) / 1000,
+        'max_us': samples[-1] / 1000,
+        'mean_us': sum(samples) / len(samples) / 1000,
+        'best_round_p50_us': min(round_medians) / 1000,
+    }
+
+
+def measure_allocations(call):
+    call()
+    tracemalloc.start()
+    try:
+        before, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        result = call()
+        after, peak = tracemalloc.get_traced_memory()
+        del result
+    finally:
+        tracemalloc.stop()
+    return {'peak_bytes': peak - before, 'retained_bytes': after - before}
+
+
+def cpu_model():
+    try:
+        with open('/proc/cpuinfo') as cpuinfo:
+            for line in cpuinfo:
+                if line.startswith('model name'):
+                    return line.split(':', 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor()
+
+
+def run(payloads, min_time, min_calls, rounds):
+    results = {}
+    # jsonify reads the app's JSON settings, as it does in a request
+    with app.app_context():
+        for name, body in payloads.items():
+            for step, call in steps(body):
+                stats = measure_latency(call, min_time, min_calls, rounds)
+                stats.update(measure_allocations(call))
+                stats['payload_bytes'] = len(body)
+                results[f'{name}/{step}'] = {key: round(value, 3) if isinstance(value, float) else value
+                                             for key, value in stats.items()}
+    return {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'cpu': cpu_model(),
+        'cpus': os.cpu_count(),
+        'platform': platform.platform(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'results': results,
+    }
+
+
+def _grew(previous, current, threshold, floor):
+    return current > previous * (1 + threshold) and current - previous > floor
+
+
+def compare(current, baseline, threshold):
+    """Return a description of every step that regressed beyond threshold"""
+    regressions = []
+    for key, stats in current['results'].items():
+        previous = baseline['results'].get(key)
+        if previous is None:
+            continue
+        # Noise from other processes only ever slows a round down, so the quietest
+        # round's median is the steadiest number to compare
+        if _grew(previous['best_round_p50_us'], stats['best_round_p50_us'], threshold, LATENCY_FLOOR_US):
+            regressions.append(
+                f'{key} best_round_p50_us: {previous["best_round_p50_us"]} -> {stats["best_round_p50_us"]} '
+                f'(+{(stats["best_round_p50_us"] / previous["best_round_p50_us"] - 1) * 100:.0f}%)'
+            )
+        if _grew(previous['peak_bytes'], stats['peak_bytes'], threshold, ALLOCATION_FLOOR_BYTES):
+            regressions.append(
+                f'{key} peak_bytes: {previous["peak_bytes"]} -> {stats["peak_bytes"]} '
+                f'(+{(stats["peak_bytes"] / previous["peak_bytes"] - 1) * 100:.0f}%)'
+            )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--corpus', default=CORPUS, help='directory of recorded upstream responses')
+    parser.add_argument('--output', help='write the results to this JSON file (default stdout)')
+    parser.add_argument('--baseline', help='results JSON to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed relative growth before failing')
+    parser.add_argument('--min-time', type=float, default=1.0, help='seconds to time each step for')
+    parser.add_argument('--min-calls', type=int, default=200, help='calls to time each step for at least')
+    parser.add_argument('--rounds', type=int, default=5, help='rounds each step is timed in')
+    parser.add_argument('--record', nargs='+', metavar='BARCODE', help='fetch these barcodes into the corpus and exit')
+    parser.add_argument('--mirror', default='world')
+    args = parser.parse_args()
+
+    if args.record:
+        record(args.record, args.corpus, args.mirror)
+        return 0
+
+    results = run(load_corpus(args.corpus), args.min_time, args.min_calls, args.rounds)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            regressions = compare(results, json.load(baseline), args.threshold)
+        for regression in regressions:
+            print(f'REGRESSION {regression}', file=sys.stderr)
+        if regressions:
+            return 1
+        print(f'No regressions beyond {args.threshold:.0%} against {args.baseline}', file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
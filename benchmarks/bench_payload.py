@@ -0,0 +1,80 @@
+"""Measure upstream bytes and parse time with and without field projection.
+
+Fetches each barcode from a mirror twice, once for the full product document
+and once asking only for the fields the app reads, then times parsing each
+body the way fetch_from_mirror does:
+
+    python benchmarks/bench_payload.py 3017620422003 5449000000996
+
+With --payload, recorded full responses are used instead of the network and
+the projected body is derived from them locally.
+"""
+import os
+import sys
+import json
+import argparse
+import statistics
+import time
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import OFF_PRODUCT_URL, PRODUCT_FIELDS, UPSTREAM_FIELDS, parse_product_payload
+
+
+def time_parse(parse, body, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        parse(body)
+        samples.append(time.perf_counter() - started)
+    return statistics.median(samples)
+
+
+def parse_full(body):
+    # What the lookup did before projection: decode everything, then read the product
+    data = json.loads(body)
+    return data.get('product')
+
+
+def project_locally(full_body):
+    data = json.loads(full_body)
+    product = data.get('product') or {}
+    data['product'] = {field: product[field] for field in PRODUCT_FIELDS if field in product}
+    return json.dumps(data).encode()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('barcodes', nargs='*', help='barcodes to fetch live')
+    parser.add_argument('--mirror', default='world')
+    parser.add_argument('--payload', action='append', default=[], help='recorded full response body (repeatable)')
+    parser.add_argument('--repeat', type=int, default=50, help='parse repetitions per body')
+    args = parser.parse_args()
+
+    bodies = []
+    for path in args.payload:
+        with open(path, 'rb') as payload:
+            full = payload.read()
+        bodies.append((os.path.basename(path), full, project_locally(full)))
+    with requests.Session() as session:
+        for barcode in args.barcodes:
+            url = OFF_PRODUCT_URL.format(mirror=args.mirror, barcode=barcode)
+            full = session.get(url, timeout=10).content
+            projected = session.get(url, params={'fields': UPSTREAM_FIELDS}, timeout=10).content
+            bodies.append((barcode, full, projected))
+
+    results = []
+    for name, full, projected in bodies:
+        results.append({
+            'product': name,
+            'full_bytes': len(full),
+            'projected_bytes': len(projected),
+            'full_parse_ms': round(time_parse(parse_full, full, args.repeat) * 1000, 3),
+            'projected_parse_ms': round(time_parse(parse_product_payload, projected, args.repeat) * 1000, 3),
+        })
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+"""Compare /search requests per second per worker for the sync and async modes.
+
+Starts a local stub of the Open Food Facts API with a fixed response latency,
+runs each serving mode under a single gunicorn worker with the product cache
+disabled, and drives it with concurrent clients:
+
+    python benchmarks/bench_serving.py --latency 0.1 --concurrency 200 --duration 10
+"""
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import subprocess
+import aiohttp
+from aiohttp import web
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+STUB_PRODUCT = {
+    'status': 1,
+    'product': {
+        'product_name': 'Stub hazelnut spread',
+        'brands': 'Stub',
+        'nutriments': {'sugars_100g': 56.3, 'fat_100g': 30.9, 'salt_100g': 0.107},
+        'allergens_tags': ['en:milk', 'en:nuts', 'en:soybeans'],
+        'additives_tags': ['en:e322', 'en:e322i'],
+        'ingredients_text': 'Sugar, palm oil, hazelnuts 13%, skimmed milk powder 8.7%',
+        'nutrition_grade_fr': 'e',
+        'nova_group': 4,
+    },
+}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+async def start_stub(port, latency):
+    body = json.dumps(STUB_PRODUCT)
+
+    async def product(request):
+        await asyncio.sleep(latency)
+        return web.Response(text=body, content_type='application/json')
+
+    stub = web.Application()
+    stub.router.add_get('/{mirror}/api/v0/product/{barcode}.json', product)
+    runner = web.AppRunner(stub, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', port).start()
+    return runner
+
+
+def start_server(mode, port, stub_port):
+    env = dict(
+        os.environ,
+        PRODUCT_CACHE_SIZE='0',
+        PRODUCT_CACHE_DB='',
+        POPULARITY_DB='',
+        # Measure serving capacity, not the outbound governor
+        OFF_MIRROR_RATE='0',
+        OFF_MIRROR_CONCURRENCY='100000',
+        OFF_PRODUCT_URL=f'http://127.0.0.1:{stub_port}/{{mirror}}/api/v0/product/{{barcode}}.json',
+    )
+    command = [sys.executable, '-m', 'gunicorn', '--workers', '1', '--bind', f'127.0.0.1:{port}', '--log-level', 'warning']
+    if mode == 'async':
+        command += ['--worker-class', 'aiohttp.GunicornWebWorker', 'async_app:app']
+    else:
+        command += ['app:app']
+    return subprocess.Popen(command, cwd=ROOT, env=env)
+
+
+async def wait_until_up(session, url):
+    for _ in range(100):
+        try:
+            async with session.get(url) as response:
+                if response.status == 200:
+                    return
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.1)
+    raise RuntimeError(f'server at {url} did not start')
+
+
+async def drive(url, concurrency, duration):
+    completed = 0
+    errors = 0
+    deadline = time.perf_counter() + duration
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    timeout = aiohttp.ClientTimeout(total=60)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        await wait_until_up(session, url + '/')
+
+        async def client(n):
+            nonlocal completed, errors
+            while time.perf_counter() < deadline:
+                try:
+                    async with session.post(url + '/search', data={'barcode': f'{30000000 + n}'}) as response:
+                        payload = await response.json()
+                        if 'error' in payload:
+                            errors += 1
+                        else:
+                            completed += 1
+                except aiohttp.ClientError:
+                    errors += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(client(n) for n in range(concurrency)))
+        elapsed = time.perf_counter() - started
+    return completed / elapsed, errors
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--latency', type=float, default=0.1, help='stub upstream latency in seconds')
+    parser.add_argument('--concurrency', type=int, default=200, help='concurrent clients')
+    parser.add_argument('--duration', type=float, default=10, help='seconds to drive each mode')
+    args = parser.parse_args()
+
+    stub_port = free_port()
+    stub = await start_stub(stub_port, args.latency)
+    results = {}
+    try:
+        for mode in ('sync', 'async'):
+            port = free_port()
+            server = start_server(mode, port, stub_port)
+            try:
+                rps, errors = await drive(f'http://127.0.0.1:{port}', args.concurrency, args.duration)
+            finally:
+                server.terminate()
+                server.wait()
+            results[mode] = {'requests_per_second': round(rps, 1), 'errors': errors}
+    finally:
+        await stub.cleanup()
+
+    print(json.dumps({'latency': args.latency, 'concurrency': args.concurrency, 'results': results}, indent=2))
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,80 @@
+"""Compare the watched-term matcher with one substring check per term.
+
+Builds ingredient texts from a word list, then times finding every watched term
+in each text two ways: `term in text.lower()` for each term, the way palm oil
+and allergens were checked before, and one TermMatcher pass. The term list is
+padded with synthetic terms to show how each approach scales:
+
+    python benchmarks/bench_terms.py --terms 171 --terms 1000 --terms 5000
+
+The per-string caches in health_rules are bypassed, so this is the cost of a
+product seen for the first time.
+"""
+import os
+import sys
+import json
+import random
+import argparse
+import statistics
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from health_rules import WATCHED_TERMS
+from term_matcher import TermMatcher
+
+WORDS = [
+    'sugar', 'wheat flour', 'palm oil', 'hazelnuts', 'skimmed milk powder', 'cocoa', 'emulsifier',
+    'soy lecithin', 'vanillin', 'water', 'salt', 'glucose-fructose syrup', 'e330', 'citric acid',
+    'natural flavouring', 'rapeseed oil', 'whole milk', 'eggs', 'yeast', 'barley malt extract',
+    'acidity regulator', 'sodium bicarbonate', 'modified starch', 'tomato paste', 'vinegar',
+]
+
+
+def watched_terms(count, rng):
+    terms = {term: category for category, names in WATCHED_TERMS.items() for term in names}
+    while len(terms) < count:
+        terms[''.join(rng.choice('abcdefghijklmnopqrstuvwxyz ') for _ in range(rng.randint(5, 14)))] = 'synthetic'
+    return dict(list(terms.items())[:count])
+
+
+def naive_terms_in(terms, text):
+    lowered = text.lower()
+    return {term: category for term, category in terms.items() if term in lowered}
+
+
+def time_each(function, texts):
+    samples = []
+    for text in texts:
+        started = time.perf_counter()
+        function(text)
+        samples.append(time.perf_counter() - started)
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--terms', type=int, action='append', help='watched-term count (repeatable)')
+    parser.add_argument('--texts', type=int, default=2000, help='ingredient texts to scan')
+    parser.add_argument('--seed', type=int, default=13)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    texts = [', '.join(rng.choice(WORDS) for _ in range(rng.randint(5, 30))).capitalize() for _ in range(args.texts)]
+    results = []
+    for count in args.terms or [sum(len(names) for names in WATCHED_TERMS.values()), 1000, 5000]:
+        terms = watched_terms(count, rng)
+        matcher = TermMatcher(terms)
+        for text in texts[:50]:
+            assert matcher.terms_in(text) == naive_terms_in(terms, text)
+        results.append({
+            'terms': len(terms),
+            'substring_checks_us': round(time_each(lambda text: naive_terms_in(terms, text), texts) * 1e6, 1),
+            'matcher_us': round(time_each(matcher.terms_in, texts) * 1e6, 1),
+            'mean_text_chars': round(statistics.mean(len(text) for text in texts)),
+        })
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,256 @@
+"""Columnar batch version of the rule table in health_rules.py.
+
+Scores a list of product infos (the dicts extract_product_info returns) in one
+pass per rule over NumPy arrays instead of one product at a time. Features,
+bands, thresholds, messages and age groups all come from FEATURES and RULES,
+the table rule_engine.evaluate is compiled from, so score_products() returns
+exactly what evaluating that table on each product would.
+
+Used by ``flask --app app score-catalog``.
+"""
+import string
+
+import numpy as np
+
+from health_rules import (
+    AGE_LAST_RESORT,
+    AGE_NO_CONCERNS,
+    AGE_RESTRICTED_SUITABLE,
+    FEATURES,
+    HEALTH_FALLBACK,
+    RULES,
+    _mentions,
+    _parse_integer,
+    _parse_number,
+    _threshold,
+    tag_terms,
+)
+
+# Array type per feature parser; anything else is kept as Python objects
+FEATURE_DTYPES = {'number': np.float64, 'integer': np.int64, 'count': np.int64, 'mentions': bool, 'tag_terms': np.int64}
+
+# Names messages may use besides the features, computed as health_rules.MESSAGE_VALUES does
+MESSAGE_VALUES = {
+    'grade_upper': lambda columns, i: (
+        columns.values['grade'][i].upper() if isinstance(columns.values['grade'][i], str) else columns.values['grade'][i]
+    ),
+    'allergen_tags': lambda columns, i: ', '.join(columns.product_infos[i].get('allergens', [])),
+}
+
+
+class TagTermCounter:
+    """Memoized count of (tag, watched term) matches per category, since tags repeat across a catalog"""
+
+    def __init__(self):
+        self._categories = {}
+
+    def count(self, tags, category):
+        total = 0
+        for tag in tags:
+            categories = self._categories.get(tag)
+            if categories is None:
+                categories = self._categories[tag] = tuple(tag_terms(tag).values())
+            total += categories.count(category)
+        return total
+
+
+def _feature_values(spec, product_infos, tag_counter):
+    # The same parse rule_engine.evaluate does for the feature; None means it is missing or unparsable
+    parser, key = spec[0], spec[1]
+    if parser == 'number':
+        return [_parse_number(product_info.get(key, {}).get(spec[2], 0)) for product_info in product_infos]
+    if parser == 'integer':
+        return [_parse_integer(product_info.get(key, 0)) for product_info in product_infos]
+    if parser == 'count':
+        return [len(product_info.get(key, [])) for product_info in product_infos]
+    if parser == 'text':
+        return [product_info.get(key, '') or None for product_info in product_infos]
+    if parser == 'mentions':
+        return [_mentions(product_info.get(key, ''), spec[2]) for product_info in product_infos]
+    if parser == 'tag_terms':
+        return [tag_counter.count(product_info.get(key, []), spec[2]) for product_info in product_infos]
+    raise ValueError(f'Unknown feature parser {parser!r}')
+
+
+class ProductColumns:
+    """Every feature the rules read, parsed once per product and laid out as arrays.
+
+    arrays[name] holds the parsed values (0 where unparsable), valid[name] marks
+    the products whose value parsed, and values[name] is the same column as
+    Python objects for formatting messages.
+    """
+
+    def __init__(self, product_infos, tag_counter=None):
+        tag_counter = tag_counter or TagTermCounter()
+        self.size = len(product_infos)
+        self.product_infos = product_infos
+        self.arrays, self.valid, self.values = {}, {}, {}
+        for name in dict.fromkeys(rule['feature'] for rule in RULES):
+            spec = FEATURES[name]
+            values = _feature_values(spec, product_infos, tag_counter)
+            self.valid[name] = np.array([value is not None for value in values], dtype=bool)
+            filled = [0 if value is None else value for value in values]
+            try:
+                self.arrays[name] = np.array(filled, dtype=FEATURE_DTYPES.get(spec[0], object))
+            except OverflowError:
+                self.arrays[name] = np.array(filled, dtype=object)
+            self.values[name] = values
+
+
+def _matches(band, values):
+    # The band's test over a whole column; a band without a test matches everything
+    if 'above' in band:
+        return values > _threshold(band['above'])
+    if 'equals' in band:
+        return values == band['equals']
+    if 'in' in band:
+        return np.logical_or.reduce([values == option for option in band['in']])
+    return np.ones(len(values), dtype=bool)
+
+
+def band_index(rule, columns):
+    """Index of the first band of the rule each product falls in, or -1 where none applies"""
+    values = columns.arrays[rule['feature']]
+    index = np.full(columns.size, -1, dtype=np.int64)
+    unmatched = columns.valid[rule['feature']].copy()
+    for number, band in enumerate(rule['bands']):
+        matched = unmatched & _matches(band, values)
+        index[matched] = number
+        unmatched &= ~matched
+    return index
+
+
+def _template_fields(template):
+    return [field for _, field, _, _ in string.Formatter().parse(template) if field]
+
+
+def _fill(column, template, positions, columns):
+    # Write template, formatted the way rule_engine.evaluate formats it, at each position
+    names = _template_fields(template)
+    if not names:
+        for i in positions:
+            column[i] = template
+        return
+    arguments = []
+    for name in names:
+        if name in MESSAGE_VALUES:
+            value = MESSAGE_VALUES[name]
+            arguments.append([value(columns, i) for i in positions])
+        elif name in columns.values:
+            values = columns.values[name]
+            arguments.append([values[i] for i in positions])
+        else:
+            raise ValueError(f'Message {template!r} uses unknown value {name!r}')
+    # Positional fields, so each product is one str.format call
+    fields = iter(range(len(names)))
+    positional = ''.join(
+        literal.replace('{', '{{').replace('}', '}}') + ('' if field is None else f'{{{next(fields)}}}')
+        for literal, field, _, _ in string.Formatter().parse(template)
+    )
+    for i, text in zip(positions, map(positional.format, *arguments)):
+        column[i] = text
+
+
+def _message_column(rule, message, index, columns):
+    """Each product's text for the message key of the band it falls in, or None"""
+    column = [None] * columns.size
+    for number, band in enumerate(rule['bands']):
+        if message in band:
+            _fill(column, band[message], np.flatnonzero(index == number).tolist(), columns)
+    return column
+
+
+def assess_health_columns(columns):
+    """The health rules of RULES over ProductColumns, returning one assessment dict per product"""
+    poor = np.zeros(columns.size, dtype=bool)
+    good = np.zeros(columns.size, dtype=bool)
+    positive_columns, negative_columns = [], []
+    for rule in RULES:
+        if rule['target'] != 'health':
+            continue
+        index = band_index(rule, columns)
+        for number, band in enumerate(rule['bands']):
+            if band.get('rating') == 'Poor':
+                poor |= index == number
+            elif band.get('rating') == 'Good':
+                good |= index == number
+        positive_columns.append(_message_column(rule, 'positive', index, columns))
+        negative_columns.append(_message_column(rule, 'negative', index, columns))
+    ratings = np.where(poor, 'Poor', np.where(good, 'Good', 'Average')).tolist()
+
+    # The arrays above did the per-rule work; this loop only assembles the messages
+    assessments = []
+    for i in range(columns.size):
+        positives = [column[i] for column in positive_columns if column[i] is not None]
+        negatives = [column[i] for column in negative_columns if column[i] is not None]
+        if not positives and not negatives:
+            positives.append(HEALTH_FALLBACK)
+        assessments.append({'overall_rating': ratings[i], 'positives': positives, 'negatives': negatives})
+    return assessments
+
+
+def _suitable_groups(not_suitable):
+    if not not_suitable:
+        return [AGE_NO_CONCERNS[0]]
+    return [group for group in AGE_RESTRICTED_SUITABLE if group not in not_suitable] or [AGE_LAST_RESORT]
+
+
+def _resolve_groups(groups, i):
+    # (not suitable, suitable) for the product at position i, duplicates dropped in first-seen order
+    not_suitable = list(dict.fromkeys(group if isinstance(group, str) else group[i] for group in groups))
+    return not_suitable, _suitable_groups(not_suitable)
+
+
+def age_recommendations_columns(columns):
+    """The age rules of RULES over ProductColumns, returning one recommendations dict per product"""
+    combination = np.zeros(columns.size, dtype=np.int64)
+    chains = []
+    for rule in RULES:
+        if rule['target'] != 'age':
+            continue
+        index = band_index(rule, columns)
+        # Products sharing every rule's band share their age groups
+        combination = combination * (len(rule['bands']) + 1) + index + 1
+        band_groups = []
+        for number, band in enumerate(rule['bands']):
+            groups = []
+            for group in band.get('not_suitable', ()):
+                if _template_fields(group):
+                    # A group naming the product's own values (its allergen tags) becomes a column of texts
+                    texts = [None] * columns.size
+                    _fill(texts, group, np.flatnonzero(index == number).tolist(), columns)
+                    group = texts
+                groups.append(group)
+            band_groups.append(groups)
+        chains.append((index.tolist(), band_groups, _message_column(rule, 'reason', index, columns)))
+    combination = combination.tolist()
+
+    # Groups are resolved once per combination of bands and, where a group is a
+    # column of texts, once per distinct set of texts
+    combinations = {}
+    resolved = {}
+    recommendations = []
+    for i in range(columns.size):
+        entry = combinations.get(combination[i])
+        if entry is None:
+            groups = [group for index, band_groups, _ in chains if index[i] >= 0 for group in band_groups[index[i]]]
+            texts = [group for group in groups if not isinstance(group, str)]
+            entry = combinations[combination[i]] = (groups, texts, None if texts else _resolve_groups(groups, i))
+        groups, texts, outcome = entry
+        if outcome is None:
+            key = (combination[i], *[text[i] for text in texts])
+            outcome = resolved.get(key)
+            if outcome is None:
+                outcome = resolved[key] = _resolve_groups(groups, i)
+
+        reasons = [reason[i] for _, _, reason in chains if reason[i] is not None]
+        if not outcome[0]:
+            reasons.append(AGE_NO_CONCERNS[1])
+        recommendations.append({'suitable_for': list(outcome[1]), 'not_suitable_for': list(outcome[0]), 'reasons': reasons})
+    return recommendations
+
+
+def score_products(product_infos, tag_counter=None):
+    """Return (health_assessment, age_recommendations) for each product info, in order"""
+    columns = ProductColumns(product_infos, tag_counter)
+    return list(zip(assess_health_columns(columns), age_recommendations_columns(columns)))
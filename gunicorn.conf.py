@@ -0,0 +1,72 @@
+"""Gunicorn settings for the scanner, picked up automatically from this directory.
+
+Workers are separate processes, so /metrics only adds up across them if every
+worker writes its metrics to a shared directory. This sets one up before the
+app is imported, and tells prometheus_client when a worker goes away. It also
+creates the memory-mapped product cache the workers share, so each product is
+held once on the host, and the file through which they share the mirrors' rate
+limits and Retry-After pauses. Each worker starts the cache warm-up once the app
+is loaded.
+"""
+import os
+import shutil
+import tempfile
+
+# prometheus_client reads this when it is first imported, so it must be set here
+# rather than in app.py
+_created_metrics_dir = None
+if not os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+    _created_metrics_dir = tempfile.mkdtemp(prefix='scanner-metrics-')
+    os.environ['PROMETHEUS_MULTIPROC_DIR'] = _created_metrics_dir
+
+# An empty SHARED_CACHE_PATH turns the shared cache off. /dev/shm keeps it in
+# memory without writing it back to disk
+_created_shared_cache = None
+if 'SHARED_CACHE_PATH' not in os.environ:
+    fd, _created_shared_cache = tempfile.mkstemp(
+        prefix='scanner-products-', dir='/dev/shm' if os.path.isdir('/dev/shm') else None
+    )
+    os.close(fd)
+    os.environ['SHARED_CACHE_PATH'] = _created_shared_cache
+
+# Likewise for the mirrors' rate limits and Retry-After pauses, which every worker obeys
+_created_shared_limits = None
+if 'SHARED_LIMITS_PATH' not in os.environ:
+    fd, _created_shared_limits = tempfile.mkstemp(
+        prefix='scanner-limits-', dir='/dev/shm' if os.path.isdir('/dev/shm') else None
+    )
+    os.close(fd)
+    os.environ['SHARED_LIMITS_PATH'] = _created_shared_limits
+
+# Imported up front: child_exit runs in a signal handler, where a first import can
+# be interrupted by the next worker's exit and re-entered half-initialised
+from prometheus_client import multiprocess  # noqa: E402
+
+
+def on_starting(server):
+    # Counters restart from zero with the master, as they would in a single process
+    path = os.environ['PROMETHEUS_MULTIPROC_DIR']
+    os.makedirs(path, exist_ok=True)
+    for name in os.listdir(path):
+        if name.endswith('.db'):
+            os.remove(os.path.join(path, name))
+
+
+def post_worker_init(worker):
+    # The app is loaded by now, in sync and async workers alike; warm its cache
+    # in the background while the worker starts taking requests
+    from app import cache_warmer
+    cache_warmer.start()
+
+
+def child_exit(server, worker):
+    multiprocess.mark_process_dead(worker.pid)
+
+
+def on_exit(server):
+    if _created_metrics_dir:
+        shutil.rmtree(_created_metrics_dir, ignore_errors=True)
+    if _created_shared_cache and os.path.exists(_created_shared_cache):
+        os.remove(_created_shared_cache)
+    if _created_shared_limits and os.path.exists(_created_shared_limits):
+        os.remove(_created_shared_limits)
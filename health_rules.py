@@ -0,0 +1,415 @@
+"""Declarative rule table behind assess_health and get_age_recommendations.
+
+Every threshold and message lives in RULES. compile_rules() turns the table
+into a single generated function once at startup: the product fields the rules
+read are parsed once per product into features, and each rule becomes one
+if/elif chain over its bands, whose first match contributes messages, a rating
+or age groups. A new rule adds one more chain to that function, not another
+walk over the product dict.
+
+Bump RULES_VERSION whenever a change alters any assessment.
+"""
+
+import re
+import json
+import string
+import hashlib
+import functools
+
+from term_matcher import TermMatcher
+
+RULES_VERSION = 3
+
+# Named thresholds, shared by the rules below and the nutrition colours on the page
+THRESHOLDS = {
+    'sugar_high': 22.5,
+    'sugar_medium': 5,
+    'sugar_child_high': 10,
+    'fat_high': 17.5,
+    'fat_medium': 3,
+    'salt_high': 1.5,
+    'salt_infant': 0.8,
+    'salt_display_medium': 0.3,
+    'additives_many': 5,
+    'additives_child_many': 3,
+}
+
+# Features the rules can read: name -> (parser, product_info key[, nutriment key,
+# watched term or term category])
+FEATURES = {
+    'grade': ('text', 'nutrition_grade'),
+    'sugar': ('number', 'nutriments', 'sugars_100g'),
+    'fat': ('number', 'nutriments', 'fat_100g'),
+    'salt': ('number', 'nutriments', 'salt_100g'),
+    'additives': ('count', 'additives_tags'),
+    'palm_oil': ('mentions', 'ingredients', 'palm oil'),
+    'nova': ('integer', 'nova_group'),
+    'allergens': ('tag_terms', 'allergens', 'allergen'),
+}
+
+COMMON_ALLERGENS = [
+    'nuts', 'peanuts', 'milk', 'eggs', 'fish', 'shellfish', 'soy', 'wheat', 'gluten',
+    'celery', 'mustard', 'sesame', 'sulphites', 'lupin', 'molluscs',
+]
+
+# Terms looked for in ingredient text and allergen tags, by category. They are all
+# matched in one pass (see term_matcher.py), so the list can grow freely
+WATCHED_TERMS = {
+    'allergen': COMMON_ALLERGENS,
+    'oil': [
+        'palm oil', 'palm fat', 'palm kernel', 'palmolein', 'palm stearin', 'coconut oil', 'coconut fat',
+        'rapeseed oil', 'canola oil', 'sunflower oil', 'soybean oil', 'cottonseed oil', 'shea butter',
+        'hydrogenated', 'partially hydrogenated', 'interesterified',
+    ],
+    'sweetener': [
+        'aspartame', 'sucralose', 'acesulfame', 'saccharin', 'cyclamate', 'neotame', 'advantame',
+        'steviol', 'stevia', 'sorbitol', 'mannitol', 'maltitol', 'xylitol', 'erythritol', 'isomalt',
+        'lactitol', 'polydextrose', 'glucose-fructose syrup', 'fructose-glucose syrup',
+        'high fructose corn syrup', 'corn syrup', 'invert sugar', 'dextrose', 'maltodextrin',
+        'e420', 'e421', 'e950', 'e951', 'e952', 'e953', 'e954', 'e955', 'e957', 'e959', 'e960',
+        'e961', 'e962', 'e965', 'e966', 'e967', 'e968', 'e969',
+    ],
+    'colour': [
+        'tartrazine', 'quinoline yellow', 'sunset yellow', 'carmoisine', 'azorubine', 'ponceau',
+        'allura red', 'erythrosine', 'patent blue', 'indigotine', 'brilliant blue', 'caramel colour',
+        'titanium dioxide', 'carmine', 'cochineal',
+        'e102', 'e104', 'e110', 'e120', 'e122', 'e123', 'e124', 'e127', 'e129', 'e131', 'e132',
+        'e133', 'e150c', 'e150d', 'e151', 'e155', 'e171',
+    ],
+    'preservative': [
+        'sodium nitrite', 'potassium nitrite', 'sodium nitrate', 'potassium nitrate', 'sodium benzoate',
+        'potassium benzoate', 'benzoic acid', 'potassium sorbate', 'sorbic acid', 'sulphur dioxide',
+        'sodium metabisulphite', 'bha', 'bht', 'tbhq', 'propyl gallate',
+        'e200', 'e202', 'e210', 'e211', 'e212', 'e220', 'e223', 'e224', 'e249', 'e250', 'e251',
+        'e252', 'e310', 'e319', 'e320', 'e321',
+    ],
+    'additive': [
+        'monosodium glutamate', 'disodium inosinate', 'disodium guanylate', 'carrageenan',
+        'polysorbate', 'carboxymethyl cellulose', 'sodium phosphate', 'phosphoric acid',
+        'mono- and diglycerides', 'emulsifier', 'flavour enhancer', 'artificial flavour',
+        'modified starch', 'xanthan gum', 'guar gum', 'soy lecithin',
+        'e338', 'e339', 'e340', 'e341', 'e407', 'e433', 'e435', 'e450', 'e451', 'e452', 'e466',
+        'e471', 'e472', 'e476', 'e481', 'e621', 'e627', 'e631', 'e635',
+    ],
+}
+
+INFANTS = 'Infants (0-12 months)'
+YOUNG_CHILDREN = 'Young children (1-3 years)'
+CHILDREN = 'Children (4-8 years)'
+TEENAGERS = 'Teenagers (14-18 years)'
+ADULTS = 'Adults (19-64 years)'
+ELDERLY = 'Elderly (65+ years)'
+PREGNANT = 'Pregnant women'
+
+# Each rule reads one feature and applies the first band that matches. A band may
+# test 'above' (value > threshold), 'equals' or 'in'; a band without a test always
+# matches. Health bands add a 'positive' or 'negative' message and may set a
+# 'rating' ('Poor' beats 'Good' beats the default 'Average'); age bands add
+# 'not_suitable' groups and a 'reason'. Messages are formatted with the features.
+RULES = [
+    {'target': 'health', 'feature': 'grade', 'bands': [
+        {'in': ('a', 'b'), 'positive': 'Good nutrition grade ({grade_upper})', 'rating': 'Good'},
+        {'equals': 'c', 'positive': 'Average nutrition grade ({grade_upper})'},
+        {'negative': 'Poor nutrition grade ({grade_upper})', 'rating': 'Poor'},
+    ]},
+    {'target': 'health', 'feature': 'sugar', 'bands': [
+        {'above': 'sugar_high', 'negative': 'High sugar content ({sugar}g per 100g)', 'rating': 'Poor'},
+        {'above': 'sugar_medium', 'negative': 'Medium sugar content ({sugar}g per 100g)'},
+        {'positive': 'Low sugar content ({sugar}g per 100g)'},
+    ]},
+    {'target': 'health', 'feature': 'fat', 'bands': [
+        {'above': 'fat_high', 'negative': 'High fat content ({fat}g per 100g)', 'rating': 'Poor'},
+        {'above': 'fat_medium', 'negative': 'Medium fat content ({fat}g per 100g)'},
+        {'positive': 'Low fat content ({fat}g per 100g)'},
+    ]},
+    {'target': 'health', 'feature': 'additives', 'bands': [
+        {'above': 'additives_many', 'negative': 'Contains many additives ({additives})', 'rating': 'Poor'},
+        {'above': 0, 'negative': 'Contains some additives ({additives})'},
+        {'positive': 'No additives'},
+    ]},
+    {'target': 'health', 'feature': 'palm_oil', 'bands': [
+        {'equals': True, 'negative': 'Contains palm oil'},
+    ]},
+    {'target': 'health', 'feature': 'nova', 'bands': [
+        {'equals': 4, 'negative': 'Ultra-processed food (NOVA group 4)', 'rating': 'Poor'},
+        {'equals': 3, 'negative': 'Processed food (NOVA group 3)'},
+        {'in': (1, 2), 'positive': 'Minimally processed food (NOVA group {nova})', 'rating': 'Good'},
+    ]},
+    {'target': 'age', 'feature': 'allergens', 'bands': [
+        {'above': 0, 'not_suitable': [INFANTS, 'people with allergies to: {allergen_tags}'],
+         'reason': 'Contains allergens: {allergen_tags}'},
+    ]},
+    {'target': 'age', 'feature': 'allergens', 'bands': [
+        {'above': 1, 'not_suitable': [YOUNG_CHILDREN]},
+    ]},
+    {'target': 'age', 'feature': 'sugar', 'bands': [
+        {'above': 'sugar_child_high', 'not_suitable': [CHILDREN, INFANTS, YOUNG_CHILDREN, 'people with diabetes'],
+         'reason': 'High sugar content ({sugar}g per 100g)'},
+        {'above': 'sugar_medium', 'not_suitable': [INFANTS]},
+    ]},
+    {'target': 'age', 'feature': 'salt', 'bands': [
+        {'above': 'salt_high', 'not_suitable': [ELDERLY, INFANTS, 'people with hypertension'],
+         'reason': 'High salt content ({salt}g per 100g)'},
+        {'above': 'salt_infant', 'not_suitable': [INFANTS]},
+    ]},
+    {'target': 'age', 'feature': 'additives', 'bands': [
+        {'above': 'additives_child_many', 'not_suitable': [PREGNANT, INFANTS, YOUNG_CHILDREN],
+         'reason': 'Contains many additives'},
+    ]},
+    {'target': 'age', 'feature': 'nova', 'bands': [
+        {'equals': 4, 'not_suitable': [INFANTS, YOUNG_CHILDREN, PREGNANT],
+         'reason': 'Highly processed food (NOVA group {nova})'},
+    ]},
+]
+
+# What is said when no rule fired
+HEALTH_FALLBACK = 'Limited information available for detailed assessment'
+AGE_NO_CONCERNS = ('all age groups', 'No specific concerns identified')
+AGE_RESTRICTED_SUITABLE = [TEENAGERS, ADULTS]
+AGE_LAST_RESORT = ADULTS
+
+# Nutrients coloured on the page: high/medium name thresholds, and for fibre and
+# protein more is better
+NUTRIENT_DISPLAY = [
+    {'name': 'Energy', 'key': 'energy-kcal_100g', 'unit': 'kcal', 'high': 400, 'medium': 200},
+    {'name': 'Fat', 'key': 'fat_100g', 'unit': 'g', 'high': 'fat_high', 'medium': 'fat_medium'},
+    {'name': 'Saturated Fat', 'key': 'saturated-fat_100g', 'unit': 'g', 'high': 5, 'medium': 1.5},
+    {'name': 'Sugars', 'key': 'sugars_100g', 'unit': 'g', 'high': 'sugar_high', 'medium': 'sugar_medium'},
+    {'name': 'Salt', 'key': 'salt_100g', 'unit': 'g', 'high': 'salt_high', 'medium': 'salt_display_medium'},
+    {'name': 'Fiber', 'key': 'fiber_100g', 'unit': 'g', 'high': 6, 'medium': 3, 'higher_is_better': True},
+    {'name': 'Proteins', 'key': 'proteins_100g', 'unit': 'g', 'high': 20, 'medium': 10, 'higher_is_better': True},
+]
+
+
+# E-numbers and short terms are reported only where they stand alone: 'e1200' is
+# not 'e120', nor 'doughnuts' 'nuts'. The rules keep plain substring matching
+E_NUMBER = re.compile(r'e\d{3}[a-z]?')
+term_matcher = TermMatcher(
+    {term: category for category, terms in WATCHED_TERMS.items() for term in terms},
+    bounded=[term for terms in WATCHED_TERMS.values() for term in terms
+             if len(term) <= 4 or E_NUMBER.fullmatch(term)],
+)
+# Part of every product ETag, so editing the terms changes the tags without a
+# RULES_VERSION bump
+WATCHED_TERMS_DIGEST = hashlib.blake2b(
+    json.dumps(WATCHED_TERMS, sort_keys=True).encode('utf-8'), digest_size=4
+).hexdigest()
+
+
+def _threshold(value):
+    return THRESHOLDS[value] if isinstance(value, str) else value
+
+
+def _parse_number(value):
+    # Same coercion the assessments always used: missing or empty counts as 0
+    try:
+        return float(value or 0)
+    except (ValueError, TypeError):
+        return None
+
+
+def _parse_integer(value):
+    try:
+        return int(value)
+    except (ValueError, TypeError):
+        return None
+
+
+# Ingredient lists and tags repeat across requests for popular products, so each
+# distinct string is scanned once
+@functools.lru_cache(maxsize=2048)
+def text_terms(text):
+    """The watched terms in an ingredient text, as {term: category}"""
+    return term_matcher.terms_in(text)
+
+
+@functools.lru_cache(maxsize=8192)
+def tag_terms(tag):
+    """The watched terms in one tag such as 'en:peanuts', as {term: category}"""
+    return term_matcher.terms_in(tag)
+
+
+@functools.lru_cache(maxsize=2048)
+def text_words(text):
+    """The watched terms that stand alone where they must, in an ingredient text or tag"""
+    return term_matcher.words_in(text)
+
+
+def _mentions(text, term):
+    return isinstance(text, str) and term in text_terms(text)
+
+
+def _count_tag_terms(tags, category):
+    # Number of (tag, term) pairs where a term of the category appears in the tag
+    count = 0
+    for tag in tags:
+        for term_category in tag_terms(tag).values():
+            if term_category == category:
+                count += 1
+    return count
+
+
+def watched_terms(product_info):
+    """Every watched term in a product's ingredients and allergen tags, with its category"""
+    hits = []
+    ingredients = product_info.get('ingredients', '')
+    if isinstance(ingredients, str):
+        hits.extend({'term': term, 'category': category, 'field': 'ingredients'}
+                    for term, category in text_words(ingredients).items())
+    for tag in product_info.get('allergens', []):
+        hits.extend({'term': term, 'category': category, 'field': 'allergens', 'tag': tag}
+                    for term, category in text_words(tag).items())
+    return hits
+
+
+def _feature_expression(spec):
+    # Python expression that parses one feature out of `product_info`
+    parser, key = spec[0], spec[1]
+    if parser == 'number':
+        return f'_parse_number(section_{key}.get({spec[2]!r}, 0))'
+    if parser == 'integer':
+        return f'_parse_integer(product_info.get({key!r}, 0))'
+    if parser == 'count':
+        return f'len(product_info.get({key!r}, []))'
+    if parser == 'text':
+        return f'(product_info.get({key!r}, \'\') or None)'
+    if parser == 'mentions':
+        if spec[2] not in term_matcher.terms:
+            raise ValueError(f'{spec[2]!r} is not a watched term')
+        return f'_mentions(product_info.get({key!r}, \'\'), {spec[2]!r})'
+    if parser == 'tag_terms':
+        return f'_count_tag_terms(product_info.get({key!r}, []), {spec[2]!r})'
+    raise ValueError(f'Unknown feature parser {parser!r}')
+
+
+# Names messages may use besides the features, and how to compute them when needed
+MESSAGE_VALUES = {
+    'grade_upper': "(f_grade.upper() if isinstance(f_grade, str) else f_grade)",
+    'allergen_tags': "', '.join(product_info.get('allergens', []))",
+}
+
+
+def _message_expression(template):
+    names = [field for _, field, _, _ in string.Formatter().parse(template) if field]
+    if not names:
+        return repr(template)
+    arguments = ', '.join(f'{name}={MESSAGE_VALUES.get(name, "f_" + name)}' for name in names)
+    return f'{template!r}.format({arguments})'
+
+
+def _band_test(band, variable):
+    if 'above' in band:
+        return f'{variable} > {_threshold(band["above"])!r}'
+    if 'equals' in band:
+        return f'{variable} == {band["equals"]!r}'
+    if 'in' in band:
+        return f'{variable} in {tuple(band["in"])!r}'
+    return None
+
+
+def _outcome_lines(target, band, indent):
+    lines = []
+    if target == 'health':
+        if 'positive' in band:
+            lines.append(f'positives.append({_message_expression(band["positive"])})')
+        if 'negative' in band:
+            lines.append(f'negatives.append({_message_expression(band["negative"])})')
+        if band.get('rating') == 'Poor':
+            lines.append('poor = True')
+        elif band.get('rating') == 'Good':
+            lines.append('good = True')
+    else:
+        groups = ', '.join(_message_expression(group) for group in band.get('not_suitable', ()))
+        if groups:
+            lines.append(f'not_suitable.extend(({groups},))')
+        if 'reason' in band:
+            lines.append(f'reasons.append({_message_expression(band["reason"])})')
+    return [indent + line for line in lines or ['pass']]
+
+
+_PROLOGUE = """\
+    positives = []
+    negatives = []
+    poor = good = False
+    not_suitable = []
+    reasons = []
+"""
+
+_EPILOGUE = """\
+    if not positives and not negatives:
+        positives.append(HEALTH_FALLBACK)
+    assessment = {
+        'overall_rating': 'Poor' if poor else 'Good' if good else 'Average',
+        'positives': positives,
+        'negatives': negatives,
+    }
+    # Remove duplicates, keeping first-seen order so the same product always serialises the same
+    not_suitable = list(dict.fromkeys(not_suitable))
+    if not not_suitable:
+        suitable = [AGE_NO_CONCERNS[0]]
+        reasons.append(AGE_NO_CONCERNS[1])
+    else:
+        suitable = [group for group in AGE_RESTRICTED_SUITABLE if group not in not_suitable]
+    if not suitable:
+        suitable.append(AGE_LAST_RESORT)
+    return assessment, {'suitable_for': suitable, 'not_suitable_for': not_suitable, 'reasons': reasons}
+"""
+
+
+class RuleEngine:
+    """A rule table compiled into straight-line Python.
+
+    evaluate(product_info) parses every feature once and runs each rule's bands
+    as one if/elif chain, all inside a single generated function; it returns
+    (health_assessment, age_recommendations). The generated code is kept in
+    `source` for inspection.
+    """
+
+    def __init__(self, version, source, evaluate):
+        self.version = version
+        self.source = source
+        self.evaluate = evaluate
+
+
+def compile_rules(rules=RULES, features=FEATURES, version=RULES_VERSION):
+    """Generate and compile the evaluator for a rule table"""
+    feature_names = []
+    for rule in rules:
+        if rule['feature'] not in feature_names:
+            feature_names.append(rule['feature'])
+    # Nested sections such as nutriments are looked up once, not once per nutrient
+    sections = sorted({features[name][1] for name in feature_names if features[name][0] == 'number'})
+    lines = ['def evaluate(product_info):']
+    lines.extend(f'    section_{key} = product_info.get({key!r}, {{}})' for key in sections)
+    lines.extend(f'    f_{name} = {_feature_expression(features[name])}' for name in feature_names)
+    lines.append(_PROLOGUE.rstrip())
+
+    for rule in rules:
+        variable = f'f_{rule["feature"]}'
+        lines.append(f'    if {variable} is not None:')
+        keyword = 'if'
+        for band in rule['bands']:
+            test = _band_test(band, variable)
+            if test is None:
+                # A band without a test ends the chain
+                lines.append('        else:' if keyword == 'elif' else '        if True:')
+            else:
+                lines.append(f'        {keyword} {test}:')
+            lines.extend(_outcome_lines(rule['target'], band, '            '))
+            if test is None:
+                break
+            keyword = 'elif'
+    lines.append(_EPILOGUE)
+
+    source = '\n'.join(lines)
+    namespace = dict(globals())
+    exec(compile(source, f'<health rules v{version}>', 'exec'), namespace)
+    return RuleEngine(version, source, namespace['evaluate'])
+
+
+def nutrient_display():
+    """The page's nutrient colour bands with thresholds resolved"""
+    return [
+        {**nutrient, 'high': _threshold(nutrient['high']), 'medium': _threshold(nutrient['medium'])}
+        for nutrient in NUTRIENT_DISPLAY
+    ]
@@ -0,0 +1,108 @@
+"""Prometheus metrics for the scanner, served at /metrics.
+
+Under gunicorn every worker is its own process, so the metrics are written to
+files in PROMETHEUS_MULTIPROC_DIR and summed across workers when scraped.
+gunicorn.conf.py sets that directory up before the app is imported and cleans
+up after dead workers. Without the variable (``python app.py``), the metrics
+live in this process only.
+"""
+import os
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+# Upstream calls are bounded by OFF_TIMEOUT, and /search adds little on top of them
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+search_requests = Counter(
+    'scanner_search_requests_total', 'Product searches by result', ['result']
+)
+search_latency = Histogram(
+    'scanner_search_latency_seconds', 'Time to answer a product search', ['result'], buckets=LATENCY_BUCKETS
+)
+search_response_bytes = Histogram(
+    'scanner_search_response_bytes', 'Size of the /search JSON body before compression', buckets=SIZE_BUCKETS
+)
+lookup_sources = Counter(
+    'scanner_lookup_source_total',
+    'Product lookups by where they were answered: cache, stale (a cached copy past its TTL), local '
+    '(offline database) or mirrors; '
+    'lookups that joined an in-flight fetch for the same barcode are not counted',
+    ['source'],
+)
+upstream_requests = Counter(
+    'scanner_upstream_requests_total',
+    'Requests to each mirror by outcome: found, not_found, error, timeout, throttled (429/503), '
+    'deadline (cut short by the lookup\'s deadline), skipped while its circuit was open, '
+    'or shed by the outbound governor',
+    ['mirror', 'outcome'],
+)
+upstream_responses = Counter(
+    'scanner_upstream_responses_total', 'HTTP status codes returned by each mirror', ['mirror', 'status']
+)
+upstream_latency = Histogram(
+    'scanner_upstream_latency_seconds', 'Time for one mirror request', ['mirror'], buckets=LATENCY_BUCKETS
+)
+upstream_response_bytes = Histogram(
+    'scanner_upstream_response_bytes', 'Size of each mirror response body', ['mirror'], buckets=SIZE_BUCKETS
+)
+upstream_shed = Counter(
+    'scanner_upstream_shed_total',
+    'Mirror requests the outbound governor refused to start: throttled (after a 429/503), '
+    'queue_full or queue_timeout',
+    ['mirror', 'reason'],
+)
+mirror_fallthrough = Counter(
+    'scanner_mirror_fallthrough_total',
+    'Upstream lookups by the ranking position (0 = first choice) of the mirror that had the product, '
+    'with depth "none" when no mirror had it',
+    ['depth', 'mirror'],
+)
+
+warmup_products = Counter(
+    'scanner_warmup_products_total',
+    'Popular products handled by the boot-time cache warm-up: cached (already on disk), fetched, not_found, '
+    'failed, or skipped by a worker that waited for another to fetch them',
+    ['outcome'],
+)
+
+
+def observe_search(result, latency, size):
+    """Record one /search answer's result, latency and size"""
+    # result is found, not_modified, not_found, unavailable, timed_out or invalid
+    search_requests.labels(result).inc()
+    search_latency.labels(result).observe(latency)
+    search_response_bytes.observe(size)
+
+
+def observe_upstream(mirror, outcome, status=None, latency=None, size=0):
+    """Record one request to a mirror; status and latency are None when no response came back"""
+    upstream_requests.labels(mirror, outcome).inc()
+    if status is not None:
+        upstream_responses.labels(mirror, str(status)).inc()
+        upstream_response_bytes.labels(mirror).observe(size)
+    if latency is not None:
+        upstream_latency.labels(mirror).observe(latency)
+
+
+def observe_fallthrough(depth, mirror):
+    """Record which ranking position answered an upstream lookup, or (None, None) for a miss"""
+    mirror_fallthrough.labels('none' if depth is None else str(depth), mirror or 'none').inc()
+
+
+def render():
+    """The current metrics in the Prometheus text format, and their content type"""
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
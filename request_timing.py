@@ -0,0 +1,113 @@
+"""Per-request phase timings for the Server-Timing header and a sampled log line.
+
+A request handler calls start(); code anywhere below it, including threads
+started with contextvars.copy_context().run and asyncio tasks, adds phases with
+phase() or record(). Outside a timed request both are no-ops. Each phase costs
+two perf_counter() calls and a dict update, so it can stay on in production.
+"""
+import json
+import time
+import random
+import logging
+import threading
+import contextvars
+
+_current = contextvars.ContextVar('request_timing', default=None)
+
+timing_log = logging.getLogger('scanner.timing')
+
+
+class RequestTiming:
+    """Durations of the phases of one request, summed by name, in the order each first ran"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = {}
+        # Hedged lookups add phases from several threads at once
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds, description=None):
+        with self._lock:
+            phase = self.phases.get(name)
+            if phase is None:
+                self.phases[name] = [seconds, description]
+            else:
+                phase[0] += seconds
+                if description is not None:
+                    phase[1] = description
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def header(self):
+        """The Server-Timing header value, ending with the request's total so far"""
+        entries = []
+        for name, (seconds, description) in list(self.phases.items()):
+            entry = f'{name};dur={seconds * 1000:.2f}'
+            if description is not None:
+                entry += f';desc="{description}"'
+            entries.append(entry)
+        entries.append(f'total;dur={self.elapsed() * 1000:.2f}')
+        return ', '.join(entries)
+
+    def milliseconds(self):
+        return {name: round(seconds * 1000, 3) for name, (seconds, _) in list(self.phases.items())}
+
+
+def start():
+    """Begin timing the current request and return its RequestTiming"""
+    timing = RequestTiming()
+    _current.set(timing)
+    return timing
+
+
+def finish():
+    """Stop attributing phases to the current request; worker threads outlive requests"""
+    _current.set(None)
+
+
+def record(name, seconds, description=None):
+    """Add a measured duration to the current request's timing, if there is one"""
+    timing = _current.get()
+    if timing is not None:
+        timing.add(name, seconds, description)
+
+
+class phase:
+    """Time the enclosed block as the named phase of the current request"""
+
+    # A plain class rather than @contextmanager: this runs several times per request
+    __slots__ = ('name', 'timing', 'started')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.timing = _current.get()
+        if self.timing is not None:
+            self.started = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        if self.timing is not None:
+            self.timing.add(self.name, time.perf_counter() - self.started)
+
+
+def setup_log(sample_rate):
+    """Send sampled timing lines, one JSON object each, to stderr when sample_rate > 0"""
+    if sample_rate > 0 and not timing_log.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        timing_log.addHandler(handler)
+        timing_log.setLevel(logging.INFO)
+        timing_log.propagate = False
+
+
+def log(timing, sample_rate, **fields):
+    """Write one request's phases as a JSON log line, for a sample_rate fraction of requests"""
+    if sample_rate <= 0 or random.random() >= sample_rate:
+        return
+    timing_log.info(json.dumps({
+        **fields,
+        'total_ms': round(timing.elapsed() * 1000, 3),
+        'phases_ms': timing.milliseconds(),
+    }))
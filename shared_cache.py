@@ -0,0 +1,192 @@
+"""A product cache in one memory-mapped file, shared by every worker on the host.
+
+The file is a header page followed by fixed-size slots, grouped in sets of
+SET_SIZE. A barcode's hash picks its set and the entry may sit in any slot of
+it; a full set evicts its oldest entry. Each slot holds the barcode and its
+product JSON, so all workers read the same copy and none keeps its own.
+
+Readers take no lock. Every slot starts with a sequence number that a writer
+makes odd before touching the slot and even again afterwards; a reader copies
+the slot out and retries if the number was odd or changed meanwhile (a
+seqlock). A CRC of the key and payload also catches a read torn some other
+way. Writers lock their set's byte range with fcntl, which excludes other
+processes, and take a thread lock first, since fcntl locks belong to the
+process rather than the thread.
+"""
+import os
+import mmap
+import zlib
+import fcntl
+import struct
+import threading
+
+MAGIC = b'SCNPC01\0'
+# magic, slot count, slot size, set size
+HEADER = struct.Struct('<8sIII')
+# Slots in use, after the layout fields in the header page and updated under its lock
+ENTRIES = struct.Struct('<Q')
+ENTRIES_OFFSET = 64
+HEADER_SIZE = mmap.PAGESIZE
+# sequence, fetched_at, crc of key and data, data length, key length
+SLOT = struct.Struct('<QdIIH6x')
+SEQUENCE = struct.Struct('<Q')
+SET_SIZE = 4
+READ_ATTEMPTS = 64
+
+
+class SharedProductCache:
+    """Fixed-slot, set-associative cache of product JSON in a shared memory-mapped file.
+
+    Entries are (fetched_at, JSON bytes) keyed on the barcode; ages and
+    decoding are left to the caller. Entries that do not fit in a slot are
+    not stored. The first process to open the file sizes it; a file laid out
+    for different settings raises ValueError rather than being overwritten
+    under another server's workers.
+    """
+
+    def __init__(self, path, slots, slot_size):
+        if slot_size <= SLOT.size or slots < SET_SIZE:
+            raise ValueError(f'Shared cache needs at least {SET_SIZE} slots of more than {SLOT.size} bytes')
+        self.path = path
+        self.sets = slots // SET_SIZE
+        self.slots = self.sets * SET_SIZE
+        self.slot_size = slot_size
+        self.size = HEADER_SIZE + self.slots * slot_size
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, HEADER_SIZE, 0)
+            try:
+                self._check_layout()
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, HEADER_SIZE, 0)
+            self._map = mmap.mmap(self._fd, self.size)
+        except BaseException:
+            os.close(self._fd)
+            raise
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self.writes = 0
+        self.evictions = 0
+        self.oversized = 0
+        # Bumped without a lock by concurrent readers, so only roughly right
+        self.read_retries = 0
+
+    def get(self, barcode):
+        """Return (fetched_at, JSON bytes) for a barcode, or None if no slot holds it"""
+        shared = self._mapping()
+        key = barcode.encode()
+        for offset in self._set_offsets(key):
+            for _ in range(READ_ATTEMPTS):
+                sequence, fetched_at, crc, data_length, key_length = SLOT.unpack_from(shared, offset)
+                if sequence & 1:
+                    # A writer is halfway through this slot
+                    self.read_retries += 1
+                    os.sched_yield()
+                    continue
+                start = offset + SLOT.size
+                if key_length != len(key) or shared[start:start + key_length] != key:
+                    break
+                if key_length + data_length > self.slot_size - SLOT.size:
+                    break
+                data = shared[start + key_length:start + key_length + data_length]
+                if SEQUENCE.unpack_from(shared, offset)[0] != sequence or zlib.crc32(data, zlib.crc32(key)) != crc:
+                    self.read_retries += 1
+                    continue
+                return fetched_at, data
+        return None
+
+    def set(self, barcode, fetched_at, data):
+        """Store JSON bytes for a barcode unless a newer entry is there; False if they do not fit in a slot"""
+        key = barcode.encode()
+        shared = self._mapping()
+        if SLOT.size + len(key) + len(data) > self.slot_size:
+            with self._lock:
+                self.oversized += 1
+            return False
+        offsets = self._set_offsets(key)
+        with self._lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, SET_SIZE * self.slot_size, offsets[0])
+            try:
+                # With the set locked no other writer can change these slots, so plain reads are safe
+                target = empty = oldest = None
+                for offset in offsets:
+                    _, slot_fetched_at, _, _, key_length = SLOT.unpack_from(shared, offset)
+                    start = offset + SLOT.size
+                    if key_length == len(key) and shared[start:start + key_length] == key:
+                        if slot_fetched_at > fetched_at:
+                            return True
+                        target = offset
+                        break
+                    if key_length == 0:
+                        empty = offset if empty is None else empty
+                    elif oldest is None or slot_fetched_at < oldest[0]:
+                        oldest = (slot_fetched_at, offset)
+                if target is None and empty is not None:
+                    target = empty
+                    self._add_entry(shared)
+                elif target is None:
+                    target = oldest[1]
+                    self.evictions += 1
+                self._write(shared, target, key, fetched_at, data)
+                self.writes += 1
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, SET_SIZE * self.slot_size, offsets[0])
+        return True
+
+    def stats(self):
+        """Return this process's write counters and the entries held for all of them"""
+        # Scanning the slots instead would fault in every page of the file
+        return {
+            'shared_path': self.path,
+            'shared_entries': ENTRIES.unpack_from(self._mapping(), ENTRIES_OFFSET)[0],
+            'shared_slots': self.slots,
+            'shared_slot_size': self.slot_size,
+            'shared_bytes': self.size,
+            'shared_writes': self.writes,
+            'shared_evictions': self.evictions,
+            'shared_oversized': self.oversized,
+            'shared_read_retries': self.read_retries,
+        }
+
+    def _set_offsets(self, key):
+        # crc32 rather than hash(): every process must pick the same set
+        first = HEADER_SIZE + (zlib.crc32(key) % self.sets) * SET_SIZE * self.slot_size
+        return [first + way * self.slot_size for way in range(SET_SIZE)]
+
+    def _add_entry(self, shared):
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, HEADER_SIZE, 0)
+        try:
+            ENTRIES.pack_into(shared, ENTRIES_OFFSET, ENTRIES.unpack_from(shared, ENTRIES_OFFSET)[0] + 1)
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, HEADER_SIZE, 0)
+
+    @staticmethod
+    def _write(shared, offset, key, fetched_at, data):
+        # Odd while the slot is being written, so readers skip or retry it; a writer
+        # that died halfway left it odd, which this write also repairs
+        sequence = SEQUENCE.unpack_from(shared, offset)[0] | 1
+        SEQUENCE.pack_into(shared, offset, sequence)
+        start = offset + SLOT.size
+        shared[start:start + len(key) + len(data)] = key + data
+        SLOT.pack_into(shared, offset, sequence, fetched_at, zlib.crc32(data, zlib.crc32(key)), len(data), len(key))
+        SEQUENCE.pack_into(shared, offset, sequence + 1)
+
+    def _mapping(self):
+        # A MAP_SHARED mapping stays shared across a fork, but the thread lock may
+        # have been held by a thread the child does not have
+        if self._pid != os.getpid():
+            self._lock = threading.Lock()
+            self._pid = os.getpid()
+        return self._map
+
+    def _check_layout(self):
+        header = HEADER.pack(MAGIC, self.slots, self.slot_size, SET_SIZE)
+        size = os.fstat(self._fd).st_size
+        if size == 0:
+            # New file: on tmpfs the slots take no memory until they are written
+            os.ftruncate(self._fd, self.size)
+            os.pwrite(self._fd, header, 0)
+        elif size != self.size or os.pread(self._fd, HEADER.size, 0) != header:
+            raise ValueError(
+                f'{self.path} holds a shared cache with a different layout; remove it or use another path'
+            )
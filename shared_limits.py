@@ -0,0 +1,105 @@
+"""Mirror rate limits and Retry-After pauses shared by every worker on the host.
+
+One small memory-mapped file holds a record per mirror: the token bucket
+(tokens and when it was last refilled) and the time until which the mirror is
+throttled. A worker that gets a 429 pauses the mirror for all of them, and the
+rate limit is spent by the host as a whole rather than by each worker.
+
+Times are time.monotonic() values, which on Linux and macOS count from the same
+point in every process on the host. A record is changed under an fcntl lock on
+its byte range, which excludes other processes; within a process the caller
+serialises access to a record, as MirrorGovernor does with its condition.
+"""
+import os
+import mmap
+import zlib
+import fcntl
+import struct
+
+MAGIC = b'SCNLIM01'
+# magic, mirror count, crc of the mirror names
+HEADER = struct.Struct('<8sII')
+# throttled until, tokens, refilled at
+RECORD = struct.Struct('<ddd8x')
+THROTTLED_UNTIL = struct.Struct('<d')
+
+
+class SharedMirrorLimits:
+    """Per-mirror token buckets and throttle deadlines in a shared memory-mapped file.
+
+    Mirrors are addressed by their index in the list given when opening. The
+    first process to open the file lays it out; a file laid out for other
+    mirrors raises ValueError rather than being overwritten under another
+    server's workers.
+    """
+
+    def __init__(self, path, mirrors):
+        self.path = path
+        self.mirrors = list(mirrors)
+        self.size = HEADER.size + len(self.mirrors) * RECORD.size
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, HEADER.size, 0)
+            try:
+                self._check_layout()
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, HEADER.size, 0)
+            self._map = mmap.mmap(self._fd, self.size)
+        except BaseException:
+            os.close(self._fd)
+            raise
+
+    def take_token(self, index, rate, burst, now):
+        """Take one of a mirror's tokens; 0 if one was taken, else seconds until one is due"""
+        offset = self._offset(index)
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, RECORD.size, offset)
+        try:
+            throttled_until, tokens, refilled_at = RECORD.unpack_from(self._map, offset)
+            if refilled_at == 0:
+                # A new record starts with a full bucket
+                tokens = burst
+            tokens = min(burst, tokens + max(0.0, now - refilled_at) * rate)
+            wait = 0.0
+            if tokens < 1:
+                wait = (1 - tokens) / rate
+            else:
+                tokens -= 1
+            RECORD.pack_into(self._map, offset, throttled_until, tokens, now)
+            return wait
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, RECORD.size, offset)
+
+    def tokens(self, index, rate, burst, now):
+        """The tokens a mirror's bucket holds at now, without taking any"""
+        _, tokens, refilled_at = RECORD.unpack_from(self._map, self._offset(index))
+        if refilled_at == 0:
+            return float(burst)
+        return min(burst, tokens + max(0.0, now - refilled_at) * rate)
+
+    def throttle(self, index, until):
+        """Take no requests to a mirror before until, unless a later pause is already set"""
+        offset = self._offset(index)
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, RECORD.size, offset)
+        try:
+            if until > THROTTLED_UNTIL.unpack_from(self._map, offset)[0]:
+                THROTTLED_UNTIL.pack_into(self._map, offset, until)
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, RECORD.size, offset)
+
+    def throttled_until(self, index):
+        """When a mirror takes requests again; a lockless read of one aligned double"""
+        return THROTTLED_UNTIL.unpack_from(self._map, self._offset(index))[0]
+
+    def _offset(self, index):
+        return HEADER.size + index * RECORD.size
+
+    def _check_layout(self):
+        header = HEADER.pack(MAGIC, len(self.mirrors), zlib.crc32('\0'.join(self.mirrors).encode()))
+        size = os.fstat(self._fd).st_size
+        if size == 0:
+            os.ftruncate(self._fd, self.size)
+            os.pwrite(self._fd, header, 0)
+        elif size != self.size or os.pread(self._fd, HEADER.size, 0) != header:
+            raise ValueError(
+                f'{self.path} holds mirror limits for other mirrors; remove it or use another path'
+            )
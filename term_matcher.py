@@ -0,0 +1,98 @@
+"""Aho-Corasick matcher for finding many watched terms in one pass.
+
+The automaton is built once from a {term: category} mapping. Scanning a string
+walks it character by character, and each character costs a single dict lookup
+however many terms are watched. Every occurrence of every term is reported,
+overlapping ones included: 'en:peanuts' hits both 'peanuts' and 'nuts'.
+Matching is by substring on the lowercased text, the same rule the old
+`in text.lower()` checks used. Terms passed as `bounded` must also stand alone
+in scan() and words_in(): a letter or digit on either side is not a hit, so
+'e1200' does not report 'e120'.
+"""
+from collections import deque
+
+
+class TermMatcher:
+    """Precompiled multi-pattern matcher over a fixed set of lowercase terms.
+
+    scan(text) returns every hit as (term, category, start); terms_in(text)
+    returns the distinct terms found by plain substring, and words_in(text)
+    the distinct terms found with `bounded` terms standing alone. All of them
+    lowercase `text` first.
+    """
+
+    def __init__(self, terms, bounded=()):
+        self.terms = [term.lower() for term in terms]
+        self.categories = [terms[term] for term in terms]
+        bounded = {term.lower() for term in bounded}
+        self._bounded = [term in bounded for term in self.terms]
+        # transitions[state] maps a character to the next state; a missing key means state 0
+        transitions = [{}]
+        outputs = [()]
+        for index, term in enumerate(self.terms):
+            state = 0
+            for char in term:
+                next_state = transitions[state].get(char)
+                if next_state is None:
+                    next_state = len(transitions)
+                    transitions[state][char] = next_state
+                    transitions.append({})
+                    outputs.append(())
+                state = next_state
+            outputs[state] += (index,)
+
+        # Breadth-first, fold each state's failure state into it so the walk never
+        # backtracks: every state ends up with a complete transition table and the
+        # outputs of all its suffixes
+        failure = [0] * len(transitions)
+        goto = [dict(children) for children in transitions]
+        queue = deque(transitions[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, child in transitions[state].items():
+                failure[child] = goto[failure[state]].get(char, 0) if state else 0
+                queue.append(child)
+            if state:
+                fallback = failure[state]
+                outputs[state] += outputs[fallback]
+                goto[state] = {**goto[fallback], **transitions[state]}
+        self._goto = goto
+        self._outputs = outputs
+
+    def __len__(self):
+        return len(self.terms)
+
+    def scan(self, text):
+        """Every (term, category, start) occurrence in text, in order of where each ends"""
+        return [(self.terms[index], self.categories[index], start) for index, start in self._hits(text)]
+
+    def terms_in(self, text):
+        """The distinct terms that occur in text, each with its category"""
+        goto, outputs = self._goto, self._outputs
+        found = set()
+        state = 0
+        for char in text.lower():
+            state = goto[state].get(char, 0)
+            if outputs[state]:
+                found.update(outputs[state])
+        return {self.terms[index]: self.categories[index] for index in sorted(found)}
+
+    def words_in(self, text):
+        """The distinct terms that occur in text, bounded ones only where they stand alone"""
+        found = {index for index, _ in self._hits(text)}
+        return {self.terms[index]: self.categories[index] for index in sorted(found)}
+
+    def _hits(self, text):
+        goto, outputs, terms, bounded = self._goto, self._outputs, self.terms, self._bounded
+        text = text.lower()
+        state = 0
+        for position, char in enumerate(text):
+            state = goto[state].get(char, 0)
+            for index in outputs[state]:
+                start = position + 1 - len(terms[index])
+                if not bounded[index] or _stands_alone(text, start, position + 1):
+                    yield index, start
+
+
+def _stands_alone(text, start, end):
+    return (start == 0 or not text[start - 1].isalnum()) and (end == len(text) or not text[end].isalnum())
@@ -0,0 +1,112 @@
+"""Test setup: the app is imported against a local stand-in for the Open Food Facts mirrors"""
+import os
+import sys
+import json
+import time
+import asyncio
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+PRODUCT = {'product_name': 'Test Spread', 'brands': 'Test', 'nutriments': {'sugars_100g': 56.3}}
+
+
+class FakeMirror(BaseHTTPRequestHandler):
+    """Answers every mirror's product URL the way the server's mode says"""
+
+    mode = 'ok'
+    delay = 0.0
+    # Seconds to wait before answering for particular barcodes, whatever the mode
+    delays = {}
+    hits = 0
+    # Parsed query string of every request, in arrival order
+    queries = []
+
+    def do_GET(self):
+        type(self).hits += 1
+        self.queries.append(parse_qs(urlsplit(self.path).query))
+        barcode = self.path.split('?')[0].rsplit('/', 1)[-1].split('.')[0]
+        time.sleep(self.delays.get(barcode, 0))
+        if self.mode == 'slow':
+            time.sleep(self.delay)
+        if self.mode == 'missing':
+            self.send_response(404)
+            self.end_headers()
+            return
+        if self.mode == 'error':
+            self.send_response(500)
+            self.end_headers()
+            return
+        if self.mode == 'throttled':
+            self.send_response(429)
+            self.send_header('Retry-After', '5')
+            self.end_headers()
+            return
+        body = json.dumps({'status': 1, 'product': PRODUCT}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Bound before the app is imported, since it reads its settings at import time
+mirror_server = ThreadingHTTPServer(('127.0.0.1', 0), FakeMirror)
+mirror_server.daemon_threads = True
+threading.Thread(target=mirror_server.serve_forever, daemon=True).start()
+
+os.environ.update({
+    'OFF_PRODUCT_URL': f'http://127.0.0.1:{mirror_server.server_port}/{{mirror}}/{{barcode}}.json',
+    'OFF_RETRIES': '0',
+    'PRODUCT_CACHE_DB': '',
+    'PRODUCT_CACHE_TTL': '60',
+    'PRODUCT_CACHE_MAX_STALE': '60',
+    'PRODUCT_CACHE_STALE_IF_ERROR': '3600',
+    'SHARED_CACHE_PATH': '',
+    'SHARED_LIMITS_PATH': '',
+    'LOCAL_PRODUCTS_DB': '',
+    'POPULARITY_DB': '',
+    'WARMUP_COUNT': '0',
+})
+
+
+@pytest.fixture
+def mirror(monkeypatch):
+    """The fake mirror, answering normally; each test gets fresh mirror health and governors"""
+    import app
+
+    monkeypatch.setattr(FakeMirror, 'mode', 'ok')
+    monkeypatch.setattr(FakeMirror, 'delay', 0.0)
+    monkeypatch.setattr(FakeMirror, 'delays', {})
+    monkeypatch.setattr(FakeMirror, 'hits', 0)
+    monkeypatch.setattr(FakeMirror, 'queries', [])
+    for priority, name in enumerate(app.OFF_MIRRORS):
+        monkeypatch.setitem(app.mirror_health, name, app.MirrorHealth(name, priority))
+        monkeypatch.setitem(app.mirror_governors, name, app.MirrorGovernor(
+            name, app.OFF_MIRROR_CONCURRENCY, app.OFF_MIRROR_RATE, app.OFF_MIRROR_BURST, app.OFF_QUEUE_SIZE,
+        ))
+    app.product_cache._entries.clear()
+    yield FakeMirror
+    app.product_cache._entries.clear()
+
+
+@pytest.fixture
+def run_async_app():
+    """Runs a coroutine function with an aiohttp test client for the async app, returning its result"""
+    from aiohttp.test_utils import TestClient, TestServer
+    import async_app
+
+    def run(test):
+        async def main():
+            async with TestClient(TestServer(async_app.create_app())) as client:
+                return await test(client)
+        return asyncio.run(main())
+    return run
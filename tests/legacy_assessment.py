@@ -0,0 +1,184 @@
+"""assess_health and get_age_recommendations as they were before bulk scoring and the rule table,
+kept verbatim as the reference the new engines must reproduce
+"""
+
+
+def assess_health(product_info):
+    """Assess the health aspects of the product"""
+    assessment = {
+        'overall_rating': 'Average',  # Default rating
+        'positives': [],
+        'negatives': []
+    }
+
+    # Check nutrition grade
+    nutrition_grade = product_info.get('nutrition_grade', '')
+    if nutrition_grade:
+        if nutrition_grade in ['a', 'b']:
+            assessment['positives'].append(f"Good nutrition grade ({nutrition_grade.upper()})")
+            assessment['overall_rating'] = 'Good'
+        elif nutrition_grade == 'c':
+            assessment['positives'].append(f"Average nutrition grade ({nutrition_grade.upper()})")
+        else:  # d or e
+            assessment['negatives'].append(f"Poor nutrition grade ({nutrition_grade.upper()})")
+            assessment['overall_rating'] = 'Poor'
+
+    # Check sugar content
+    nutriments = product_info.get('nutriments', {})
+    try:
+        sugar_100g = float(nutriments.get('sugars_100g', 0) or 0)
+        if sugar_100g > 22.5:
+            assessment['negatives'].append(f"High sugar content ({sugar_100g}g per 100g)")
+            assessment['overall_rating'] = 'Poor'
+        elif sugar_100g > 5:
+            assessment['negatives'].append(f"Medium sugar content ({sugar_100g}g per 100g)")
+        else:
+            assessment['positives'].append(f"Low sugar content ({sugar_100g}g per 100g)")
+    except (ValueError, TypeError):
+        pass
+
+    # Check fat content
+    try:
+        fat_100g = float(nutriments.get('fat_100g', 0) or 0)
+        if fat_100g > 17.5:
+            assessment['negatives'].append(f"High fat content ({fat_100g}g per 100g)")
+            assessment['overall_rating'] = 'Poor'
+        elif fat_100g > 3:
+            assessment['negatives'].append(f"Medium fat content ({fat_100g}g per 100g)")
+        else:
+            assessment['positives'].append(f"Low fat content ({fat_100g}g per 100g)")
+    except (ValueError, TypeError):
+        pass
+
+    # Check additives
+    additives = product_info.get('additives_tags', [])
+    if len(additives) > 5:
+        assessment['negatives'].append(f"Contains many additives ({len(additives)})")
+        assessment['overall_rating'] = 'Poor'
+    elif len(additives) > 0:
+        assessment['negatives'].append(f"Contains some additives ({len(additives)})")
+    else:
+        assessment['positives'].append("No additives")
+
+    # Check for palm oil
+    ingredients = product_info.get('ingredients', '')
+    if isinstance(ingredients, str) and 'palm oil' in ingredients.lower():
+        assessment['negatives'].append("Contains palm oil")
+
+    # Check NOVA group (food processing classification)
+    try:
+        nova_group = int(product_info.get('nova_group', 0))
+        if nova_group == 4:
+            assessment['negatives'].append("Ultra-processed food (NOVA group 4)")
+            assessment['overall_rating'] = 'Poor'
+        elif nova_group == 3:
+            assessment['negatives'].append("Processed food (NOVA group 3)")
+        elif nova_group in [1, 2]:
+            assessment['positives'].append(f"Minimally processed food (NOVA group {nova_group})")
+            if assessment['overall_rating'] != 'Poor':
+                assessment['overall_rating'] = 'Good'
+    except (ValueError, TypeError):
+        pass
+
+    # If no specific positives or negatives were found
+    if not assessment['positives'] and not assessment['negatives']:
+        assessment['positives'].append("Limited information available for detailed assessment")
+
+    return assessment
+
+def get_age_recommendations(product_info):
+    """Determine suitable age groups for the product"""
+    recommendations = {
+        'suitable_for': [],
+        'not_suitable_for': [],
+        'reasons': []
+    }
+
+    all_age_groups = [
+        'Infants (0-12 months)',
+        'Young children (1-3 years)',
+        'Children (4-8 years)',
+        'Older children (9-13 years)',
+        'Teenagers (14-18 years)',
+        'Adults (19-64 years)',
+        'Elderly (65+ years)',
+        'Pregnant women'
+    ]
+
+    # Check for allergens (common allergens make product unsuitable for infants and young children)
+    allergens = product_info.get('allergens', [])
+    common_allergens = ['nuts', 'peanuts', 'milk', 'eggs', 'fish', 'shellfish', 'soy', 'wheat', 'gluten', 'celery', 'mustard', 'sesame', 'sulphites', 'lupin', 'molluscs']
+
+    detected_allergens = []
+    for allergen in allergens:
+        for common in common_allergens:
+            if common in allergen.lower():
+                detected_allergens.append(common)
+
+    if detected_allergens:
+        recommendations['not_suitable_for'].append('Infants (0-12 months)')
+        recommendations['not_suitable_for'].append('people with allergies to: ' + ', '.join(allergens))
+        recommendations['reasons'].append(f"Contains allergens: {', '.join(allergens)}")
+        if len(detected_allergens) > 1:
+            recommendations['not_suitable_for'].append('Young children (1-3 years)')
+
+    # Check sugar content (high sugar is not good for children)
+    nutriments = product_info.get('nutriments', {})
+    try:
+        sugar_100g = float(nutriments.get('sugars_100g', 0) or 0)
+        if sugar_100g > 10:
+            recommendations['not_suitable_for'].extend(['Children (4-8 years)', 'Infants (0-12 months)', 'Young children (1-3 years)', 'people with diabetes'])
+            recommendations['reasons'].append(f"High sugar content ({sugar_100g}g per 100g)")
+        elif sugar_100g > 5:
+            recommendations['not_suitable_for'].extend(['Infants (0-12 months)'])
+    except (ValueError, TypeError):
+        # Sugar content not available or not a valid number
+        pass
+
+    # Check salt content (high salt is not good for elderly and infants)
+    try:
+        salt_100g = float(nutriments.get('salt_100g', 0) or 0)
+        if salt_100g > 1.5:
+            recommendations['not_suitable_for'].extend(['Elderly (65+ years)', 'Infants (0-12 months)', 'people with hypertension'])
+            recommendations['reasons'].append(f"High salt content ({salt_100g}g per 100g)")
+        elif salt_100g > 0.8:
+            recommendations['not_suitable_for'].extend(['Infants (0-12 months)'])
+    except (ValueError, TypeError):
+        # Salt content not available or not a valid number
+        pass
+
+    # Check additives (many additives not good for children and pregnant women)
+    additives = product_info.get('additives_tags', [])
+    if len(additives) > 3:
+        recommendations['not_suitable_for'].extend(['Pregnant women', 'Infants (0-12 months)', 'Young children (1-3 years)'])
+        recommendations['reasons'].append("Contains many additives")
+
+    # Check NOVA group (highly processed foods not good for certain groups)
+    try:
+        nova_group = int(product_info.get('nova_group', 0))
+        if nova_group == 4:  # Ultra-processed food
+            recommendations['not_suitable_for'].extend(['Infants (0-12 months)', 'Young children (1-3 years)', 'Pregnant women'])
+            recommendations['reasons'].append(f"Highly processed food (NOVA group {nova_group})")
+    except (ValueError, TypeError):
+        # Nova group not available or not a valid number
+        pass
+
+    # Remove duplicates
+    recommendations['not_suitable_for'] = list(set(recommendations['not_suitable_for']))
+
+    # Default recommendations if no specific issues found
+    if not recommendations['not_suitable_for']:
+        recommendations['suitable_for'].append('all age groups')
+        recommendations['reasons'].append("No specific concerns identified")
+    else:
+        # Add suitable age groups that aren't in the not_suitable list
+        age_groups = ['Teenagers (14-18 years)', 'Adults (19-64 years)']
+        for group in age_groups:
+            if group not in recommendations['not_suitable_for']:
+                recommendations['suitable_for'].append(group)
+
+    # If no suitable groups were found, add adults as default
+    if not recommendations['suitable_for']:
+        recommendations['suitable_for'].append('Adults (19-64 years)')
+
+    return recommendations
@@ -0,0 +1,78 @@
+"""Admin endpoints, and the async app serving every route the Flask app does"""
+import threading
+
+import pytest
+
+import app
+
+
+def flask_routes():
+    return {(rule.rule.replace('<name>', '{name}'), method)
+            for rule in app.app.url_map.iter_rules() if rule.endpoint != 'static'
+            for method in rule.methods - {'HEAD', 'OPTIONS'}}
+
+
+def test_async_app_serves_the_same_routes():
+    import async_app
+    routes = {(route.resource.canonical, route.method)
+              for route in async_app.create_app().router.routes() if route.method != 'HEAD'}
+    assert routes == flask_routes()
+
+
+@pytest.mark.parametrize('path', ['/admin/mirrors', '/admin/pool', '/admin/local-products', '/admin/cache',
+                                  '/admin/popularity'])
+def test_sync_and_async_admin_endpoints_agree(mirror, run_async_app, path):
+    client = app.app.test_client()
+    client.get('/search?barcode=3017620422003')
+
+    async def admin(async_client):
+        await async_client.get('/search?barcode=5449000000996')
+        response = await async_client.get(path)
+        assert response.status == 200
+        return await response.json()
+
+    sync_body = client.get(path).get_json()
+    async_body = run_async_app(admin)
+    assert type(sync_body) is type(async_body)
+    assert sorted(sync_body) == sorted(async_body)
+
+
+def test_mirror_report_lists_every_mirror_in_ranking_order(mirror):
+    app.mirror_health['uk'].record('found', 0.01)
+    body = app.app.test_client().get('/admin/mirrors').get_json()
+    assert body['ranking'][0] == 'uk'
+    assert [entry['mirror'] for entry in body['mirrors']] == body['ranking']
+
+
+def test_async_pool_counts_requests_and_connections(mirror, run_async_app):
+    async def pool(client):
+        for barcode in ('3017620422003', '5449000000996'):
+            await client.get(f'/search?barcode={barcode}')
+        return await (await client.get('/admin/pool')).json()
+
+    stats = run_async_app(pool)['world']
+    assert stats['requests'] >= 2
+    assert 1 <= stats['connections_created'] <= stats['requests']
+
+
+@pytest.mark.parametrize('path, calls', [
+    ('/admin/cache', [(app.product_cache, 'stats')]),
+    ('/admin/popularity', [(app.popularity, 'stats'), (app.popularity, 'top')]),
+    ('/admin/local-products', [(app.local_products, 'stats')]),
+])
+def test_async_admin_reads_sqlite_off_the_event_loop(mirror, run_async_app, monkeypatch, path, calls):
+    threads = []
+    for owner, name in calls:
+        def recorded(*args, method=getattr(owner, name)):
+            threads.append(threading.get_ident())
+            return method(*args)
+        monkeypatch.setattr(owner, name, recorded)
+
+    async def admin(client):
+        response = await client.get(path)
+        assert response.status == 200
+        return threading.get_ident()
+
+    loop_thread = run_async_app(admin)
+    assert len(threads) == len(calls)
+    assert loop_thread not in threads
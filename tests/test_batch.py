@@ -0,0 +1,75 @@
+"""POST /search/batch: NDJSON records streamed as each lookup finishes, in both serving modes"""
+import json
+
+import pytest
+
+import app
+
+
+def records(body):
+    return [json.loads(line) for line in body.decode().splitlines()]
+
+
+@pytest.fixture
+def client():
+    return app.app.test_client()
+
+
+def test_one_record_per_unique_barcode_and_invalid_ones_first(client, mirror):
+    response = client.post('/search/batch', json={'barcodes': ['123', '3017620422003', '3017-6204-22003', '5449000000996']})
+    assert response.status_code == 200
+    assert response.mimetype == 'application/x-ndjson'
+    lines = records(response.data)
+    assert lines[0] == {'barcode': '123', 'error': app.INVALID_BARCODE_ERROR}
+    assert sorted(line['barcode'] for line in lines[1:]) == ['3017620422003', '5449000000996']
+    assert all(line['name'] == 'Test Spread' for line in lines[1:])
+    # The two spellings of the same barcode share one lookup
+    assert mirror.hits == 2
+
+
+def test_form_fields(client, mirror):
+    response = client.post('/search/batch', data={'barcode': ['3017620422003', '5449000000996']})
+    assert len(records(response.data)) == 2
+
+
+def test_records_stream_in_the_order_lookups_finish(client, mirror):
+    mirror.delays = {'3017620422003': 0.5}
+    response = client.post('/search/batch', json={'barcodes': ['3017620422003', '5449000000996']}, buffered=False)
+    first = json.loads(next(iter(response.response)))
+    assert first['barcode'] == '5449000000996'
+    response.close()
+
+
+def test_failed_lookups_are_records_not_errors(client, mirror):
+    mirror.mode = 'missing'
+    lines = records(client.post('/search/batch', json={'barcodes': ['3017620422003']}).data)
+    assert lines == [{'barcode': '3017620422003', 'error': app.PRODUCT_NOT_FOUND_ERROR}]
+    mirror.mode = 'error'
+    lines = records(client.post('/search/batch', json={'barcodes': ['5449000000996']}).data)
+    assert lines == [{'barcode': '5449000000996', 'error': app.UPSTREAM_UNAVAILABLE_ERROR}]
+
+
+@pytest.mark.parametrize('payload', [{'barcodes': []}, {'barcodes': 'not a list'}, {}])
+def test_a_batch_without_barcodes_is_400(client, mirror, payload):
+    assert client.post('/search/batch', json=payload).status_code == 400
+
+
+def test_a_batch_over_the_limit_is_400(client, mirror):
+    barcodes = [f'{number:013d}' for number in range(app.BATCH_MAX_BARCODES + 1)]
+    response = client.post('/search/batch', json={'barcodes': barcodes})
+    assert response.status_code == 400
+    assert mirror.hits == 0
+
+
+def test_async_batch_streams_the_same_records(mirror, run_async_app):
+    mirror.delays = {'3017620422003': 0.5}
+
+    async def batch(client):
+        response = await client.post('/search/batch', json={'barcodes': ['123', '3017620422003', '5449000000996']})
+        assert response.headers['Content-Type'] == 'application/x-ndjson'
+        return [json.loads(line) async for line in response.content]
+
+    lines = run_async_app(batch)
+    assert [line['barcode'] for line in lines] == ['123', '5449000000996', '3017620422003']
+    assert lines[0]['error'] == app.INVALID_BARCODE_ERROR
+    assert lines[2]['name'] == 'Test Spread'
@@ -0,0 +1,113 @@
+"""Lookup deadlines: the client's timeout budget, 504 at the deadline, and per-mirror adaptive timeouts"""
+import math
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import app
+from app import MirrorHealth, mirror_timeout, search_budget
+
+BARCODE = '3017620422003'
+
+
+@pytest.mark.parametrize('requested, budget', [
+    (None, app.SEARCH_DEADLINE),
+    ('', app.SEARCH_DEADLINE),
+    ('2.5', 2.5),
+    ('1e9', app.SEARCH_DEADLINE_MAX),
+])
+def test_budget_from_the_timeout_parameter(requested, budget):
+    assert search_budget(requested) == budget
+
+
+@pytest.mark.parametrize('requested', ['0', '-1', 'nan', 'soon'])
+def test_budget_must_be_a_positive_number(requested):
+    assert search_budget(requested) is None
+
+
+def test_invalid_timeout_is_400_without_a_lookup(mirror):
+    response = app.app.test_client().get(f'/search?barcode={BARCODE}&timeout=soon')
+    assert response.status_code == 400
+    assert response.get_json() == {'error': app.INVALID_TIMEOUT_ERROR}
+    assert mirror.hits == 0
+
+
+@pytest.mark.parametrize('lookup_mode', ['sequential', 'hedged'])
+def test_mirror_slower_than_the_deadline_is_504(mirror, monkeypatch, lookup_mode):
+    monkeypatch.setattr(app, 'LOOKUP_MODE', lookup_mode)
+    mirror.mode = 'slow'
+    mirror.delay = 2.0
+    started = time.monotonic()
+    response = app.app.test_client().get(f'/search?barcode={BARCODE}&timeout=0.3')
+    assert response.status_code == 504
+    assert response.get_json() == {'error': app.LOOKUP_TIMED_OUT_ERROR}
+    # The lookup gives up at its deadline instead of waiting for the mirror
+    assert time.monotonic() - started < 1.5
+
+
+def test_async_mirror_slower_than_the_deadline_is_504(mirror, run_async_app):
+    mirror.mode = 'slow'
+    mirror.delay = 2.0
+
+    async def search(client):
+        started = time.monotonic()
+        response = await client.get(f'/search?barcode={BARCODE}&timeout=0.3')
+        return response.status, await response.json(), time.monotonic() - started
+
+    status, body, elapsed = run_async_app(search)
+    assert status == 504
+    assert body == {'error': app.LOOKUP_TIMED_OUT_ERROR}
+    assert elapsed < 1.5
+
+
+def test_joining_a_slower_lookup_still_ends_at_its_own_deadline(mirror):
+    mirror.mode = 'slow'
+    mirror.delay = 1.0
+    client = app.app.test_client()
+    with ThreadPoolExecutor(1) as pool:
+        first = pool.submit(client.get, f'/search?barcode={BARCODE}&timeout=5')
+        while not app.upstream_flights.stats()['in_flight']:
+            time.sleep(0.01)
+        started = time.monotonic()
+        assert client.get(f'/search?barcode={BARCODE}&timeout=0.2').status_code == 504
+        assert time.monotonic() - started < 0.8
+        assert first.result(5).status_code == 200
+
+
+def test_request_timeout_is_cut_to_the_time_left():
+    health = MirrorHealth('world', 0)
+    assert mirror_timeout(health, time.monotonic() + 60) == (health.timeout, False)
+    timeout, cut = mirror_timeout(health, time.monotonic() + 0.5)
+    assert cut and 0.4 < timeout <= 0.5
+    assert mirror_timeout(health, time.monotonic() - 1) == (0.001, True)
+
+
+def test_timeout_adapts_to_the_latency_percentile():
+    health = MirrorHealth('world', 0)
+    for _ in range(app.MIRROR_TIMEOUT_MIN_SAMPLES - 1):
+        health.record('found', 0.4)
+    # Too few samples to go on yet
+    assert health.timeout == app.OFF_TIMEOUT
+    health.record('found', 0.4)
+    assert math.isclose(health.timeout, 0.4 * app.MIRROR_TIMEOUT_MULTIPLIER)
+
+
+def test_adapted_timeout_has_a_floor_and_a_ceiling():
+    fast = MirrorHealth('world', 0)
+    slow = MirrorHealth('uk', 1)
+    for _ in range(app.MIRROR_TIMEOUT_MIN_SAMPLES):
+        fast.record('found', 0.001)
+        slow.record('error', app.OFF_TIMEOUT)
+    assert fast.timeout == app.MIRROR_TIMEOUT_MIN
+    assert slow.timeout == app.OFF_TIMEOUT
+
+
+def test_a_slowing_mirror_gets_a_longer_timeout():
+    health = MirrorHealth('world', 0)
+    for _ in range(app.MIRROR_LATENCY_WINDOW):
+        health.record('found', 0.2)
+    short = health.timeout
+    for _ in range(app.MIRROR_LATENCY_WINDOW // 10):
+        health.record('found', 1.5)
+    assert health.timeout > short
@@ -0,0 +1,171 @@
+"""MirrorGovernor: why requests are shed, how waiting threads and tasks are woken, and /search under a 429"""
+import time
+import asyncio
+import threading
+
+import pytest
+
+import app
+from app import MirrorGovernor
+
+
+def governor(max_in_flight=1, rate=0, burst=1, max_waiting=4, **kwargs):
+    return MirrorGovernor('test', max_in_flight, rate, burst, max_waiting, **kwargs)
+
+
+def soon(seconds=5.0):
+    return time.monotonic() + seconds
+
+
+def test_admits_up_to_max_in_flight():
+    limits = governor(max_in_flight=2)
+    assert limits.acquire(soon()) is None
+    assert limits.acquire(soon()) is None
+    assert limits.in_flight == 2
+    assert limits.admitted == 2
+
+
+def test_sheds_when_the_queue_is_full():
+    limits = governor(max_waiting=0)
+    assert limits.acquire(soon()) is None
+    assert limits.acquire(soon()) == 'queue_full'
+    assert limits.shed['queue_full'] == 1
+
+
+def test_sheds_a_waiter_whose_deadline_passes():
+    limits = governor()
+    assert limits.acquire(soon()) is None
+    started = time.monotonic()
+    assert limits.acquire(soon(0.1)) == 'queue_timeout'
+    assert 0.05 < time.monotonic() - started < 1
+    assert limits.waiting == 0
+
+
+def test_sheds_at_once_when_no_token_is_due_before_the_deadline():
+    limits = governor(max_in_flight=10, rate=1, burst=1)
+    assert limits.acquire(soon()) is None
+    started = time.monotonic()
+    assert limits.acquire(soon(0.2)) == 'queue_timeout'
+    assert time.monotonic() - started < 0.1
+
+
+def test_waits_for_a_token_due_before_the_deadline():
+    limits = governor(max_in_flight=10, rate=20, burst=1)
+    assert limits.acquire(soon()) is None
+    started = time.monotonic()
+    assert limits.acquire(soon()) is None
+    assert time.monotonic() - started >= 0.04
+
+
+def test_sheds_while_throttled():
+    limits = governor()
+    limits.throttle(5)
+    assert limits.acquire(soon()) == 'throttled'
+    assert 4 < limits.throttled_for() <= 5
+    assert limits.shed['throttled'] == 1
+
+
+def test_release_wakes_a_waiting_thread():
+    limits = governor()
+    assert limits.acquire(soon()) is None
+    outcome = {}
+
+    def wait_for_turn():
+        started = time.monotonic()
+        outcome['shed'] = limits.acquire(soon())
+        outcome['waited'] = time.monotonic() - started
+
+    waiter = threading.Thread(target=wait_for_turn)
+    waiter.start()
+    while limits.waiting == 0:
+        time.sleep(0.001)
+    time.sleep(0.05)
+    limits.release()
+    waiter.join(2)
+    assert outcome['shed'] is None
+    # Woken by the release, not by polling out its five-second deadline
+    assert outcome['waited'] < 1
+    assert limits.in_flight == 1
+
+
+def test_release_wakes_a_waiting_task():
+    limits = governor()
+    assert limits.acquire(soon()) is None
+
+    async def main():
+        task = asyncio.create_task(limits.acquire_async(soon()))
+        while limits.waiting == 0:
+            await asyncio.sleep(0.001)
+        started = time.monotonic()
+        # Released from another thread, as a sync request finishing would
+        threading.Thread(target=limits.release).start()
+        shed = await asyncio.wait_for(task, 2)
+        return shed, time.monotonic() - started
+
+    shed, waited = asyncio.run(main())
+    assert shed is None
+    assert waited < 1
+    assert limits.in_flight == 1
+
+
+def test_waiting_task_is_shed_at_its_deadline():
+    limits = governor()
+    assert limits.acquire(soon()) is None
+    assert asyncio.run(limits.acquire_async(soon(0.1))) == 'queue_timeout'
+    assert limits.waiting == 0
+
+
+def test_threads_and_tasks_share_the_slots():
+    limits = governor()
+    assert asyncio.run(limits.acquire_async(soon())) is None
+    assert limits.acquire(soon(0.05)) == 'queue_timeout'
+    limits.release()
+    assert limits.acquire(soon()) is None
+
+
+def test_shared_limits_throttle_every_governor(tmp_path):
+    shared_limits = pytest.importorskip('shared_limits')
+    path = str(tmp_path / 'limits')
+    first = governor(shared=shared_limits.SharedMirrorLimits(path, ['test']))
+    second = governor(shared=shared_limits.SharedMirrorLimits(path, ['test']))
+    first.throttle(5)
+    assert second.acquire(soon()) == 'throttled'
+
+
+def test_shared_limits_share_the_token_bucket(tmp_path):
+    shared_limits = pytest.importorskip('shared_limits')
+    path = str(tmp_path / 'limits')
+    first = governor(max_in_flight=10, rate=0.01, burst=2, shared=shared_limits.SharedMirrorLimits(path, ['test']))
+    second = governor(max_in_flight=10, rate=0.01, burst=2, shared=shared_limits.SharedMirrorLimits(path, ['test']))
+    assert first.acquire(soon()) is None
+    assert second.acquire(soon()) is None
+    assert first.acquire(soon()) == 'queue_timeout'
+    assert second.acquire(soon()) == 'queue_timeout'
+
+
+@pytest.mark.parametrize('lookup_mode', ['sequential', 'hedged'])
+def test_throttled_upstream_is_503_with_its_retry_after(mirror, monkeypatch, lookup_mode):
+    monkeypatch.setattr(app, 'LOOKUP_MODE', lookup_mode)
+    mirror.mode = 'throttled'
+    client = app.app.test_client()
+    response = client.get('/search?barcode=3017620422003')
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '5'
+    # The other mirrors are the same service, so none of them is tried
+    assert mirror.hits == 1
+    # Nor is any mirror tried again before the pause is over
+    assert client.get('/search?barcode=3017620422003').status_code == 503
+    assert mirror.hits == 1
+
+
+def test_async_throttled_upstream_is_503_with_its_retry_after(mirror, run_async_app):
+    mirror.mode = 'throttled'
+
+    async def search(client):
+        responses = [await client.get('/search?barcode=3017620422003') for _ in range(2)]
+        return [(response.status, response.headers.get('Retry-After')) for response in responses]
+
+    (first_status, first_retry_after), (second_status, second_retry_after) = run_async_app(search)
+    assert (first_status, first_retry_after) == (503, '5')
+    assert second_status == 503 and second_retry_after
+    assert mirror.hits == 1
@@ -0,0 +1,88 @@
+"""ingest-products and the offline product database /search reads from"""
+import gzip
+import json
+import time
+
+import pytest
+
+import app
+from app import LocalProductStore
+
+
+def ingest(path, db_path, batch_size=2):
+    result = app.app.test_cli_runner().invoke(
+        args=['ingest-products', str(path), '--db', db_path, '--batch-size', str(batch_size)]
+    )
+    assert result.exit_code == 0, result.output
+    return result
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / 'products.sqlite3')
+
+
+@pytest.fixture
+def jsonl_dump(tmp_path):
+    path = tmp_path / 'products.jsonl.gz'
+    rows = [
+        {'code': '3017620422003', 'product_name': 'Spread', 'brands': '', 'nutriments': {'sugars_100g': 56.3, 'sugars_serving': 8.5}},
+        {'code': '12', 'product_name': 'Too short'},
+        {'code': '5449000000996', 'product_name': 'Cola', 'ignored_field': 'x'},
+    ]
+    with gzip.open(path, 'wt', encoding='utf-8') as dump:
+        for row in rows:
+            dump.write(json.dumps(row) + '\n')
+        dump.write('not json\n')
+    return path
+
+
+def test_jsonl_export_keeps_valid_barcodes_and_only_served_fields(jsonl_dump, db_path):
+    assert 'Ingested 2 products' in ingest(jsonl_dump, db_path).output
+    store = LocalProductStore(db_path)
+    assert store.get('3017620422003') == {'product_name': 'Spread', 'nutriments': {'sugars_100g': 56.3}}
+    assert store.get('5449000000996') == {'product_name': 'Cola'}
+    assert store.get('12') is None
+    assert store.stats()['hits'] == 2
+
+
+def test_csv_export_flattens_tags_and_nutriments(tmp_path, db_path):
+    path = tmp_path / 'products.csv'
+    path.write_text(
+        'code\tproduct_name\tallergens_tags\tnutriscore_grade\tsugars_100g\tfat_100g\n'
+        '3017620422003\tSpread\ten:milk,en:nuts\td\t56.3\t\n',
+        encoding='utf-8',
+    )
+    ingest(path, db_path)
+    product = LocalProductStore(db_path).get('3017620422003')
+    assert product['allergens_tags'] == ['en:milk', 'en:nuts']
+    assert product['nutrition_grade_fr'] == 'd'
+    assert product['nutriments'] == {'sugars_100g': 56.3}
+
+
+def test_store_without_a_file_answers_none(db_path):
+    store = LocalProductStore(db_path)
+    assert store.get('3017620422003') is None
+    assert LocalProductStore('').get('3017620422003') is None
+
+
+def test_store_picks_up_a_new_database_after_ingest(jsonl_dump, tmp_path, db_path, monkeypatch):
+    monkeypatch.setattr(LocalProductStore, 'STAT_INTERVAL', 0.05)
+    ingest(jsonl_dump, db_path)
+    store = LocalProductStore(db_path)
+    assert store.get('3017620422003')['product_name'] == 'Spread'
+    newer = tmp_path / 'newer.jsonl'
+    newer.write_text(json.dumps({'code': '3017620422003', 'product_name': 'Spread v2'}) + '\n', encoding='utf-8')
+    ingest(newer, db_path)
+    time.sleep(0.1)
+    assert store.get('3017620422003')['product_name'] == 'Spread v2'
+    assert store.get('5449000000996') is None
+
+
+def test_search_answers_from_the_local_database_without_the_mirrors(jsonl_dump, db_path, mirror, monkeypatch):
+    ingest(jsonl_dump, db_path)
+    monkeypatch.setattr(app, 'local_products', LocalProductStore(db_path))
+    response = app.app.test_client().get('/search?barcode=3017620422003')
+    assert response.status_code == 200
+    assert response.get_json()['name'] == 'Spread'
+    assert mirror.hits == 0
@@ -0,0 +1,105 @@
+"""/metrics: the Prometheus exposition and what a /search adds to it"""
+import pytest
+from prometheus_client import REGISTRY
+from prometheus_client.parser import text_string_to_metric_families
+
+import app
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+class Delta:
+    """Changes of the named samples between creation and a call"""
+
+    def __init__(self, *keys):
+        self.keys = keys
+        self.before = [sample(name, **labels) for name, labels in keys]
+
+    def __call__(self):
+        return [sample(name, **labels) - before for (name, labels), before in zip(self.keys, self.before)]
+
+
+def test_exposition_is_prometheus_text_with_every_family(mirror):
+    app.app.test_client().get('/search?barcode=3017620422003')
+    response = app.app.test_client().get('/metrics')
+    assert response.status_code == 200
+    assert response.content_type.startswith('text/plain; version=0.0.4')
+    families = {family.name for family in text_string_to_metric_families(response.get_data(as_text=True))}
+    assert {
+        'scanner_search_requests', 'scanner_search_latency_seconds', 'scanner_search_response_bytes',
+        'scanner_lookup_source', 'scanner_upstream_requests', 'scanner_upstream_responses',
+        'scanner_upstream_latency_seconds', 'scanner_upstream_response_bytes', 'scanner_mirror_fallthrough',
+    } <= families
+
+
+def test_found_product_counts_the_search_and_the_mirror_that_had_it(mirror):
+    first = app.ranked_mirrors()[0]
+    delta = Delta(
+        ('scanner_search_requests_total', {'result': 'found'}),
+        ('scanner_search_latency_seconds_count', {'result': 'found'}),
+        ('scanner_search_response_bytes_count', {}),
+        ('scanner_lookup_source_total', {'source': 'mirrors'}),
+        ('scanner_upstream_requests_total', {'mirror': first, 'outcome': 'found'}),
+        ('scanner_upstream_responses_total', {'mirror': first, 'status': '200'}),
+        ('scanner_upstream_latency_seconds_count', {'mirror': first}),
+        ('scanner_mirror_fallthrough_total', {'depth': '0', 'mirror': first}),
+    )
+    assert app.app.test_client().get('/search?barcode=3017620422003').status_code == 200
+    assert delta() == [1] * 8
+
+
+def test_cached_product_is_counted_as_a_cache_lookup(mirror):
+    client = app.app.test_client()
+    client.get('/search?barcode=3017620422003')
+    delta = Delta(('scanner_lookup_source_total', {'source': 'cache'}),
+                  ('scanner_lookup_source_total', {'source': 'mirrors'}))
+    client.get('/search?barcode=3017620422003')
+    assert delta() == [1, 0]
+
+
+def test_missing_product_counts_every_mirror_and_no_fallthrough_depth(mirror):
+    mirror.mode = 'missing'
+    delta = Delta(
+        ('scanner_search_requests_total', {'result': 'not_found'}),
+        ('scanner_mirror_fallthrough_total', {'depth': 'none', 'mirror': 'none'}),
+        *[('scanner_upstream_requests_total', {'mirror': name, 'outcome': 'not_found'}) for name in app.OFF_MIRRORS],
+    )
+    app.app.test_client().get('/search?barcode=3017620422003')
+    assert delta() == [1] * (2 + len(app.OFF_MIRRORS))
+
+
+@pytest.mark.parametrize('mode, outcome, status', [('error', 'error', '500'), ('throttled', 'throttled', '429')])
+def test_failing_mirror_outcomes(mirror, mode, outcome, status):
+    mirror.mode = mode
+    first = app.ranked_mirrors()[0]
+    delta = Delta(
+        ('scanner_search_requests_total', {'result': 'unavailable'}),
+        ('scanner_upstream_requests_total', {'mirror': first, 'outcome': outcome}),
+        ('scanner_upstream_responses_total', {'mirror': first, 'status': status}),
+    )
+    assert app.app.test_client().get('/search?barcode=3017620422003').status_code == 503
+    assert delta() == [1, 1, 1]
+
+
+def test_invalid_barcode_is_counted_without_touching_the_mirrors(mirror):
+    delta = Delta(('scanner_search_requests_total', {'result': 'invalid'}))
+    app.app.test_client().get('/search?barcode=12')
+    assert delta() == [1]
+    assert mirror.hits == 0
+
+
+def test_async_app_records_and_serves_the_same_metrics(mirror, run_async_app):
+    delta = Delta(('scanner_search_requests_total', {'result': 'found'}),
+                  ('scanner_lookup_source_total', {'source': 'mirrors'}))
+
+    async def search(client):
+        await client.get('/search?barcode=3017620422003')
+        response = await client.get('/metrics')
+        return response.headers['Content-Type'], await response.text()
+
+    content_type, body = run_async_app(search)
+    assert delta() == [1, 1]
+    assert content_type.startswith('text/plain')
+    assert 'scanner_search_requests_total{result="found"}' in body
@@ -0,0 +1,118 @@
+"""Mirror health: the circuit breaker's open and half-open states, and how mirrors are ranked"""
+import time
+
+import pytest
+
+import app
+from app import MirrorHealth
+
+
+def failed(health, times):
+    for _ in range(times):
+        health.record('error', 0.1)
+
+
+def test_breaker_opens_after_consecutive_failures():
+    health = MirrorHealth('world', 0)
+    failed(health, app.MIRROR_FAILURE_THRESHOLD - 1)
+    assert health.state == 'closed'
+    health.record('found', 0.1)
+    failed(health, app.MIRROR_FAILURE_THRESHOLD - 1)
+    assert health.state == 'closed'
+    health.record('error', 0.1)
+    assert health.state == 'open'
+    assert not health.available()
+    assert not health.acquire()
+
+
+def test_open_breaker_lets_one_probe_through_after_the_cooldown():
+    health = MirrorHealth('world', 0)
+    failed(health, app.MIRROR_FAILURE_THRESHOLD)
+    health.opened_at = time.time() - app.MIRROR_COOLDOWN
+    assert health.available()
+    assert health.acquire()
+    assert health.state == 'half_open'
+    assert not health.available()
+    assert not health.acquire()
+
+
+def test_successful_probe_closes_the_breaker():
+    health = MirrorHealth('world', 0)
+    failed(health, app.MIRROR_FAILURE_THRESHOLD)
+    health.opened_at = time.time() - app.MIRROR_COOLDOWN
+    assert health.acquire()
+    health.record('not_found', 0.1)
+    assert health.state == 'closed'
+    assert health.consecutive_failures == 0
+
+
+def test_failed_probe_reopens_the_breaker_for_another_cooldown():
+    health = MirrorHealth('world', 0)
+    failed(health, app.MIRROR_FAILURE_THRESHOLD)
+    health.opened_at = time.time() - app.MIRROR_COOLDOWN
+    assert health.acquire()
+    health.record('error', 0.1)
+    assert health.state == 'open'
+    assert not health.available()
+
+
+def test_abandoned_probe_frees_the_half_open_slot():
+    health = MirrorHealth('world', 0)
+    failed(health, app.MIRROR_FAILURE_THRESHOLD)
+    health.opened_at = time.time() - app.MIRROR_COOLDOWN
+    assert health.acquire()
+    health.release()
+    assert health.acquire()
+
+
+def test_faster_mirror_ranks_first(mirror):
+    for _ in range(10):
+        app.mirror_health['world'].record('found', 2.0)
+        app.mirror_health['uk'].record('found', 0.05)
+    ranking = app.ranked_mirrors()
+    assert ranking[0] == 'uk'
+    assert ranking.index('world') > ranking.index('us')
+
+
+def test_errors_and_misses_demote_a_mirror(mirror):
+    for _ in range(3):
+        app.mirror_health['world'].record('error', 0.1)
+        app.mirror_health['us'].record('not_found', 0.1)
+        app.mirror_health['uk'].record('found', 0.1)
+    ranking = app.ranked_mirrors()
+    assert ranking[0] == 'uk'
+    assert ranking[-1] == 'world'
+    # Same latency as uk, but most of what it answers is a miss
+    assert app.mirror_health['us'].score() > app.mirror_health['uk'].score()
+
+
+def test_unknown_mirrors_keep_their_priority_order(mirror):
+    assert app.ranked_mirrors() == app.OFF_MIRRORS
+
+
+def test_open_and_throttled_mirrors_are_not_ranked(mirror):
+    failed(app.mirror_health['world'], app.MIRROR_FAILURE_THRESHOLD)
+    app.mirror_governors['us'].throttle(30)
+    assert app.ranked_mirrors() == ['uk', 'in']
+
+
+@pytest.mark.parametrize('lookup_mode', ['sequential', 'hedged'])
+def test_every_mirror_failing_is_503(mirror, monkeypatch, lookup_mode):
+    monkeypatch.setattr(app, 'LOOKUP_MODE', lookup_mode)
+    mirror.mode = 'error'
+    response = app.app.test_client().get('/search?barcode=3017620422003')
+    assert response.status_code == 503
+    assert response.get_json() == {'error': app.UPSTREAM_UNAVAILABLE_ERROR}
+    assert 'Retry-After' not in response.headers
+    assert mirror.hits == len(app.OFF_MIRRORS)
+
+
+def test_search_stops_calling_mirrors_whose_breakers_opened(mirror):
+    mirror.mode = 'error'
+    client = app.app.test_client()
+    for _ in range(app.MIRROR_FAILURE_THRESHOLD):
+        client.get('/search?barcode=3017620422003')
+    hits = mirror.hits
+    assert client.get('/search?barcode=3017620422003').status_code == 503
+    assert mirror.hits == hits
+    assert {entry['state'] for entry in client.get('/admin/mirrors').get_json()['mirrors']} == {'open'}
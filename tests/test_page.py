@@ -0,0 +1,79 @@
+"""The index page: one precompressed body per encoding, each with its own strong ETag"""
+import gzip
+
+import pytest
+
+import app
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+@pytest.fixture
+def client():
+    return app.app.test_client()
+
+
+def test_identity_when_no_encoding_is_accepted(client):
+    response = client.get('/', headers={'Accept-Encoding': 'identity'})
+    assert response.status_code == 200
+    assert 'Content-Encoding' not in response.headers
+    assert b'<!DOCTYPE html>' in response.data
+    assert response.headers['Vary'] == 'Accept-Encoding'
+    assert response.headers['Cache-Control'] == 'no-cache'
+    assert not response.headers['ETag'].startswith('W/')
+
+
+def test_gzip_variant(client):
+    plain = client.get('/', headers={'Accept-Encoding': 'identity'})
+    response = client.get('/', headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(response.data) == plain.data
+    assert response.headers['ETag'] == plain.headers['ETag'][:-1] + '-gz"'
+
+
+@pytest.mark.skipif(brotli is None, reason='brotli is not installed')
+def test_brotli_is_preferred_when_accepted(client):
+    plain = client.get('/', headers={'Accept-Encoding': 'identity'})
+    response = client.get('/', headers={'Accept-Encoding': 'gzip, br'})
+    assert response.headers['Content-Encoding'] == 'br'
+    assert brotli.decompress(response.data) == plain.data
+    assert response.headers['ETag'].endswith('-br"')
+
+
+def test_refused_encoding_is_not_used(client):
+    response = client.get('/', headers={'Accept-Encoding': 'br;q=0, gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+
+
+@pytest.mark.parametrize('encoding', ['identity', 'gzip'])
+def test_matching_etag_gets_304_without_a_body(client, encoding):
+    etag = client.get('/', headers={'Accept-Encoding': encoding}).headers['ETag']
+    response = client.get('/', headers={'Accept-Encoding': encoding, 'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.data == b''
+    assert response.headers['ETag'] == etag
+
+
+def test_etag_of_another_encoding_does_not_match(client):
+    etag = client.get('/', headers={'Accept-Encoding': 'identity'}).headers['ETag']
+    response = client.get('/', headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+    assert response.status_code == 200
+
+
+def test_async_app_serves_the_same_variants(run_async_app):
+    plain = app.app.test_client().get('/', headers={'Accept-Encoding': 'gzip'})
+
+    async def index(client):
+        response = await client.get('/', headers={'Accept-Encoding': 'gzip'}, auto_decompress=False)
+        body = await response.read()
+        not_modified = await client.get('/', headers={'Accept-Encoding': 'gzip', 'If-None-Match': response.headers['ETag']})
+        return response.headers, body, not_modified.status
+
+    headers, body, status = run_async_app(index)
+    assert headers['Content-Encoding'] == 'gzip'
+    assert headers['ETag'] == plain.headers['ETag']
+    assert body == plain.data
+    assert status == 304
@@ -0,0 +1,42 @@
+"""Mirror response bodies: the fields kept from them, and the request asking for only those"""
+import json
+from pathlib import Path
+
+import pytest
+
+import app
+from app import PRODUCT_FIELDS, parse_product_payload
+
+CORPUS = Path(__file__).resolve().parent.parent / 'benchmarks' / 'corpus'
+
+
+@pytest.mark.parametrize('path', sorted(CORPUS.glob('*.json')), ids=lambda path: path.stem)
+def test_only_served_fields_are_kept(path):
+    body = path.read_bytes()
+    data = json.loads(body)
+    product = parse_product_payload(body)
+    if data.get('status') != 1:
+        assert product is None
+        return
+    assert product == {field: data['product'][field] for field in PRODUCT_FIELDS if field in data['product']}
+
+
+@pytest.mark.parametrize('body', [
+    b'{"status": 0, "status_verbose": "product not found"}',
+    b'{"status": 1, "product": {}}',
+    b'{"status": 1}',
+    b'[]',
+])
+def test_bodies_without_a_product_are_none(body):
+    assert parse_product_payload(body) is None
+
+
+@pytest.mark.parametrize('body', [b'<html>busy</html>', b'{"status": 1, "product": {', b'\xff\xfe'])
+def test_malformed_bodies_raise_value_error(body):
+    with pytest.raises(ValueError):
+        parse_product_payload(body)
+
+
+def test_mirrors_are_asked_for_the_served_fields_only(mirror):
+    app.app.test_client().get('/search?barcode=3017620422003')
+    assert mirror.queries[-1]['fields'] == [app.UPSTREAM_FIELDS]
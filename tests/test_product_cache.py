@@ -0,0 +1,108 @@
+"""ProductCache: the memory and SQLite tiers, their TTLs and eviction"""
+import time
+
+import pytest
+
+import app
+from app import ProductCache
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / 'cache.sqlite3')
+
+
+def cache(db_path=None, max_entries=16, ttl=60, max_stale=60, db_max_entries=100, db_ttl=3600):
+    return ProductCache(max_entries, ttl, db_path=db_path, db_max_entries=db_max_entries if db_path else 0,
+                        db_ttl=db_ttl, max_stale=max_stale)
+
+
+def test_memory_hit():
+    products = cache()
+    products.set('1', {'name': 'a'})
+    product_info, age = products.get('1')
+    assert product_info == {'name': 'a'}
+    assert 0 <= age < 1
+    assert products.stats()['memory_hits'] == 1
+
+
+def test_miss():
+    products = cache()
+    assert products.get('1') == (None, None)
+    assert products.stats()['misses'] == 1
+
+
+def test_least_recently_used_entry_is_evicted():
+    products = cache(max_entries=2)
+    products.set('1', {'name': 'a'})
+    products.set('2', {'name': 'b'})
+    products.get('1')
+    products.set('3', {'name': 'c'})
+    assert products.get('2') == (None, None)
+    assert products.get('1')[0] == {'name': 'a'}
+    assert products.get('3')[0] == {'name': 'c'}
+    assert products.evictions == 1
+
+
+def test_disk_tier_is_shared_by_instances_and_refills_memory(db_path):
+    cache(db_path).set('1', {'name': 'a'})
+    products = cache(db_path)
+    assert products.get('1')[0] == {'name': 'a'}
+    assert products.get('1')[0] == {'name': 'a'}
+    stats = products.stats()
+    assert (stats['disk_hits'], stats['memory_hits'], stats['disk_entries']) == (1, 1, 1)
+
+
+def test_entry_past_its_ttl_comes_back_stale_with_its_age():
+    products = cache(ttl=60, max_stale=60)
+    products._remember('1', time.time() - 90, {'name': 'a'})
+    product_info, age = products.get('1')
+    assert product_info == {'name': 'a'}
+    assert 89 < age < 92
+    assert products.stats()['stale_hits'] == 1
+
+
+def test_entry_past_ttl_and_max_stale_is_dropped():
+    products = cache(ttl=60, max_stale=60)
+    products._remember('1', time.time() - 121, {'name': 'a'})
+    assert products.get('1') == (None, None)
+    assert products.stats()['memory_entries'] == 0
+
+
+def test_fresher_disk_entry_wins_over_a_stale_memory_one(db_path):
+    products = cache(db_path)
+    products._remember('1', time.time() - 90, {'name': 'old'})
+    products._db_set('1', time.time() - 5, {'name': 'new'})
+    product_info, age = products.get('1')
+    assert product_info == {'name': 'new'}
+    assert age < 60
+
+
+def test_disk_entries_expire_after_db_ttl(db_path):
+    products = cache(db_path, ttl=60, max_stale=60, db_ttl=100)
+    products._db_set('1', time.time() - 101, {'name': 'a'})
+    assert products.get('1') == (None, None)
+
+
+def test_disk_tier_is_trimmed_to_its_newest_entries(db_path):
+    products = cache(db_path, db_max_entries=5)
+    # Trimming runs every hundred writes
+    for number in range(100):
+        products._db_set(str(number), 1000.0 + number, {'number': number})
+    rows = products._connection().execute('SELECT barcode FROM product_cache ORDER BY fetched_at').fetchall()
+    assert [row[0] for row in rows] == ['95', '96', '97', '98', '99']
+
+
+def test_warm_moves_a_disk_entry_into_memory_without_counting_a_lookup(db_path):
+    cache(db_path).set('1', {'name': 'a'})
+    products = cache(db_path)
+    assert products.warm('1')
+    assert products.stats()['memory_entries'] == 1
+    assert products.stats()['misses'] + products.stats()['disk_hits'] == 0
+
+
+def test_search_answers_a_repeat_lookup_from_the_cache(mirror):
+    client = app.app.test_client()
+    assert client.get('/search?barcode=3017620422003').status_code == 200
+    assert client.get('/search?barcode=3017620422003').status_code == 200
+    assert mirror.hits == 1
@@ -0,0 +1,139 @@
+"""Bulk scoring and the compiled rule table give exactly what the per-product assessments always gave"""
+import itertools
+import random
+
+import pytest
+
+from app import rule_engine
+from bulk_scoring import ProductColumns, band_index, score_products
+from health_rules import FEATURES, RULES, _threshold
+from legacy_assessment import assess_health, get_age_recommendations
+
+# Values on both sides of every threshold, plus the unparsable and missing ones
+GRADES = ['', 'a', 'b', 'c', 'd', 'e']
+SUGARS = [None, 0, '', 5, 5.01, '10', 10.5, 22.5, 30, 'n/a', [1]]
+FATS = [None, 0, 3, 3.5, '17.5', 18, 'trace']
+SALTS = [None, 0, 0.8, 0.81, '1.5', 2, 'high']
+ADDITIVES = [[], ['en:e330'], ['en:e330'] * 4, ['en:e330'] * 6]
+NOVAS = ['', None, 1, 2, '3', 4, '4', 'x']
+ALLERGENS = [[], ['en:milk'], ['en:peanuts'], ['en:milk', 'en:eggs'], ['en:doughnuts'], ['en:celery-root']]
+INGREDIENTS = ['', 'Sugar, PALM OIL, hazelnuts', 'sugar, palm fat', None, 42]
+
+
+def product(grade, sugar, fat, salt, additives, nova, allergens, ingredients):
+    nutriments = {key: value for key, value in
+                  (('sugars_100g', sugar), ('fat_100g', fat), ('salt_100g', salt)) if value is not None}
+    info = {'nutriments': nutriments, 'additives_tags': additives, 'allergens': allergens}
+    if grade:
+        info['nutrition_grade'] = grade
+    if nova is not None:
+        info['nova_group'] = nova
+    if ingredients is not None:
+        info['ingredients'] = ingredients
+    return info
+
+
+def corpus():
+    # Each column's values in turn against a plain product, then a fixed random sample of mixes
+    columns = [GRADES, SUGARS, FATS, SALTS, ADDITIVES, NOVAS, ALLERGENS, INGREDIENTS]
+    plain = [column[0] for column in columns]
+    products = [{}]
+    for index, column in enumerate(columns):
+        for value in column:
+            products.append(product(*plain[:index], value, *plain[index + 1:]))
+    rng = random.Random(20)
+    products.extend(product(*(rng.choice(column) for column in columns)) for _ in range(1500))
+    return products
+
+
+CORPUS = corpus()
+
+
+def legacy(product_info):
+    recommendations = get_age_recommendations(product_info)
+    # The old function deduplicated through a set, so its group order was arbitrary
+    recommendations['not_suitable_for'] = sorted(recommendations['not_suitable_for'])
+    return assess_health(product_info), recommendations
+
+
+def comparable(scores):
+    health, age = scores
+    return health, {**age, 'not_suitable_for': sorted(age['not_suitable_for'])}
+
+
+def test_score_products_matches_the_old_functions():
+    for product_info, scores in zip(CORPUS, score_products(CORPUS)):
+        assert comparable(scores) == legacy(product_info), product_info
+
+
+def test_compiled_rules_match_the_old_functions():
+    for product_info in CORPUS:
+        assert comparable(rule_engine.evaluate(product_info)) == legacy(product_info), product_info
+
+
+# One tag per allergen match, so a tag list can carry any number of matches
+ALLERGEN_TAGS = ['en:milk', 'en:eggs', 'en:soy', 'en:celery', 'en:mustard']
+
+
+def band_values(band):
+    """Feature values that fall in the band, and ones just outside it"""
+    if 'above' in band:
+        limit = _threshold(band['above'])
+        return [limit, limit + 1] if isinstance(limit, int) else [limit, limit + 0.01]
+    if 'equals' in band:
+        return [band['equals']]
+    if 'in' in band:
+        return list(band['in'])
+    return []
+
+
+def with_feature(name, value):
+    # A product whose only field is the one the feature is parsed from
+    parser, key = FEATURES[name][:2]
+    if parser == 'number':
+        return {key: {FEATURES[name][2]: value}}
+    if parser == 'count':
+        return {key: [f'en:e{100 + n}' for n in range(value)]}
+    if parser == 'mentions':
+        return {key: f'water, {FEATURES[name][2]}' if value else 'water'}
+    if parser == 'tag_terms':
+        return {key: ALLERGEN_TAGS[:value]}
+    return {key: value}
+
+
+def rule_branch_products():
+    products = [{}]
+    for rule in RULES:
+        name = rule['feature']
+        values = [value for band in rule['bands'] for value in band_values(band)]
+        if FEATURES[name][0] == 'text':
+            values += ['z', '']
+        elif FEATURES[name][0] == 'mentions':
+            values += [False]
+        elif FEATURES[name][0] in ('number', 'integer'):
+            values += [0, 'not a number']
+        products.extend(with_feature(name, value) for value in values)
+    return products
+
+
+BRANCHES = rule_branch_products()
+
+
+def test_every_rule_band_is_exercised():
+    columns = ProductColumns(BRANCHES)
+    for rule in RULES:
+        assert set(band_index(rule, columns).tolist()) >= set(range(len(rule['bands']))), rule
+
+
+@pytest.mark.parametrize('product_info', BRANCHES, ids=lambda product_info: repr(product_info)[:60])
+def test_every_rule_branch_agrees_across_engines(product_info):
+    expected = legacy(product_info)
+    assert comparable(rule_engine.evaluate(product_info)) == expected
+    assert comparable(score_products([product_info])[0]) == expected
+
+
+@pytest.mark.parametrize('size', [1, 7])
+def test_chunking_does_not_change_scores(size):
+    head = CORPUS[:50]
+    chunks = itertools.chain.from_iterable(score_products(head[start:start + size]) for start in range(0, len(head), size))
+    assert list(chunks) == score_products(head)
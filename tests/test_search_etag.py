@@ -0,0 +1,131 @@
+"""/search bodies: the compact schema, strong ETags per encoding, and 304 revalidation"""
+import gzip
+
+import pytest
+
+import app
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+BARCODE = '3017620422003'
+
+
+@pytest.fixture
+def client(mirror):
+    return app.app.test_client()
+
+
+@pytest.fixture
+def compressed(monkeypatch):
+    # The test product's body is small; compress it anyway
+    monkeypatch.setattr(app, 'COMPRESS_MIN_SIZE', 0)
+
+
+def search(client, method='GET', **headers):
+    if method == 'POST':
+        return client.post('/search', data={'barcode': BARCODE}, headers=headers)
+    return client.get(f'/search?barcode={BARCODE}', headers=headers)
+
+
+def test_found_product_has_a_strong_etag_and_must_be_revalidated(client):
+    response = search(client, **{'Accept-Encoding': 'identity'})
+    assert response.status_code == 200
+    assert response.headers['ETag'].startswith('"full.')
+    assert response.headers['Cache-Control'] == 'no-cache'
+    assert 'Accept-Encoding' in response.headers['Vary']
+    assert 'health_assessment' in response.get_json()
+
+
+def test_matching_etag_gets_an_empty_304(client):
+    etag = search(client).headers['ETag']
+    response = search(client, **{'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.data == b''
+    assert response.headers['ETag'] == etag
+    assert 'Server-Timing' in response.headers
+
+
+def test_stale_etag_gets_the_body(client):
+    response = search(client, **{'If-None-Match': '"full.r0.t0.0", W/"other"'})
+    assert response.status_code == 200
+
+
+def test_post_is_never_answered_with_304(client):
+    etag = search(client).headers['ETag']
+    assert search(client, 'POST', **{'If-None-Match': etag}).status_code == 200
+
+
+def test_gzip_body_has_its_own_etag_and_revalidates(client, compressed):
+    plain = search(client, **{'Accept-Encoding': 'identity'})
+    response = search(client, **{'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(response.data) == plain.data
+    assert response.headers['ETag'] == plain.headers['ETag'][:-1] + '-gz"'
+    not_modified = search(client, **{'Accept-Encoding': 'gzip', 'If-None-Match': response.headers['ETag']})
+    assert not_modified.status_code == 304
+    assert not_modified.headers['ETag'] == response.headers['ETag']
+
+
+@pytest.mark.skipif(brotli is None, reason='brotli is not installed')
+def test_brotli_body_has_its_own_etag(client, compressed):
+    plain = search(client, **{'Accept-Encoding': 'identity'})
+    response = search(client, **{'Accept-Encoding': 'gzip, br'})
+    assert response.headers['Content-Encoding'] == 'br'
+    assert brotli.decompress(response.data) == plain.data
+    assert response.headers['ETag'] == plain.headers['ETag'][:-1] + '-br"'
+
+
+def test_small_bodies_are_not_compressed(client):
+    assert 'Content-Encoding' not in search(client, **{'Accept-Encoding': 'gzip'}).headers
+
+
+def test_compact_schema(client):
+    full = search(client)
+    response = client.get(f'/search?barcode={BARCODE}&schema=compact')
+    body = response.get_json()
+    assert body['schema'] == 'compact.v1'
+    assert body['name'] == 'Test Spread'
+    assert body['nutriments'] == {'sugars_100g': 56.3}
+    assert body['health_assessment'] == full.get_json()['health_assessment']
+    assert 'watched_terms' not in body and 'allergens' not in body
+    assert response.headers['ETag'].startswith('"compact.v1.')
+    assert client.get(f'/search?barcode={BARCODE}&schema=compact.v1').headers['ETag'] == response.headers['ETag']
+
+
+def test_default_schema_is_configurable(client, monkeypatch):
+    monkeypatch.setattr(app, 'DEFAULT_RESPONSE_SCHEMA', 'compact.v1')
+    assert search(client).get_json()['schema'] == 'compact.v1'
+
+
+def test_unknown_schema_is_400(client, mirror):
+    response = client.get(f'/search?barcode={BARCODE}&schema=compact.v9')
+    assert response.status_code == 400
+    assert response.get_json() == {'error': app.UNKNOWN_SCHEMA_ERROR}
+    assert mirror.hits == 0
+
+
+def test_etag_changes_with_the_rules_the_watched_terms_and_the_product(client, monkeypatch):
+    etag = search(client).headers['ETag']
+    digest = app.WATCHED_TERMS_DIGEST
+    monkeypatch.setattr(app, 'WATCHED_TERMS_DIGEST', 'changed')
+    assert search(client).headers['ETag'] != etag
+    monkeypatch.setattr(app, 'WATCHED_TERMS_DIGEST', digest)
+    assert search(client).headers['ETag'] == etag
+    monkeypatch.setattr(app.rule_engine, 'version', app.rule_engine.version + 1)
+    assert search(client).headers['ETag'] != etag
+    assert app.product_etag({'name': 'A'}, 'full') != app.product_etag({'name': 'B'}, 'full')
+
+
+def test_async_app_agrees_on_etags_and_304s(mirror, run_async_app):
+    etag = search(app.app.test_client()).headers['ETag']
+
+    async def revalidate(client):
+        response = await client.get(f'/search?barcode={BARCODE}')
+        not_modified = await client.get(f'/search?barcode={BARCODE}', headers={'If-None-Match': etag})
+        posted = await client.post('/search', data={'barcode': BARCODE}, headers={'If-None-Match': etag})
+        return response.headers['ETag'], not_modified.status, posted.status
+
+    assert run_async_app(revalidate) == (etag, 304, 200)
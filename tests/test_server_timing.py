@@ -0,0 +1,89 @@
+"""The Server-Timing header on /search, and the sampled timing log line"""
+import json
+import logging
+import re
+
+import app
+import request_timing
+
+ENTRY = re.compile(r'([\w-]+);dur=([\d.]+)(?:;desc="([^"]*)")?')
+
+
+def phases(header):
+    """{name: (milliseconds, description)} from a Server-Timing value, checking its syntax"""
+    entries = header.split(', ')
+    parsed = [ENTRY.fullmatch(entry) for entry in entries]
+    assert all(parsed), header
+    return {match[1]: (float(match[2]), match[3]) for match in parsed}
+
+
+def test_mirror_lookup_times_each_phase(mirror):
+    mirror.delays = {'3017620422003': 0.1}
+    first = app.ranked_mirrors()[0]
+    timing = phases(app.app.test_client().get('/search?barcode=3017620422003').headers['Server-Timing'])
+    assert list(timing)[0] == 'cache'
+    assert list(timing)[-1] == 'total'
+    assert {'cache', 'upstream', f'mirror-{first}', 'parse', 'assess', 'serialize'} <= set(timing)
+    assert timing[f'mirror-{first}'][1] == 'found'
+    assert timing[f'mirror-{first}'][0] >= 100
+    assert timing['total'][0] >= timing['upstream'][0] >= timing[f'mirror-{first}'][0]
+
+
+def test_cached_product_has_no_upstream_phases(mirror):
+    client = app.app.test_client()
+    client.get('/search?barcode=3017620422003')
+    timing = phases(client.get('/search?barcode=3017620422003').headers['Server-Timing'])
+    assert set(timing) == {'cache', 'assess', 'serialize', 'total'}
+
+
+def test_every_failed_mirror_is_described(mirror):
+    mirror.mode = 'missing'
+    timing = phases(app.app.test_client().get('/search?barcode=3017620422003').headers['Server-Timing'])
+    assert {name: description for name, (_, description) in timing.items() if name.startswith('mirror-')} == {
+        f'mirror-{name}': 'not_found' for name in app.OFF_MIRRORS
+    }
+
+
+def test_hedged_lookups_time_mirrors_from_their_threads(mirror, monkeypatch):
+    monkeypatch.setattr(app, 'LOOKUP_MODE', 'hedged')
+    timing = phases(app.app.test_client().get('/search?barcode=3017620422003').headers['Server-Timing'])
+    assert timing[f'mirror-{app.ranked_mirrors()[0]}'][1] == 'found'
+
+
+def test_errors_carry_the_header_too(mirror):
+    assert set(phases(app.app.test_client().get('/search?barcode=12').headers['Server-Timing'])) == {'serialize', 'total'}
+
+
+def test_header_can_be_turned_off(mirror, monkeypatch):
+    monkeypatch.setattr(app, 'SERVER_TIMING', False)
+    assert 'Server-Timing' not in app.app.test_client().get('/search?barcode=3017620422003').headers
+
+
+def test_phases_after_a_request_finished_are_not_added_to_it():
+    timing = request_timing.start()
+    request_timing.record('mirror-world', 0.5, 'found')
+    request_timing.finish()
+    with request_timing.phase('cache'):
+        pass
+    request_timing.record('mirror-uk', 1.0)
+    assert list(timing.phases) == ['mirror-world']
+
+
+def test_sampled_requests_log_their_phases(mirror, monkeypatch, caplog):
+    monkeypatch.setattr(app, 'TIMING_LOG_SAMPLE_RATE', 1.0)
+    caplog.set_level(logging.INFO, logger='scanner.timing')
+    app.app.test_client().get('/search?barcode=3017620422003')
+    line = json.loads(caplog.records[-1].getMessage())
+    assert line['barcode'] == '3017620422003'
+    assert line['result'] == 'found'
+    assert line['mode'] == 'sync'
+    assert 'upstream' in line['phases_ms']
+
+
+def test_async_app_sends_the_same_phases(mirror, run_async_app):
+    async def search(client):
+        response = await client.get('/search?barcode=3017620422003')
+        return response.headers['Server-Timing']
+
+    timing = phases(run_async_app(search))
+    assert {'cache', 'upstream', f'mirror-{app.ranked_mirrors()[0]}', 'assess', 'serialize', 'total'} <= set(timing)
@@ -0,0 +1,176 @@
+"""SharedProductCache: layout, eviction, oversized entries, lock-free reads under concurrent writes, and its tier in ProductCache"""
+import os
+import time
+import multiprocessing
+
+import pytest
+
+from app import ProductCache
+
+shared_cache = pytest.importorskip('shared_cache')
+from shared_cache import SLOT, SET_SIZE, READ_ATTEMPTS, SharedProductCache
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'cache')
+
+
+def test_round_trip(path):
+    cache = SharedProductCache(path, 64, 256)
+    assert cache.get('123') is None
+    assert cache.set('123', 10.0, b'{"name": "x"}')
+    assert cache.get('123') == (10.0, b'{"name": "x"}')
+    assert cache.stats()['shared_entries'] == 1
+
+
+def test_other_processes_see_writes(path):
+    writer = SharedProductCache(path, 64, 256)
+    reader = SharedProductCache(path, 64, 256)
+    writer.set('123', 10.0, b'{}')
+    assert reader.get('123') == (10.0, b'{}')
+
+
+def test_an_older_entry_does_not_replace_a_newer_one(path):
+    cache = SharedProductCache(path, 64, 256)
+    cache.set('123', 20.0, b'"new"')
+    assert cache.set('123', 10.0, b'"old"')
+    assert cache.get('123') == (20.0, b'"new"')
+
+
+def test_a_full_set_evicts_its_oldest_entry(path):
+    # One set, so every barcode competes for the same slots
+    cache = SharedProductCache(path, SET_SIZE, 256)
+    for number in range(SET_SIZE + 1):
+        cache.set(str(number), float(number), b'{}')
+    assert cache.get('0') is None
+    assert all(cache.get(str(number)) for number in range(1, SET_SIZE + 1))
+    assert cache.evictions == 1
+    assert cache.stats()['shared_entries'] == SET_SIZE
+
+
+def test_oversized_entries_are_not_stored(path):
+    cache = SharedProductCache(path, 64, 256)
+    assert not cache.set('123', 10.0, b'x' * 256)
+    assert cache.get('123') is None
+    assert cache.oversized == 1
+
+
+def test_a_file_laid_out_differently_is_refused(path):
+    SharedProductCache(path, 64, 256)
+    with pytest.raises(ValueError):
+        SharedProductCache(path, 64, 512)
+    with pytest.raises(ValueError):
+        SharedProductCache(path, 128, 256)
+
+
+def test_a_slot_being_written_is_retried_and_never_returned(path):
+    cache = SharedProductCache(path, SET_SIZE, 256)
+    cache.set('123', 10.0, b'{}')
+    offset = next(offset for offset in cache._set_offsets(b'123')
+                  if cache._map[offset + SLOT.size:offset + SLOT.size + 3] == b'123')
+    sequence = shared_cache.SEQUENCE.unpack_from(cache._map, offset)[0]
+    # What a reader sees while a writer is halfway through the slot
+    shared_cache.SEQUENCE.pack_into(cache._map, offset, sequence | 1)
+    assert cache.get('123') is None
+    assert cache.read_retries == READ_ATTEMPTS
+    shared_cache.SEQUENCE.pack_into(cache._map, offset, sequence + 2)
+    assert cache.get('123') == (10.0, b'{}')
+
+
+def test_a_torn_payload_fails_its_crc(path):
+    cache = SharedProductCache(path, SET_SIZE, 256)
+    cache.set('123', 10.0, b'{"a": 1}')
+    offset = next(offset for offset in cache._set_offsets(b'123')
+                  if cache._map[offset + SLOT.size:offset + SLOT.size + 3] == b'123')
+    cache._map[offset + SLOT.size + 3] ^= 0xFF
+    assert cache.get('123') is None
+    assert cache.read_retries == READ_ATTEMPTS
+
+
+def _write_generations(path, barcodes, generations):
+    cache = SharedProductCache(path, SET_SIZE * 2, 512)
+    for generation in range(1, generations + 1):
+        for barcode in barcodes:
+            # Every generation has its own length and content, so a mix of two is detectable
+            cache.set(barcode, float(generation), f'{generation}:'.encode() * (generation % 40 + 1))
+
+
+def _read_until_done(path, barcodes, done, torn):
+    cache = SharedProductCache(path, SET_SIZE * 2, 512)
+    while not done.is_set():
+        for barcode in barcodes:
+            entry = cache.get(barcode)
+            if entry is None:
+                continue
+            fetched_at, data = entry
+            generation = int(fetched_at)
+            if data != f'{generation}:'.encode() * (generation % 40 + 1):
+                torn.value += 1
+
+
+def test_concurrent_readers_never_see_a_torn_entry(path):
+    context = multiprocessing.get_context('fork')
+    barcodes = [str(number) for number in range(12)]
+    SharedProductCache(path, SET_SIZE * 2, 512)
+    done = context.Event()
+    torn = context.Value('i', 0)
+    readers = [context.Process(target=_read_until_done, args=(path, barcodes, done, torn)) for _ in range(2)]
+    writers = [context.Process(target=_write_generations, args=(path, barcodes, 300)) for _ in range(2)]
+    for process in readers + writers:
+        process.start()
+    for process in writers:
+        process.join(60)
+    done.set()
+    for process in readers:
+        process.join(10)
+    assert all(process.exitcode == 0 for process in readers + writers)
+    assert torn.value == 0
+    assert SharedProductCache(path, SET_SIZE * 2, 512).stats()['shared_entries'] == SET_SIZE * 2
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='needs fork')
+def test_a_forked_child_writes_through_the_inherited_mapping(path):
+    cache = SharedProductCache(path, 64, 256)
+    pid = os.fork()
+    if pid == 0:
+        os._exit(0 if cache.set('123', 10.0, b'{}') else 1)
+    _, status = os.waitpid(pid, 0)
+    assert os.waitstatus_to_exitcode(status) == 0
+    assert cache.get('123') == (10.0, b'{}')
+
+
+def worker_cache(path, slot_size=256):
+    # What each gunicorn worker builds: its own memory tier over the shared file
+    return ProductCache(16, 60, max_stale=60, shared=SharedProductCache(path, 64, slot_size))
+
+
+def test_workers_share_products_through_the_shared_tier(path):
+    worker_cache(path).set('123', {'name': 'Spread'})
+    other = worker_cache(path)
+    assert other.get('123')[0] == {'name': 'Spread'}
+    # Copied into that worker's memory tier on the first hit
+    assert other.get('123')[0] == {'name': 'Spread'}
+    stats = other.stats()
+    assert (stats['shared_hits'], stats['memory_hits']) == (1, 1)
+
+
+def test_shared_entry_keeps_its_age(path):
+    first = worker_cache(path)
+    first._shared_set('123', time.time() - 90, {'name': 'Spread'})
+    product_info, age = worker_cache(path).get('123')
+    assert product_info == {'name': 'Spread'}
+    assert 89 < age < 91
+
+
+def test_shared_entry_past_max_stale_is_a_miss(path):
+    first = worker_cache(path)
+    first._shared_set('123', time.time() - 121, {'name': 'Spread'})
+    assert worker_cache(path).get('123') == (None, None)
+
+
+def test_product_too_large_for_a_slot_stays_in_its_worker(path):
+    first = worker_cache(path, slot_size=64)
+    first.set('123', {'name': 'x' * 100})
+    assert first.get('123')[0] == {'name': 'x' * 100}
+    assert worker_cache(path, slot_size=64).get('123') == (None, None)
@@ -0,0 +1,98 @@
+"""SingleFlight: concurrent lookups of one barcode share a single upstream fetch and its outcome"""
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import app
+from app import SingleFlight
+
+
+def run_together(flights, key, fn, callers, timeout=None):
+    """Call flights.do(key, fn) from several threads at once, returning each result or exception"""
+    def call():
+        try:
+            return flights.do(key, fn, timeout=timeout)
+        except Exception as e:
+            return e
+    with ThreadPoolExecutor(callers) as pool:
+        return list(pool.map(lambda _: call(), range(callers)))
+
+
+def slow(result, seconds=0.2):
+    calls = []
+
+    def fn():
+        calls.append(threading.get_ident())
+        time.sleep(seconds)
+        if isinstance(result, Exception):
+            raise result
+        return result
+    return fn, calls
+
+
+def test_concurrent_calls_share_one_run():
+    flights = SingleFlight()
+    fn, calls = slow({'product_name': 'Spread'})
+    results = run_together(flights, '3017620422003', fn, 5)
+    assert len(calls) == 1
+    assert results == [{'product_name': 'Spread'}] * 5
+    assert flights.stats() == {'upstream_fetches': 1, 'coalesced_requests': 4, 'in_flight': 0}
+
+
+def test_the_exception_reaches_every_waiter():
+    flights = SingleFlight()
+    error = app.UpstreamUnavailable()
+    fn, calls = slow(error)
+    results = run_together(flights, '3017620422003', fn, 4)
+    assert len(calls) == 1
+    assert all(result is error for result in results)
+    assert flights.stats()['in_flight'] == 0
+
+
+def test_different_keys_do_not_wait_for_each_other():
+    flights = SingleFlight()
+    fn, calls = slow(None, 0.1)
+    with ThreadPoolExecutor(2) as pool:
+        list(pool.map(lambda key: flights.do(key, fn), ['3017620422003', '5449000000996']))
+    assert len(calls) == 2
+    assert flights.stats()['coalesced_requests'] == 0
+
+
+def test_a_finished_call_is_not_reused():
+    flights = SingleFlight()
+    fn, calls = slow('first', 0)
+    flights.do('3017620422003', fn)
+    flights.do('3017620422003', fn)
+    assert len(calls) == 2
+
+
+def test_joiner_times_out_while_the_call_carries_on():
+    flights = SingleFlight()
+    fn, calls = slow('found', 0.5)
+    results = run_together(flights, '3017620422003', fn, 2, timeout=0.05)
+    assert 'found' in results
+    assert any(isinstance(result, TimeoutError) for result in results)
+    assert len(calls) == 1
+
+
+def test_concurrent_searches_fetch_once(mirror):
+    mirror.delays = {'3017620422003': 0.3}
+    with ThreadPoolExecutor(4) as pool:
+        responses = list(pool.map(lambda _: app.app.test_client().get('/search?barcode=3017620422003'), range(4)))
+    assert [response.status_code for response in responses] == [200] * 4
+    assert mirror.hits == 1
+
+
+def test_async_concurrent_searches_fetch_once(mirror, run_async_app):
+    mirror.delays = {'3017620422003': 0.3}
+
+    async def searches(client):
+        responses = await asyncio.gather(*(client.get('/search?barcode=3017620422003') for _ in range(4)))
+        stats = await (await client.get('/admin/coalescing')).json()
+        return [response.status for response in responses], stats
+
+    statuses, stats = run_async_app(searches)
+    assert statuses == [200] * 4
+    assert mirror.hits == 1
+    assert stats['coalesced_requests'] >= 3
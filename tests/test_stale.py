@@ -0,0 +1,155 @@
+"""Stale products: served at once while refreshed in the background, and served when the mirrors fail"""
+import time
+import asyncio
+from collections import OrderedDict
+
+import pytest
+
+import app
+
+BARCODE = '3017620422003'
+
+
+@pytest.fixture
+def client(mirror, monkeypatch):
+    monkeypatch.setattr(app, '_refresh_misses', OrderedDict())
+    return app.app.test_client()
+
+
+@pytest.fixture(params=['sequential', 'hedged'])
+def lookup_mode(request, monkeypatch):
+    monkeypatch.setattr(app, 'LOOKUP_MODE', request.param)
+    return request.param
+
+
+def cache_aged(barcode, age):
+    # What the cache would hold had the product been fetched age seconds ago
+    app.product_cache._remember(barcode, time.time() - age, app.extract_product_info({'product_name': 'Cached'}, 'world'))
+
+
+def refreshed():
+    """Wait for the background refreshes to finish"""
+    deadline = time.monotonic() + 5
+    while app._refreshing or app.upstream_flights.stats()['in_flight']:
+        assert time.monotonic() < deadline, 'background refresh did not finish'
+        time.sleep(0.01)
+
+
+def test_stale_copy_is_served_at_once_and_refreshed_behind_it(client, mirror):
+    # Past the TTL (60 s) but within max-stale (another 60 s)
+    cache_aged(BARCODE, 90)
+    mirror.delays = {BARCODE: 0.3}
+    started = time.monotonic()
+    body = client.get(f'/search?barcode={BARCODE}').get_json()
+    assert time.monotonic() - started < 0.3
+    assert body['name'] == 'Cached'
+    assert body['stale'] is True
+    refreshed()
+    body = client.get(f'/search?barcode={BARCODE}').get_json()
+    assert body['name'] == 'Test Spread'
+    assert 'stale' not in body
+    assert mirror.hits == 1
+
+
+def test_concurrent_stale_hits_refresh_once(client, mirror):
+    cache_aged(BARCODE, 90)
+    mirror.delays = {BARCODE: 0.2}
+    for _ in range(5):
+        client.get(f'/search?barcode={BARCODE}')
+    refreshed()
+    assert mirror.hits == 1
+
+
+def test_product_gone_upstream_is_refreshed_once_per_ttl(client, mirror):
+    cache_aged(BARCODE, 90)
+    mirror.mode = 'missing'
+    client.get(f'/search?barcode={BARCODE}')
+    refreshed()
+    assert mirror.hits == len(app.OFF_MIRRORS)
+    for _ in range(3):
+        assert client.get(f'/search?barcode={BARCODE}').get_json()['stale'] is True
+        refreshed()
+    assert mirror.hits == len(app.OFF_MIRRORS)
+    # A TTL later it is tried again
+    app._refresh_misses[BARCODE] -= app.PRODUCT_CACHE_TTL
+    client.get(f'/search?barcode={BARCODE}')
+    refreshed()
+    assert mirror.hits == 2 * len(app.OFF_MIRRORS)
+
+
+def test_failed_refresh_is_retried_by_the_next_stale_hit(client, mirror):
+    cache_aged(BARCODE, 90)
+    mirror.mode = 'error'
+    client.get(f'/search?barcode={BARCODE}')
+    refreshed()
+    mirror.mode = 'ok'
+    client.get(f'/search?barcode={BARCODE}')
+    refreshed()
+    assert client.get(f'/search?barcode={BARCODE}').get_json()['name'] == 'Test Spread'
+
+
+def test_refresh_backoff_forgets_old_misses(client, monkeypatch):
+    monkeypatch.setattr(app, 'REFRESH_MISSES_MAX', 2)
+    for barcode in ('1', '2', '3'):
+        app.record_refresh_miss(barcode)
+    assert list(app._refresh_misses) == ['2', '3']
+    assert app.refresh_due('1') and not app.refresh_due('3')
+
+
+def test_async_refresh_backs_off_when_the_product_is_gone(client, mirror, run_async_app):
+    import async_app
+    cache_aged(BARCODE, 90)
+    mirror.mode = 'missing'
+
+    async def stale_hits(async_client):
+        bodies = []
+        for _ in range(3):
+            bodies.append(await (await async_client.get(f'/search?barcode={BARCODE}')).json())
+            # Lets the background refresh run to completion
+            while async_app.upstream_flights:
+                await asyncio.sleep(0.01)
+        return bodies
+
+    bodies = run_async_app(stale_hits)
+    assert all(body['stale'] for body in bodies)
+    assert mirror.hits == len(app.OFF_MIRRORS)
+    assert not app.refresh_due(BARCODE)
+
+
+def test_stale_copy_is_served_when_the_mirrors_fail(client, mirror, lookup_mode):
+    # Past the TTL and max-stale window, but within stale-if-error
+    cache_aged(BARCODE, 600)
+    mirror.mode = 'error'
+    response = client.get(f'/search?barcode={BARCODE}')
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body['name'] == 'Cached'
+    assert body['stale'] is True
+
+
+def test_async_stale_copy_is_served_when_the_mirrors_fail(client, mirror, run_async_app):
+    cache_aged(BARCODE, 600)
+    mirror.mode = 'error'
+
+    async def search(async_client):
+        response = await async_client.get(f'/search?barcode={BARCODE}')
+        return response.status, await response.json()
+
+    status, body = run_async_app(search)
+    assert status == 200
+    assert body['stale'] is True
+
+
+def test_stale_copy_is_replaced_when_a_mirror_answers(client, mirror):
+    cache_aged(BARCODE, 600)
+    response = client.get(f'/search?barcode={BARCODE}')
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body['name'] == 'Test Spread'
+    assert 'stale' not in body
+
+
+def test_copy_past_stale_if_error_is_not_served(client, mirror):
+    cache_aged(BARCODE, 60 + 3600 + 1)
+    mirror.mode = 'error'
+    assert client.get(f'/search?barcode={BARCODE}').status_code == 503
@@ -0,0 +1,88 @@
+"""TermMatcher: every watched term in one pass, with bounded terms only where they stand alone"""
+import random
+
+import pytest
+
+from health_rules import WATCHED_TERMS, term_matcher, watched_terms
+from term_matcher import TermMatcher
+
+
+@pytest.fixture
+def matcher():
+    return TermMatcher(
+        {'he': 'a', 'she': 'a', 'his': 'b', 'hers': 'b', 'nuts': 'allergen', 'peanuts': 'allergen', 'e120': 'colour'},
+        bounded=['nuts', 'E120'],
+    )
+
+
+def test_overlapping_terms_are_all_reported_where_they_end(matcher):
+    assert matcher.scan('ushers') == [('she', 'a', 1), ('he', 'a', 2), ('hers', 'b', 2)]
+    assert matcher.terms_in('en:peanuts') == {'nuts': 'allergen', 'peanuts': 'allergen'}
+
+
+def test_repeats_are_scanned_each_time_and_listed_once(matcher):
+    assert [start for term, _, start in matcher.scan('he he') if term == 'he'] == [0, 3]
+    assert matcher.terms_in('he he') == {'he': 'a'}
+
+
+def test_matching_ignores_case(matcher):
+    assert matcher.terms_in('SHE and His') == {'he': 'a', 'she': 'a', 'his': 'b'}
+    assert matcher.scan('E120') == [('e120', 'colour', 0)]
+
+
+def test_bounded_terms_must_stand_alone(matcher):
+    assert matcher.words_in('e1200') == {}
+    assert matcher.words_in('colour (E120), water') == {'e120': 'colour'}
+    assert matcher.words_in('doughnuts') == {}
+    assert matcher.words_in('nuts') == {'nuts': 'allergen'}
+    assert matcher.words_in('en:nuts') == {'nuts': 'allergen'}
+
+
+def test_plain_substring_matching_ignores_bounds(matcher):
+    assert matcher.terms_in('e1200') == {'e120': 'colour'}
+    assert matcher.terms_in('doughnuts') == {'nuts': 'allergen'}
+
+
+def test_unbounded_terms_match_inside_words(matcher):
+    # 'peanuts' is not bounded, 'nuts' inside it is
+    assert matcher.words_in('peanutsauce') == {'peanuts': 'allergen'}
+
+
+def test_no_terms_and_empty_text():
+    assert TermMatcher({}).terms_in('anything') == {}
+    assert len(TermMatcher({'a': 'x'})) == 1
+    assert TermMatcher({'a': 'x'}).scan('') == []
+
+
+def test_agrees_with_one_substring_check_per_term():
+    terms = {'ab': 1, 'abc': 2, 'bca': 3, 'c': 4, 'cab': 5, 'aaa': 6}
+    matcher = TermMatcher(terms, bounded=['c'])
+    rng = random.Random(13)
+    for _ in range(500):
+        text = ''.join(rng.choice('abc ') for _ in range(rng.randrange(12)))
+        assert matcher.terms_in(text) == {term: category for term, category in terms.items() if term in text}
+        naive = sorted((term, start) for term in terms for start in range(len(text)) if text.startswith(term, start))
+        assert sorted((term, start) for term, _, start in TermMatcher(terms).scan(text)) == naive
+
+
+def test_watched_short_terms_and_e_numbers_are_bounded():
+    assert 'bha' in term_matcher.words_in('antioxidant: BHA')
+    assert 'bha' not in term_matcher.words_in('onion bhaji')
+    assert 'e120' not in term_matcher.words_in('e1200')
+    assert term_matcher.words_in('palm oil')['palm oil'] == 'oil'
+
+
+def test_every_watched_term_is_found_with_its_category():
+    for category, terms in WATCHED_TERMS.items():
+        for term in terms:
+            assert term_matcher.words_in(f'water, {term.upper()}, salt').get(term) == category
+
+
+def test_watched_terms_lists_hits_by_field():
+    hits = watched_terms({'ingredients': 'Sugar, palm oil, E120', 'allergens': ['en:peanuts', 'en:milk']})
+    assert {'term': 'palm oil', 'category': 'oil', 'field': 'ingredients'} in hits
+    assert {'term': 'e120', 'category': 'colour', 'field': 'ingredients'} in hits
+    assert {'term': 'peanuts', 'category': 'allergen', 'field': 'allergens', 'tag': 'en:peanuts'} in hits
+    assert {'term': 'milk', 'category': 'allergen', 'field': 'allergens', 'tag': 'en:milk'} in hits
+    # 'nuts' is bounded, and 'en:peanuts' only contains it inside a word
+    assert not any(hit['term'] == 'nuts' for hit in hits)